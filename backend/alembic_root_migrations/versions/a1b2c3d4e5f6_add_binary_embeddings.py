@@ -0,0 +1,104 @@
+"""add binary float32 embedding columns
+
+Revision ID: a1b2c3d4e5f6
+Revises: f6a7b2c3d8e9
+Create Date: 2026-10-18 10:00:00.000000
+
+Add nullable BLOB columns `faces.embedding_bin` and `users.encoding_bin`
+holding one format byte (1 = little-endian float32) followed by the raw
+vector, then backfill them from the JSON columns in throttled batches.
+
+The new columns are committed first and every batch of the backfill is
+its own transaction, so row locks and undo are bounded by one batch and
+an interrupted run resumes where it stopped (only rows whose binary
+column is still NULL are read). The JSON columns are left untouched, so
+downgrading only drops the new columns. Batch size and pause between
+batches can be tuned with EMBEDDING_BACKFILL_BATCH (default 500) and
+EMBEDDING_BACKFILL_SLEEP (seconds, default 0.05).
+"""
+import json
+import logging
+import os
+import time
+
+from alembic import op
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = 'a1b2c3d4e5f6'
+down_revision = 'f6a7b2c3d8e9'
+branch_labels = None
+depends_on = None
+
+FORMAT_F32_V1 = 1
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+
+def _pack(raw):
+    if raw is None:
+        return None
+    vec = json.loads(raw) if isinstance(raw, str) else raw
+    # JSON columns written by enroll hold a JSON-encoded string of the list
+    if isinstance(vec, str):
+        vec = json.loads(vec)
+    if not vec:
+        return None
+    return bytes([FORMAT_F32_V1]) + np.asarray(vec, dtype='<f4').tobytes()
+
+
+def _backfill(conn, table, json_col, bin_col):
+    # runs on an autocommit connection: BEGIN/COMMIT delimit one batch
+    batch = int(os.getenv('EMBEDDING_BACKFILL_BATCH', 500))
+    pause = float(os.getenv('EMBEDDING_BACKFILL_SLEEP', 0.05))
+    last_id = 0
+    total = 0
+    while True:
+        rows = conn.execute(text(
+            f"SELECT id, {json_col} FROM {table} "
+            f"WHERE id > :last AND {bin_col} IS NULL AND {json_col} IS NOT NULL "
+            f"ORDER BY id LIMIT :n"
+        ), {'last': last_id, 'n': batch}).fetchall()
+        if not rows:
+            break
+        updates = []
+        for row_id, raw in rows:
+            try:
+                packed = _pack(raw)
+            except (ValueError, TypeError):
+                packed = None
+            if packed is not None:
+                updates.append({'b': packed, 'id': row_id})
+        if updates:
+            conn.execute(text("BEGIN"))
+            try:
+                conn.execute(text(f"UPDATE {table} SET {bin_col} = :b WHERE id = :id"), updates)
+            except Exception:
+                conn.execute(text("ROLLBACK"))
+                raise
+            conn.execute(text("COMMIT"))
+            total += len(updates)
+        last_id = rows[-1][0]
+        if pause:
+            time.sleep(pause)
+    logger.info('backfilled %d %s.%s rows', total, table, bin_col)
+    return total
+
+
+def upgrade():
+    op.add_column('faces', sa.Column('embedding_bin', sa.LargeBinary(), nullable=True))
+    op.add_column('users', sa.Column('encoding_bin', sa.LargeBinary(), nullable=True))
+
+    # commit the new columns, then backfill one committed batch at a time
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        _backfill(conn, 'faces', 'embedding', 'embedding_bin')
+        _backfill(conn, 'users', 'encoding', 'encoding_bin')
+
+
+def downgrade():
+    # JSON columns were never modified; dropping the binary copies is enough.
+    op.drop_column('users', 'encoding_bin')
+    op.drop_column('faces', 'embedding_bin')
@@ -0,0 +1,27 @@
+"""add per-user face prototypes
+
+Revision ID: a4d8e2f6b1c3
+Revises: f3c7d9e1a2b4
+Create Date: 2026-10-18 22:00:00.000000
+
+`users.prototypes_bin` holds USER_PROTOTYPES k-medoids of the user's
+active face embeddings (packed k x D float32). NULL means "use every
+active face", which is what existing users get until
+`flask --app manage gallery recluster` or their next enroll/delete.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8e2f6b1c3'
+down_revision = 'f3c7d9e1a2b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('prototypes_bin', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('users', 'prototypes_bin')
@@ -0,0 +1,28 @@
+"""add user site
+
+Revision ID: b7e3a9c1d2f4
+Revises: a1b2c3d4e5f6
+Create Date: 2026-10-18 12:00:00.000000
+
+Add a nullable, indexed `site` column to `users`. Together with
+`department` it can be used to partition the face gallery so a kiosk
+only searches the users of its own site.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3a9c1d2f4'
+down_revision = 'a1b2c3d4e5f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('site', sa.String(length=128), nullable=True))
+    op.create_index('ix_users_site', 'users', ['site'])
+
+
+def downgrade():
+    op.drop_index('ix_users_site', table_name='users')
+    op.drop_column('users', 'site')
@@ -0,0 +1,29 @@
+"""add lease columns to enroll_jobs
+
+Revision ID: b9e4f1a7c2d5
+Revises: a4d8e2f6b1c3
+Create Date: 2026-10-18 23:00:00.000000
+
+A running enrollment job is owned by the worker holding its lease
+(`lease_owner` token, `lease_until` expiry renewed by a heartbeat); only
+jobs whose lease expired are re-queued, so a slow job is never processed
+twice.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b9e4f1a7c2d5'
+down_revision = 'a4d8e2f6b1c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('enroll_jobs', sa.Column('lease_owner', sa.String(length=32), nullable=True))
+    op.add_column('enroll_jobs', sa.Column('lease_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('enroll_jobs', 'lease_until')
+    op.drop_column('enroll_jobs', 'lease_owner')
@@ -0,0 +1,30 @@
+"""add running embedding sum/count to users
+
+Revision ID: c8f4b0d2e3a5
+Revises: b7e3a9c1d2f4
+Create Date: 2026-10-18 14:00:00.000000
+
+Add `users.encoding_sum` (float32 blob, same format as `encoding_bin`)
+and `users.encoding_count` so enroll/delete can update the centroid
+incrementally. Existing users are seeded lazily from their stored face
+embeddings on the next enroll/delete; run
+`flask --app manage gallery rebuild-centroids` to fill them all at once.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c8f4b0d2e3a5'
+down_revision = 'b7e3a9c1d2f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('encoding_sum', sa.LargeBinary(), nullable=True))
+    op.add_column('users', sa.Column('encoding_count', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'encoding_count')
+    op.drop_column('users', 'encoding_sum')
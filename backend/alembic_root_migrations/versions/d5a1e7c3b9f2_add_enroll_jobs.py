@@ -0,0 +1,41 @@
+"""add enroll_jobs table for asynchronous enrollment
+
+Revision ID: d5a1e7c3b9f2
+Revises: c8f4b0d2e3a5
+Create Date: 2026-10-18 16:00:00.000000
+
+`POST /api/face/enroll?async=1` stores the uploads, records a job row and
+returns 202; a worker thread in the web process processes the job and
+`GET /api/face/jobs/<id>` reports per-file progress from `files`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd5a1e7c3b9f2'
+down_revision = 'c8f4b0d2e3a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'enroll_jobs',
+        sa.Column('id', sa.String(length=36), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='queued'),
+        sa.Column('profile', sa.String(length=32), nullable=True),
+        sa.Column('files', sa.JSON(), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_enroll_jobs_user_id', 'enroll_jobs', ['user_id'])
+    op.create_index('ix_enroll_jobs_status', 'enroll_jobs', ['status'])
+
+
+def downgrade():
+    op.drop_index('ix_enroll_jobs_status', table_name='enroll_jobs')
+    op.drop_index('ix_enroll_jobs_user_id', table_name='enroll_jobs')
+    op.drop_table('enroll_jobs')
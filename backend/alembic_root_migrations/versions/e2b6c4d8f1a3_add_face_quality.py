@@ -0,0 +1,25 @@
+"""add face quality score
+
+Revision ID: e2b6c4d8f1a3
+Revises: d5a1e7c3b9f2
+Create Date: 2026-10-18 18:00:00.000000
+
+`faces.quality` holds the face quality score (0..1) computed by the
+enrollment quality gate. Faces enrolled before have NULL.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e2b6c4d8f1a3'
+down_revision = 'd5a1e7c3b9f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('faces', sa.Column('quality', sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('faces', 'quality')
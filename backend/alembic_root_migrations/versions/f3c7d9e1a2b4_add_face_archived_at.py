@@ -0,0 +1,26 @@
+"""add face archived_at
+
+Revision ID: f3c7d9e1a2b4
+Revises: e2b6c4d8f1a3
+Create Date: 2026-10-18 20:00:00.000000
+
+`faces.archived_at` marks faces dropped from a user's active templates
+by the per-user cap (FACE_TEMPLATES_MAX). Existing faces stay active;
+run `flask --app manage gallery cap-templates` to apply the cap to them.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f3c7d9e1a2b4'
+down_revision = 'e2b6c4d8f1a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('faces', sa.Column('archived_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('faces', 'archived_at')
@@ -300,6 +300,16 @@ def create_app():
     app.register_blueprint(face_bp, url_prefix='/api/face')
     app.register_blueprint(statistics_bp, url_prefix='/api/statistics')
 
+    # maintenance CLI (`flask --app manage gallery ...`)
+    from backend.commands import gallery_cli
+
+    app.cli.add_command(gallery_cli)
+
+    # probe the face detectors once instead of catching CNN failures per request
+    from backend.utils.face_utils import probe_detectors
+
+    probe_detectors()
+
     @app.route('/')
     def index():
         return 'Backend is running', 200
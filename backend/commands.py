@@ -0,0 +1,177 @@
+"""Flask CLI commands for offline maintenance.
+
+Run from the repository root, e.g.:
+
+    flask --app manage gallery export --dir /var/lib/face-gallery
+    flask --app manage gallery verify --dir /var/lib/face-gallery --against-db
+    flask --app manage gallery rebuild-centroids
+    flask --app manage gallery cap-templates --max 10
+    flask --app manage gallery recluster --workers 4
+"""
+import os
+
+import click
+import numpy as np
+from flask.cli import AppGroup
+
+from backend.extensions import db
+from backend.models import User, Face
+
+gallery_cli = AppGroup('gallery', help='Gallery snapshot tools.')
+
+
+def _snapshot_dir(value):
+    d = value or os.getenv('GALLERY_SNAPSHOT_DIR', '')
+    if not d:
+        raise click.UsageError('pass --dir or set GALLERY_SNAPSHOT_DIR')
+    return d
+
+
+@gallery_cli.command('export')
+@click.option('--dir', 'snapshot_dir', help='Snapshot root (default: $GALLERY_SNAPSHOT_DIR).')
+@click.option('--keep', default=3, show_default=True, help='Number of snapshot versions to keep.')
+def export_snapshot(snapshot_dir, keep):
+    """Load the gallery from the DB and publish it as a new snapshot."""
+    from backend.utils.face_utils import load_gallery_arrays
+    from backend.utils.snapshot import snapshot_lock, write_snapshot
+
+    snapshot_dir = _snapshot_dir(snapshot_dir)
+    stats = {}
+    arrays = load_gallery_arrays(User, Face, stats=stats)
+    with snapshot_lock(snapshot_dir):
+        version = write_snapshot(snapshot_dir, arrays, meta={'source': 'cli'}, keep=keep)
+    click.echo('exported snapshot %s: %d users, %d faces (%.0f rows/s)' % (
+        version, stats['users'], stats['faces'], stats.get('rows_per_sec') or 0))
+
+
+@gallery_cli.command('verify')
+@click.option('--dir', 'snapshot_dir', help='Snapshot root (default: $GALLERY_SNAPSHOT_DIR).')
+@click.option('--version', default=None, help='Version to check (default: the live one).')
+@click.option('--against-db', is_flag=True, help='Also compare the snapshot with the database.')
+def verify_snapshot_cmd(snapshot_dir, version, against_db):
+    """Check a snapshot for consistency (and optionally against the DB)."""
+    from backend.utils.snapshot import load_snapshot, verify_snapshot
+
+    snapshot_dir = _snapshot_dir(snapshot_dir)
+    problems = verify_snapshot(snapshot_dir, version)
+    if not problems and against_db:
+        from backend.utils.face_utils import load_gallery_arrays
+
+        header, snap = load_snapshot(snapshot_dir, version)
+        db_arrays = load_gallery_arrays(User, Face)
+        if not np.array_equal(snap['uids'], db_arrays['uids']):
+            problems.append('user ids differ from DB (%d in snapshot, %d in DB)' % (
+                snap['uids'].shape[0], db_arrays['uids'].shape[0]))
+        elif not np.array_equal(snap['offsets'], db_arrays['offsets']):
+            problems.append('per-user face counts differ from DB')
+        else:
+            for name in ('centroids', 'faces'):
+                if not np.allclose(snap[name], db_arrays[name], atol=1e-5):
+                    problems.append('%s differ from DB' % name)
+    if problems:
+        for p in problems:
+            click.echo('FAIL: %s' % p)
+        raise SystemExit(1)
+    click.echo('snapshot OK')
+
+
+@gallery_cli.command('rebuild-centroids')
+@click.option('--user-id', 'user_ids', type=int, multiple=True, help='Only these users (repeatable).')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per streamed batch / commit.')
+def rebuild_centroids_cmd(user_ids, batch_size):
+    """Recompute user centroids and running sums from stored face embeddings."""
+    from backend.utils.centroid import rebuild_centroids
+    from backend.utils.gallery import gallery
+
+    result = rebuild_centroids(User, Face, db.session, batch_size=batch_size, user_ids=user_ids or None)
+    click.echo('rebuilt %d user centroids from %d faces (%d users without stored embeddings skipped)' % (
+        result['users'], result['faces'], result['skipped']))
+    if gallery.snapshot_dir:
+        # publish the repaired centroids so running workers pick them up
+        gallery.rebuild(User, Face)
+        click.echo('published snapshot %s' % gallery.snapshot_version)
+
+
+@gallery_cli.command('cap-templates')
+@click.option('--max', 'k', type=int, default=None, help='Active templates per user (default: $FACE_TEMPLATES_MAX).')
+@click.option('--reselect', is_flag=True, help='Let archived faces compete again (restoring selected ones).')
+@click.option('--user-id', 'user_ids', type=int, multiple=True, help='Only these users (repeatable).')
+def cap_templates_cmd(k, reselect, user_ids):
+    """Apply the per-user active template cap to existing users."""
+    from backend.utils.gallery import gallery
+    from backend.utils.prototypes import refresh_user_prototypes
+    from backend.utils.templates import cap_user_templates
+
+    users = User.query
+    if user_ids:
+        users = users.filter(User.id.in_(user_ids))
+    changed = []
+    n_archived = n_restored = 0
+    for user in users.order_by(User.id).all():
+        archived, restored = cap_user_templates(user, Face, k=k, reselect=reselect)
+        if archived or restored:
+            refresh_user_prototypes(user, Face)
+            db.session.commit()
+            changed.append(user.id)
+            n_archived += len(archived)
+            n_restored += len(restored)
+    click.echo('%d users changed: %d faces archived, %d restored' % (len(changed), n_archived, n_restored))
+    if changed and gallery.snapshot_dir:
+        # publish the trimmed templates so running workers pick them up
+        gallery.rebuild(User, Face)
+        click.echo('published snapshot %s' % gallery.snapshot_version)
+
+
+@gallery_cli.command('recluster')
+@click.option('--k', type=int, default=None, help='Prototypes per user (default: $USER_PROTOTYPES).')
+@click.option('--workers', type=int, default=None, help='Clustering processes (default: CPU count).')
+@click.option('--user-id', 'user_ids', type=int, multiple=True, help='Only these users (repeatable).')
+@click.option('--report/--no-report', default=True, show_default=True,
+              help='Compare match decisions before and after, using the active faces as queries.')
+def recluster_cmd(k, workers, user_ids, report):
+    """Recompute per-user prototypes from the active faces.
+
+    The report replays every active face as a mark query against the
+    gallery before and after reclustering; queries that are also templates
+    match themselves exactly without prototypes, so read the accept counts
+    as a lower bound of the change rather than a field accuracy.
+    """
+    from backend.utils.face_utils import load_gallery_arrays
+    from backend.utils.gallery import gallery
+    from backend.utils.matcher import MatchEngine
+    from backend.utils.prototypes import USER_PROTOTYPES, compare_decisions, recluster_all
+
+    if k and USER_PROTOTYPES <= 0:
+        click.echo('warning: USER_PROTOTYPES is 0, so matching ignores the stored prototypes '
+                   '(and the report shows no change) until it is set', err=True)
+    before = None
+    if report:
+        before = MatchEngine.from_arrays(**load_gallery_arrays(User, Face))
+    result = recluster_all(User, Face, db.session, k=k, workers=workers, user_ids=user_ids or None)
+    click.echo('reclustered %d users from %d faces (%d with prototypes)' % (
+        result['users'], result['faces'], result['with_prototypes']))
+
+    if report:
+        after = MatchEngine.from_arrays(**load_gallery_arrays(User, Face))
+        faces = load_gallery_arrays(User, Face, prototypes=False)
+        labels = np.repeat(faces['uids'], np.diff(faces['offsets']))
+        if user_ids:
+            keep = np.isin(labels, list(user_ids))
+            queries, labels = faces['faces'][keep], labels[keep]
+        else:
+            queries = faces['faces']
+        tol = dict(USER_TOL=float(os.getenv('USER_TOL', 0.45)), USER_MARGIN=float(os.getenv('USER_MARGIN', 0.15)),
+                   FACE_TOL=float(os.getenv('FACE_TOL', 0.55)))
+        cmp = compare_decisions(before, after, queries, labels.tolist(), **tol)
+        click.echo('%d queries, %d decisions changed' % (cmp['queries'], cmp['changed']))
+        for name in ('before', 'after'):
+            s = cmp[name]
+            click.echo('  %-6s accepted %d, correct %d, mean margin %s, mean face comparisons %s' % (
+                name, s['accepted'], s['correct'],
+                '-' if s['mean_margin'] is None else '%.4f' % s['mean_margin'],
+                '-' if s['mean_face_comparisons'] is None else '%.1f' % s['mean_face_comparisons']))
+
+    if gallery.snapshot_dir:
+        # publish the new prototypes so running workers pick them up
+        gallery.rebuild(User, Face)
+        click.echo('published snapshot %s' % gallery.snapshot_version)
@@ -20,6 +20,8 @@ class User(db.Model):
     password_hash = db.Column(db.String(255), nullable=True)
     role = db.Column(db.Enum(RoleEnum), nullable=False, default=RoleEnum.employee)
     department = db.Column(db.String(128), nullable=True)
+    # Site/location the user checks in at; optional gallery partition key
+    site = db.Column(db.String(128), nullable=True, index=True)
     avatar = db.Column(db.String(512), nullable=True)
     phone = db.Column(db.String(64), nullable=True)
     status = db.Column(db.String(32), nullable=False, default='Active')
@@ -35,6 +37,16 @@ class User(db.Model):
     # JSON-serialized averaged 128-d face embedding for this user
     # Use the JSON column type to align with MySQL `JSON` column
     encoding = db.Column(db.JSON, nullable=True)
+    # Same centroid as a 513-byte float32 blob (see utils/embedding.py);
+    # preferred on read, `encoding` is kept in sync during the transition
+    encoding_bin = db.Column(db.LargeBinary, nullable=True)
+    # Running sum (float32 blob) and count of the stored face embeddings,
+    # so the centroid is updated in O(1) on enroll/delete (utils/centroid.py)
+    encoding_sum = db.Column(db.LargeBinary, nullable=True)
+    encoding_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # k-medoid prototypes of the active faces, packed k x D float32
+    # (utils/prototypes.py); NULL = match against all active faces
+    prototypes_bin = db.Column(db.LargeBinary, nullable=True)
 
 
 class Face(db.Model):
@@ -45,10 +57,17 @@ class Face(db.Model):
     image_path = db.Column(db.String(512), nullable=True)
     # Per-face 128-d embedding stored as native JSON (array of floats)
     embedding = db.Column(db.JSON, nullable=True)
+    # Binary float32 copy of `embedding` (format byte + raw vector)
+    embedding_bin = db.Column(db.LargeBinary, nullable=True)
     # 'metadata' is a reserved attribute name on Declarative classes
     # (SQLAlchemy uses `.metadata` for MetaData). Use attribute `meta`
     # mapped to the DB column name 'metadata' to preserve schema.
     meta = db.Column('metadata', db.Text, nullable=True)
+    # Face quality score (0..1, see utils/quality.py) at enrollment
+    quality = db.Column(db.Float, nullable=True)
+    # Set when the face was dropped from the user's active templates
+    # (utils/templates.py); archived faces are kept but not matched against
+    archived_at = db.Column(db.DateTime, nullable=True)
     enrolled_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
@@ -79,3 +98,22 @@ class RefreshToken(db.Model):
     issued_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=True)
     revoked = db.Column(db.Boolean, default=False)
+
+
+class EnrollJob(db.Model):
+    """Asynchronous enrollment (`POST /api/face/enroll?async=1`, see utils/enroll_jobs.py)."""
+    __tablename__ = 'enroll_jobs'
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    # queued -> running -> done | failed
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    profile = db.Column(db.String(32), nullable=True)
+    # one entry per uploaded file: filename, face_id, path, status, error
+    files = db.Column(db.JSON, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # claim token and expiry of the running worker's lease, renewed by its heartbeat
+    lease_owner = db.Column(db.String(32), nullable=True)
+    lease_until = db.Column(db.DateTime, nullable=True)
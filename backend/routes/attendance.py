@@ -7,31 +7,37 @@ import datetime
 import hashlib
 from flask import current_app
 import json
-import numpy as np
-import face_recognition
 from zoneinfo import ZoneInfo
 from io import BytesIO
 import os
+import random
 import time
-import cv2
 import uuid
 from ..utils.face_utils import (
-    get_face_locations,
-    encode_faces,
-    load_user_profiles_from_db,
     decide_match,
+    verify_match,
     append_log_row,
-    is_blurry_bgr,
 )
+from ..utils.gallery import gallery
+from ..utils.profiles import get_profile
+from ..utils.quality import QUALITY_BLUR_THRESHOLD
+from ..utils.recognition_pool import RecognitionUnavailable, analyze_uploads
+from ..utils.embedding_cache import embedding_cache
 
 # Default matching thresholds (can be tuned via environment variables)
 USER_TOL = float(os.getenv('USER_TOL', 0.45))
 USER_MARGIN = float(os.getenv('USER_MARGIN', 0.15))
 FACE_TOL = float(os.getenv('FACE_TOL', 0.55))
 MIN_FACE_HEIGHT_PX = int(os.getenv('MIN_FACE_HEIGHT_PX', 120))
-BLUR_THRESHOLD = float(os.getenv('BLUR_THRESHOLD', 100.0))
 LOG_CSV_PATH = os.getenv('LOG_CSV_PATH', './logs/face_match_log.csv')
-LOG_HEADER = ['timestamp','query_id','best_uid','best_d','runner_up_d','margin','per_face_min','accepted','latency','true_label']
+LOG_HEADER = ['timestamp','query_id','best_uid','best_d','runner_up_d','margin','per_face_min','accepted','latency','true_label','scope','mode','profile']
+# What a scoped query does when its partition rejects: 'none' or 'global' (retry on the whole gallery)
+SCOPE_FALLBACK = os.getenv('SCOPE_FALLBACK', 'none').lower()
+# 1:1 verification for authenticated callers instead of 1:N identification
+VERIFY_AUTHENTICATED = os.getenv('VERIFY_AUTHENTICATED', '1').lower() in ('1', 'true', 'yes')
+VERIFY_TOL = float(os.getenv('VERIFY_TOL', USER_TOL))
+# fraction of verified requests that also run 1:N identification to catch impostors
+VERIFY_SAMPLE_RATE = float(os.getenv('VERIFY_SAMPLE_RATE', 0.0))
 
 attendance_bp = Blueprint('attendance', __name__)
 
@@ -62,13 +68,28 @@ def mark_attendance():
         user = db.session.get(User, int(uid)) if uid else None
     except Exception:
         user = db.session.get(User, uid) if uid else None
+    # only the token's identity is a claim worth verifying 1:1; a face_id
+    # in the request body is not proof of who is in front of the camera
+    token_user = user
 
     face_id = None
     distance_val = None
+    shared_image = False
+    # optional gallery partition (department/site) to identify against
+    scope = request.values.get('scope') or None
+
+    # recognition profile (fast/balanced/accurate); deployment default unless overridden
+    profile_name = request.values.get('profile') or None
 
     if request.is_json:
         body = request.get_json() or {}
         face_id = body.get('face_id')
+        scope = body.get('scope') or scope
+        profile_name = body.get('profile') or profile_name
+    try:
+        profile = get_profile(profile_name)
+    except KeyError:
+        return jsonify({'error': f'unknown profile: {profile_name}'}), 400
 
     if 'face_id' in request.form:
         face_id = request.form.get('face_id')
@@ -88,39 +109,68 @@ def mark_attendance():
         img = request.files['image']
         try:
             content = img.read()
-            arr = np.frombuffer(content, np.uint8)
-            image_bgr = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-            if image_bgr is None:
+
+            # decode, blur check and one detection pass (feeding the face
+            # count/size checks and the encoding) run in the recognition pool
+            min_face_px = profile['min_face_px'] or MIN_FACE_HEIGHT_PX
+            try:
+                detected, = analyze_uploads([content], profile, min_face_px,
+                                            profile['blur_threshold'] or QUALITY_BLUR_THRESHOLD)
+            except RecognitionUnavailable as e:
+                return jsonify({'error': 'recognition_unavailable', 'reason': e.reason}), 503
+            if detected['error'] == 'decode_failed':
                 return jsonify({'error': 'failed to decode uploaded image'}), 400
+            if detected['error'] == 'blurry':
+                return jsonify({'error': 'blurry_image', 'quality': detected['quality']}), 400
+            if detected['error'] in ('too_dark', 'too_bright'):
+                return jsonify({'error': detected['error'], 'quality': detected['quality']}), 400
+            if not detected['boxes']:
+                return jsonify({'error': 'no face detected in uploaded image'}), 400
+            if len(detected['boxes']) > 1:
+                return jsonify({'error': 'multiple faces detected; please provide a single-face image'}), 400
+            if detected['heights'][0] < min_face_px:
+                return jsonify({'error': 'face_too_small'}), 400
+            if not detected['encodings'] or detected['encodings'][0] is None:
+                return jsonify({'error': 'failed to compute encoding'}), 400
+
+            query_vec = detected['encodings'][0]
 
-            # quick quality checks
-            if is_blurry_bgr(image_bgr, threshold=BLUR_THRESHOLD):
-                return jsonify({'error': 'blurry_image'}), 400
-
-            rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-
-            # Prefer calling face_encodings directly (tests often patch this).
-            encs = encode_faces(rgb, locations=None, fr=face_recognition)
-            if not encs:
-                # fallback to explicit face detection for checks
-                locations = get_face_locations(rgb, prefer_cnn=True, fr=face_recognition)
-                if not locations:
-                    return jsonify({'error': 'no face detected in uploaded image'}), 400
-                if len(locations) > 1:
-                    return jsonify({'error': 'multiple faces detected; please provide a single-face image'}), 400
-                top, right, bottom, left = locations[0]
-                if (bottom - top) < MIN_FACE_HEIGHT_PX:
-                    return jsonify({'error': 'face_too_small'}), 400
-                encs = encode_faces(rgb, locations, fr=face_recognition)
-                if not encs:
-                    return jsonify({'error': 'failed to compute encoding'}), 400
-
-            query_vec = encs[0]
-
-            # load normalized user profiles and perform decision+logging
-            profiles = load_user_profiles_from_db(User, Face)
             start = time.time()
-            accepted, debug = decide_match(query_vec, profiles, USER_TOL, USER_MARGIN, FACE_TOL)
+            # an authenticated caller with an enrolled face is verified 1:1
+            # against their own profile; everyone else (including callers
+            # that only name a face_id) is identified 1:N
+            verify = VERIFY_AUTHENTICATED and token_user is not None and user is token_user
+            claimed = gallery.profile(user.id, User, Face) if verify else None
+            impostor_uid = None
+            if claimed is not None:
+                accepted, debug = verify_match(query_vec, user.id, claimed, VERIFY_TOL, FACE_TOL)
+                debug['mode'] = 'verify'
+                # a rejected claim (and a sample of accepted ones) is also
+                # identified 1:N, so an impostor gets identity_mismatch
+                if not accepted or (VERIFY_SAMPLE_RATE > 0 and random.random() < VERIFY_SAMPLE_RATE):
+                    check_ok, check = decide_match(query_vec, gallery.engine(User, Face, scope=scope),
+                                                   USER_TOL, USER_MARGIN, FACE_TOL)
+                    debug['impostor_check'] = {'best_uid': check.get('best_uid'), 'accepted': check_ok}
+                    if check_ok and check.get('best_uid') != user.id:
+                        impostor_uid = check['best_uid']
+            else:
+                # normalized user profiles come from the in-process gallery cache;
+                # a scoped query searches (and applies the margin rule) within its partition only
+                profiles = gallery.engine(User, Face, scope=scope)
+                accepted, debug = decide_match(query_vec, profiles, USER_TOL, USER_MARGIN, FACE_TOL)
+                debug['mode'] = 'identify'
+                if scope and not accepted and SCOPE_FALLBACK == 'global':
+                    accepted, debug = decide_match(query_vec, gallery.engine(User, Face), USER_TOL, USER_MARGIN, FACE_TOL)
+                    debug['mode'] = 'identify'
+                    debug['scope_fallback'] = True
+                    scope = None
+            debug['scope'] = scope
+            debug['profile'] = profile['name']
+            debug['detector_calls'] = detected['detector_calls']
+            debug['decode'] = detected['decode']
+            debug['quality'] = detected['quality']
+            debug['timings'] = detected['timings']
+            debug['cache'] = detected.get('cache')
             debug['latency'] = time.time() - start
             debug['timestamp'] = time.time()
             debug['query_id'] = str(uuid.uuid4())
@@ -131,14 +181,16 @@ def mark_attendance():
             except Exception:
                 current_app.logger.exception('Failed to append match log')
 
-            if not accepted:
+            if not accepted and impostor_uid is None:
                 return jsonify({'error': 'face_not_recognized', 'debug': debug}), 404
 
             # accepted -> map best_uid to User and face verification already done
+            # (a sampled 1:N check that accepted someone else overrides a 1:1 accept)
+            detected_uid = impostor_uid if impostor_uid is not None else debug['best_uid']
             try:
-                matched_user = db.session.get(User, int(debug['best_uid']))
+                matched_user = db.session.get(User, int(detected_uid))
             except Exception:
-                matched_user = db.session.get(User, debug['best_uid'])
+                matched_user = db.session.get(User, detected_uid)
 
             if user:
                 if matched_user and matched_user.id != user.id:
@@ -146,6 +198,8 @@ def mark_attendance():
 
             if not user:
                 user = matched_user
+            # one photo marking two different people is worth an admin's look
+            shared_image = bool(user and embedding_cache.note_user(detected.get('sha256'), user.id))
 
             # set face_id to None (per-face id can be determined later if needed)
             face_id = None
@@ -241,6 +295,8 @@ def mark_attendance():
         out['longitude'] = lon
     if timezone_fallback:
         out['timezone_fallback'] = True
+    if shared_image:
+        out['shared_image'] = True
 
     return jsonify({'marked': True, 'record': out})
 
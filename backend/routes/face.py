@@ -1,22 +1,38 @@
 from flask import Blueprint, request, jsonify, current_app
 from backend.extensions import db
-from backend.models import Face, User
+from backend.models import EnrollJob, Face, User
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from werkzeug.utils import secure_filename
 import os
+import time
 import uuid
-import hashlib
 import json
+from datetime import datetime
 import numpy as np
-import face_recognition
 from flask import abort
-import cv2
-from ..utils.face_utils import get_face_locations, encode_faces, normalize_vec, is_blurry_bgr
+from ..utils.face_utils import pipeline_stats
+from ..utils.gallery import gallery
+from ..utils.profiles import get_profile
+from ..utils.quality import QUALITY_BLUR_THRESHOLD
+from ..utils.recognition_pool import RecognitionUnavailable, analyze_uploads, encode_batcher, recognition_pool
+from ..utils.enroll_jobs import (EnrollJobRunner, LeaseLost, ENROLL_JOB_WORKERS, ENROLL_JOB_POLL_SECONDS,
+                                  ENROLL_JOB_LEASE_SECONDS)
+from ..utils.upload import PENDING_SUFFIX, UploadTooLarge, read_upload, write_atomic
+from ..utils.embedding import decode_stored, pack_embedding
+from ..utils.templates import cap_user_templates
+from ..utils.prototypes import refresh_user_prototypes
+from ..utils.embedding_cache import embedding_cache
+from ..utils.centroid import add_face_embeddings, remove_face_embeddings, remove_face_embeddings_bulk
 from backend.app import limiter
 
 # Quality defaults (can be tuned)
 MIN_FACE_HEIGHT_PX = int(os.getenv('MIN_FACE_HEIGHT_PX', 120))
-BLUR_THRESHOLD = float(os.getenv('BLUR_THRESHOLD', 100.0))
+# Reject enrollment photos that contain more than one face
+ENROLL_REJECT_MULTI_FACE = os.getenv('ENROLL_REJECT_MULTI_FACE', '1').lower() in ('1', 'true', 'yes')
+# Upper bound on face_ids accepted by one batch-delete request
+FACE_BATCH_DELETE_MAX = int(os.getenv('FACE_BATCH_DELETE_MAX', 1000))
+# Seconds an enrollment job waits for its images to come back from the pool
+ENROLL_JOB_TIMEOUT = float(os.getenv('ENROLL_JOB_TIMEOUT', 600))
 
 face_bp = Blueprint('face', __name__)
 
@@ -28,6 +44,161 @@ def _allowed(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def _detection_error(detected, filename, min_face_px):
+    """Enrollment error message for one analyzed upload, or None if usable."""
+    if detected['error'] == 'decode_failed':
+        return f'failed to process image: failed to read saved image: {filename}'
+    if detected['error'] == 'blurry':
+        return f'image too blurry: {filename}'
+    if detected['error'] in ('too_dark', 'too_bright'):
+        return f"face {detected['error'].replace('_', ' ')}: {filename}"
+    if not detected['boxes']:
+        return f'no face detected in uploaded image: {filename}'
+    if len(detected['boxes']) > 1 and ENROLL_REJECT_MULTI_FACE:
+        return f'multiple faces detected; please provide a single-face image: {filename}'
+    if detected['heights'][0] < min_face_px:
+        return f'face bounding box too small: {filename}'
+    if not detected['encodings'] or detected['encodings'][0] is None:
+        return f'failed to compute face encoding: {filename}'
+    return None
+
+
+def _quality_score(detected):
+    quality = detected.get('quality')
+    return quality['score'] if quality else None
+
+
+def _store_faces(user, entries):
+    """Add Face rows for `(face_id, rel_path, sha256, encoding, quality score)` entries.
+
+    Updates the user's running centroid, applies the per-user template
+    cap (FACE_TEMPLATES_MAX, see utils/templates.py) and recomputes the
+    user's prototypes (utils/prototypes.py); the caller commits and
+    refreshes the gallery. Returns the new faces and the faces archived by
+    the cap (possibly including new ones).
+    """
+    created_faces = []
+    archived = []
+    for face_id, rel_path, fp, enc, score in entries:
+        try:
+            # store normalized embedding as JSON string
+            face_embedding = [float(x) for x in enc.tolist()]
+            f = Face(user_id=user.id, face_id=face_id, image_path=rel_path, meta=fp,
+                     embedding=json.dumps(face_embedding), embedding_bin=pack_embedding(face_embedding),
+                     quality=score)
+            created_faces.append(f)
+        except Exception:
+            continue
+
+    if created_faces:
+        # running sum/count update from the new embeddings only; earlier
+        # uploads are never re-read (the sum is seeded from stored embeddings once)
+        try:
+            add_face_embeddings(user, [decode_stored(f.embedding_bin) for f in created_faces], Face)
+            db.session.add(user)
+        except Exception:
+            current_app.logger.exception('failed to update centroid for user %s', user.id)
+        db.session.add_all(created_faces)
+        try:
+            archived, _ = cap_user_templates(user, Face)
+        except Exception:
+            current_app.logger.exception('failed to apply template cap for user %s', user.id)
+        try:
+            refresh_user_prototypes(user, Face)
+        except Exception:
+            current_app.logger.exception('failed to update prototypes for user %s', user.id)
+    return created_faces, archived
+
+
+def _analyze_job_files(paths, hashes, profile, min_face_px, on_result):
+    while True:
+        try:
+            return analyze_uploads(paths, profile, min_face_px, profile['blur_threshold'] or QUALITY_BLUR_THRESHOLD,
+                                   timeout=ENROLL_JOB_TIMEOUT, on_result=on_result, hashes=hashes)
+        except RecognitionUnavailable as e:
+            # the pool is full of interactive requests; they go first
+            if e.reason != 'busy':
+                raise
+            time.sleep(enroll_jobs.poll_seconds)
+
+
+def _run_enroll_job(job_id):
+    """Analyze and store the files of one claimed enrollment job."""
+    job = db.session.get(EnrollJob, job_id)
+    if job is None:
+        return
+    user = db.session.get(User, job.user_id)
+    if user is None:
+        raise RuntimeError('user no longer exists')
+    profile = get_profile(job.profile)
+    min_face_px = profile['min_face_px'] or MIN_FACE_HEIGHT_PX
+    upload_root = current_app.config['UPLOAD_FOLDER']
+    files = [dict(f) for f in job.files]
+    todo = [i for i, f in enumerate(files) if f['status'] in ('queued', 'processed')]
+
+    def on_result(k, detected):
+        # per-file progress as soon as each image comes back from the pool
+        entry = files[todo[k]]
+        entry['error'] = _detection_error(detected, entry['filename'], min_face_px)
+        entry['status'] = 'error' if entry['error'] else 'processed'
+        job.files = [dict(f) for f in files]
+        db.session.commit()
+
+    try:
+        results = _analyze_job_files([files[i]['path'] for i in todo], [files[i].get('sha256') for i in todo],
+                                     profile, min_face_px, on_result)
+    except Exception:
+        # the job fails as a whole; nothing of it was stored. A job that
+        # was re-queued meanwhile keeps its files for the new owner.
+        db.session.rollback()
+        if enroll_jobs.renew(job_id):
+            for entry in files:
+                try:
+                    os.remove(entry['path'])
+                except Exception:
+                    pass
+        raise
+
+    # the conditional UPDATE locks the job row until the faces below are
+    # committed with it, so a re-queue cannot slip in between
+    if not enroll_jobs.renew(job_id, commit=False):
+        raise LeaseLost(job_id)
+    entries = []
+    for i, detected in zip(todo, results):
+        entry = files[i]
+        if entry['status'] == 'processed':
+            entries.append((entry['face_id'], entry['image_path'], entry.get('sha256'), detected['encodings'][0],
+                            _quality_score(detected)))
+            entry['status'] = 'done'
+    _, archived = _store_faces(user, entries)
+    archived_ids = {f.face_id for f in archived}
+    for entry in files:
+        if entry['face_id'] in archived_ids:
+            entry['archived'] = True
+        if entry['status'] == 'done' and embedding_cache.note_user(entry.get('sha256'), user.id):
+            entry['shared_image'] = True
+    job.files = files
+    job.status = 'done'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    # pending files are only touched once the faces are committed: a job
+    # that fails or is re-queued before that still has all of them to retry
+    for i in todo:
+        entry = files[i]
+        try:
+            if entry['status'] == 'done':
+                os.replace(entry['path'], os.path.join(upload_root, entry['image_path']))
+            else:
+                os.remove(entry['path'])
+        except Exception:
+            current_app.logger.exception('failed to finalize upload %s of enroll job %s', entry['path'], job_id)
+    gallery.refresh_user(user.id, User, Face)
+
+
+enroll_jobs = EnrollJobRunner(EnrollJob, db, _run_enroll_job, workers=ENROLL_JOB_WORKERS,
+                              poll_seconds=ENROLL_JOB_POLL_SECONDS, lease_seconds=ENROLL_JOB_LEASE_SECONDS)
+
+
 @face_bp.route('/enroll', methods=['POST'])
 @jwt_required(optional=True)
 def enroll():
@@ -66,200 +237,173 @@ def enroll():
     if not user:
         return jsonify({'success': False, 'error': 'user not identified (send auth token or user_id)'}), 400
 
-    user_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'faces', f"user_{user.id}")
-    os.makedirs(user_folder, exist_ok=True)
+    profile_name = request.values.get('profile') or None
+    try:
+        profile = get_profile(profile_name)
+    except KeyError:
+        return jsonify({'success': False, 'error': f'unknown profile: {profile_name}'}), 400
 
-    saved_faces = []
-    encs_for_files = []
+    user_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'faces', f"user_{user.id}")
 
+    # each upload is read once (hashed on the way) and kept in memory; files
+    # are written only once they are known to be enrolled
+    uploads = []
     for file in files:
         if file.filename == '':
-            # cleanup any previously saved files for this request
-            for _, p in saved_faces:
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
             return jsonify({'success': False, 'error': 'empty filename'}), 400
         if not _allowed(file.filename):
-            for _, p in saved_faces:
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
             return jsonify({'success': False, 'error': f'invalid file type: {file.filename}'}), 400
-
-        # simple max size guard (5 MB)
-        file.seek(0, os.SEEK_END)
-        size = file.tell()
-        file.seek(0)
-        if size > 5 * 1024 * 1024:
-            for _, p in saved_faces:
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
+        try:
+            data, fp = read_upload(file.stream, max_bytes=5 * 1024 * 1024)
+        except UploadTooLarge:
             return jsonify({'success': False, 'error': f'file too large (max 5MB): {file.filename}'}), 400
 
         filename = secure_filename(file.filename)
         ext = filename.rsplit('.', 1)[1].lower()
         face_id = str(uuid.uuid4())
         saved_name = f"{face_id}.{ext}"
-        save_path = os.path.join(user_folder, saved_name)
+        uploads.append({'filename': filename, 'face_id': face_id, 'data': data, 'sha256': fp,
+                        'path': os.path.join(user_folder, saved_name),
+                        'image_path': os.path.join('faces', f"user_{user.id}", saved_name)})
 
-        try:
-            file.save(save_path)
-        except Exception as e:
-            for _, p in saved_faces:
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
-            return jsonify({'success': False, 'error': f'failed to save file: {str(e)}'}), 500
-
-        rel_path = os.path.join('faces', f"user_{user.id}", saved_name)
-        saved_faces.append((face_id, save_path, rel_path))
-
-        # compute encoding for this saved file with quality checks
-        try:
-            # read via OpenCV to perform blur check
-            img_bgr = cv2.imread(save_path)
-            img_rgb = None
-            if img_bgr is None:
-                # OpenCV failed to read the file (corrupt bytes or test double).
-                # Fall back to face_recognition.load_image_file which test suites
-                # may patch to provide a synthetic image ndarray or a dummy object.
-                try:
-                    img_rgb = face_recognition.load_image_file(save_path)
-                    # only convert to BGR if we received an ndarray-like image
-                    if hasattr(img_rgb, 'ndim'):
-                        img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
-                    else:
-                        img_bgr = None
-                except Exception:
-                    raise ValueError('failed to read saved image')
-            if img_bgr is not None and is_blurry_bgr(img_bgr, threshold=BLUR_THRESHOLD):
-                # cleanup and reject
-                try:
-                    os.remove(save_path)
-                except Exception:
-                    pass
-                return jsonify({'success': False, 'error': f'image too blurry: {filename}'}), 400
+    written = []
 
-            if img_bgr is not None:
-                rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-            elif img_rgb is not None:
-                # img_rgb may be a numpy ndarray (RGB) or a test-provided dummy object
-                rgb = img_rgb
-            else:
-                raise ValueError('failed to obtain image RGB data')
-            # Prefer calling face_encodings directly (tests often patch this).
-            encs = encode_faces(rgb, locations=None, fr=face_recognition)
-            if not encs:
-                # Fallback to explicit detection for size/quality checks
-                locations = get_face_locations(rgb, prefer_cnn=True, fr=face_recognition)
-                if not locations:
-                    try:
-                        os.remove(save_path)
-                    except Exception:
-                        pass
-                    return jsonify({'success': False, 'error': f'no face detected in uploaded image: {filename}'}), 400
-                # check face size
-                top, right, bottom, left = locations[0]
-                if (bottom - top) < MIN_FACE_HEIGHT_PX:
-                    try:
-                        os.remove(save_path)
-                    except Exception:
-                        pass
-                    return jsonify({'success': False, 'error': f'face bounding box too small: {filename}'}), 400
-                encs = encode_faces(rgb, locations, fr=face_recognition)
-                if not encs:
-                    try:
-                        os.remove(save_path)
-                    except Exception:
-                        pass
-                    return jsonify({'success': False, 'error': f'failed to compute face encoding: {filename}'}), 400
-
-            encs_for_files.append(encs[0])
-        except Exception as e:
+    def _discard_written():
+        # remove every file written by this request
+        for p in written:
             try:
-                os.remove(save_path)
+                os.remove(p)
             except Exception:
                 pass
-            for _, p, _ in saved_faces[:-1]:
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
-            return jsonify({'success': False, 'error': f'failed to process image: {str(e)}'}), 400
 
-    # At this point saved_faces and encs_for_files are populated
-    # collect encodings from all images in the user's folder for averaging
-    enc_list = []
+    if request.values.get('async', '').lower() in ('1', 'true', 'yes'):
+        # the job runner needs the bytes after this request ends: park them
+        # under a pending name, renamed into place once the image is enrolled
+        try:
+            for u in uploads:
+                pending = u['path'] + PENDING_SUFFIX
+                write_atomic(pending, u['data'])
+                written.append(pending)
+        except Exception as e:
+            _discard_written()
+            return jsonify({'success': False, 'error': f'failed to save file: {str(e)}'}), 500
+        job_id = str(uuid.uuid4())
+        job = EnrollJob(id=job_id, user_id=user.id, profile=profile_name,
+                        files=[{'filename': u['filename'], 'face_id': u['face_id'], 'path': pending,
+                                'image_path': u['image_path'], 'sha256': u['sha256'], 'status': 'queued',
+                                'error': None}
+                               for u, pending in zip(uploads, written)])
+        try:
+            db.session.add(job)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            _discard_written()
+            return jsonify({'success': False, 'error': f'failed to queue enrollment: {str(e)}'}), 500
+        enroll_jobs.start(current_app._get_current_object())
+        enroll_jobs.wake()
+        # a runner may already have claimed the job; this request queued it
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'queued',
+                        'status_url': f'/api/face/jobs/{job_id}'}), 202
+
+    # decode (from memory), blur check, detection and encoding of all
+    # uploads run together in the recognition pool; one detection pass per
+    # image feeds the face count/size checks and the encoding
+    min_face_px = profile['min_face_px'] or MIN_FACE_HEIGHT_PX
     try:
-        for fname in os.listdir(user_folder):
-            fpath = os.path.join(user_folder, fname)
-            if not _allowed(fname):
-                continue
-            try:
-                img = face_recognition.load_image_file(fpath)
-                e = face_recognition.face_encodings(img)
-                if e:
-                    enc_list.append(e[0])
-            except Exception:
-                continue
-    except Exception:
-        enc_list = encs_for_files[:]
-
-    if not enc_list:
-        enc_list = encs_for_files[:]
+        results = analyze_uploads([u['data'] for u in uploads], profile, min_face_px,
+                                  profile['blur_threshold'] or QUALITY_BLUR_THRESHOLD, hashes=[u['sha256'] for u in uploads])
+    except RecognitionUnavailable as e:
+        return jsonify({'success': False, 'error': 'recognition_unavailable', 'reason': e.reason}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'failed to process image: {str(e)}'}), 400
+
+    for u, detected in zip(uploads, results):
+        error = _detection_error(detected, u['filename'], min_face_px)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
 
     try:
-        arr = np.stack(enc_list, axis=0)
-        mean_vec = np.mean(arr, axis=0)
-        mean_norm = normalize_vec(mean_vec)
-        mean_list = mean_norm.tolist()
-    except Exception:
-        mean_list = None
-
+        for u in uploads:
+            write_atomic(u['path'], u['data'])
+            written.append(u['path'])
+    except Exception as e:
+        _discard_written()
+        return jsonify({'success': False, 'error': f'failed to save file: {str(e)}'}), 500
+
+    created_faces, archived = _store_faces(user, [(u['face_id'], u['image_path'], u['sha256'], detected['encodings'][0],
+                                         _quality_score(detected))
+                                        for u, detected in zip(uploads, results)])
     try:
-        if mean_list is not None:
-            # store normalized centroid as JSON string
-            user.encoding = json.dumps([float(x) for x in mean_list])
-            db.session.add(user)
+        db.session.commit()
     except Exception:
-        pass
-
-    created_faces = []
-    for (face_id, save_path, rel_path), enc in zip(saved_faces, encs_for_files):
-        try:
-            fp = None
-            try:
-                with open(save_path, 'rb') as fh:
-                    data = fh.read()
-                    fp = hashlib.sha256(data).hexdigest()
-            except Exception:
-                fp = None
-            # store normalized embedding as JSON string
-            face_embedding = [float(x) for x in enc.tolist()]
-            f = Face(user_id=user.id, face_id=face_id, image_path=rel_path, meta=fp, embedding=json.dumps(face_embedding))
-            created_faces.append(f)
-        except Exception:
-            continue
-
-    if created_faces:
-        db.session.add_all(created_faces)
-    db.session.commit()
+        db.session.rollback()
+        _discard_written()
+        raise
+    gallery.refresh_user(user.id, User, Face)
+    # the same image already enrolled or marked for someone else
+    shared_ids = [f.face_id for f in created_faces if embedding_cache.note_user(f.meta, user.id)]
 
     # Return per-file result(s). If single upload, return single object for convenience.
+    archived_ids = [f.face_id for f in archived]
     if len(created_faces) == 1:
         f = created_faces[0]
-        return jsonify({'success': True, 'face_id': f.face_id, 'image_path': f"/uploads/{f.image_path}"})
+        return jsonify({'success': True, 'face_id': f.face_id, 'image_path': f"/uploads/{f.image_path}",
+                        'archived': archived_ids, 'shared_images': shared_ids})
     else:
         faces_out = [{'face_id': f.face_id, 'image_path': f"/uploads/{f.image_path}"} for f in created_faces]
-        return jsonify({'success': True, 'faces': faces_out})
+        return jsonify({'success': True, 'faces': faces_out, 'archived': archived_ids, 'shared_images': shared_ids})
+
 
 
+@face_bp.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required(optional=True)
+def enroll_job_status(job_id):
+    # Progress of an async enrollment: owner or admin; tooling without a
+    # token passes the same user_id it enrolled with
+    job = db.session.get(EnrollJob, job_id)
+    if not job:
+        return jsonify({'error': 'not found'}), 404
+
+    uid = get_jwt_identity()
+    if uid:
+        try:
+            caller = db.session.get(User, int(uid))
+        except Exception:
+            caller = db.session.get(User, uid)
+        is_owner = caller and caller.id == job.user_id
+        is_admin = caller and (hasattr(caller.role, 'value') and caller.role.value == 'admin')
+        allowed = is_owner or is_admin
+    else:
+        allowed = str(request.args.get('user_id')) == str(job.user_id)
+    if not allowed:
+        return jsonify({'error': 'permission denied'}), 403
+
+    # a job enqueued by another worker process is still picked up if that
+    # process went away
+    enroll_jobs.start(current_app._get_current_object())
+
+    files = [{'filename': f['filename'], 'status': f['status'], 'error': f['error'],
+              'face_id': f['face_id'] if f['status'] == 'done' else None,
+              'image_path': f"/uploads/{f['image_path']}" if f['status'] == 'done' else None}
+             for f in job.files]
+    counts = {s: sum(1 for f in files if f['status'] == s) for s in ('done', 'error')}
+    return jsonify({
+        'job_id': job.id,
+        'user_id': job.user_id,
+        'status': job.status,
+        'profile': job.profile,
+        'error': job.error,
+        'total': len(files),
+        'processed': sum(1 for f in files if f['status'] != 'queued'),
+        'succeeded': counts['done'],
+        'failed': counts['error'],
+        'files': files,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    })
+
 
 @face_bp.route('', methods=['GET'])
 @jwt_required(optional=True)
@@ -287,7 +431,8 @@ def list_faces():
     faces = Face.query.filter_by(user_id=user.id).all()
     out = []
     for f in faces:
-        out.append({'face_id': f.face_id, 'image_path': f"/uploads/{f.image_path}"})
+        out.append({'face_id': f.face_id, 'image_path': f"/uploads/{f.image_path}", 'quality': f.quality,
+                    'archived': f.archived_at is not None})
     return jsonify({'faces': out})
 
 
@@ -320,9 +465,26 @@ def delete_face(face_id):
         pass
 
     user_id = f.user_id
-    # delete DB row
+    # take the face out of the user's running sum and delete the row in one commit
     try:
+        try:
+            user = db.session.get(User, int(user_id))
+        except Exception:
+            user = db.session.get(User, user_id)
+        # archived faces are not part of the running sum
+        if user and f.archived_at is None:
+            try:
+                raw = f.embedding_bin if f.embedding_bin is not None else f.embedding
+                remove_face_embeddings(user, [decode_stored(raw) if raw is not None else None], Face)
+                db.session.add(user)
+            except Exception:
+                current_app.logger.exception('failed to update centroid for user %s', user_id)
         db.session.delete(f)
+        if user and f.archived_at is None:
+            try:
+                refresh_user_prototypes(user, Face)
+            except Exception:
+                current_app.logger.exception('failed to update prototypes for user %s', user_id)
         db.session.commit()
     except Exception:
         try:
@@ -331,37 +493,87 @@ def delete_face(face_id):
             pass
         return jsonify({'error': 'failed to delete'}), 500
 
-    # Recompute averaged user encoding from remaining faces
+    gallery.refresh_user(user_id, User, Face)
+
+    return jsonify({'deleted': True})
+
+
+@face_bp.route('/batch-delete', methods=['POST'])
+@jwt_required()
+def batch_delete_faces():
+    # Delete many faces in one transaction; each affected user's centroid is
+    # updated once and the gallery is refreshed in a single step
+    uid = get_jwt_identity()
     try:
-        remaining = Face.query.filter_by(user_id=user_id).all()
-        enc_list = []
-        for r in remaining:
-            try:
-                e = r.embedding
-                if isinstance(e, str):
-                    e = json.loads(e)
-                if e and len(e) == 128:
-                    enc_list.append(np.array(e))
-            except Exception:
-                continue
-        if enc_list:
-            arr = np.stack(enc_list, axis=0)
-            mean_vec = np.mean(arr, axis=0)
-            mean_list = [float(x) for x in mean_vec.tolist()]
-        else:
-            mean_list = None
-        try:
-            user = db.session.get(User, int(user_id))
-        except Exception:
-            user = db.session.get(User, user_id)
-        if user:
-            user.encoding = mean_list
-            db.session.add(user)
-            db.session.commit()
+        caller = db.session.get(User, int(uid))
+    except Exception:
+        caller = db.session.get(User, uid)
+
+    body = request.get_json(silent=True) or {}
+    face_ids = body.get('face_ids')
+    if not isinstance(face_ids, list) or not face_ids or not all(isinstance(x, str) for x in face_ids):
+        return jsonify({'error': 'face_ids must be a non-empty list of strings'}), 400
+    if len(face_ids) > FACE_BATCH_DELETE_MAX:
+        return jsonify({'error': f'at most {FACE_BATCH_DELETE_MAX} face_ids per request'}), 400
+    face_ids = list(dict.fromkeys(face_ids))
+
+    faces = Face.query.filter(Face.face_id.in_(face_ids)).all()
+    found = {f.face_id for f in faces}
+    not_found = [fid for fid in face_ids if fid not in found]
+
+    # owner of every face, or admin
+    is_admin = caller and (hasattr(caller.role, 'value') and caller.role.value == 'admin')
+    if not is_admin and (not caller or any(f.user_id != caller.id for f in faces)):
+        return jsonify({'error': 'permission denied'}), 403
+
+    user_ids = sorted({f.user_id for f in faces})
+    try:
+        users = {u.id: u for u in User.query.filter(User.id.in_(user_ids))} if user_ids else {}
+        rows = []
+        for f in faces:
+            raw = f.embedding_bin if f.embedding_bin is not None else f.embedding
+            if raw is not None and f.archived_at is None:
+                rows.append((f.user_id, decode_stored(raw)))
+        if rows:
+            remove_face_embeddings_bulk(users, [r[0] for r in rows], np.stack([r[1] for r in rows]), Face)
+        for f in faces:
+            db.session.delete(f)
+        for user_id in {r[0] for r in rows}:
+            if user_id in users:
+                refresh_user_prototypes(users[user_id], Face)
+        db.session.commit()
     except Exception:
+        current_app.logger.exception('batch face delete failed')
         try:
             db.session.rollback()
         except Exception:
             pass
+        return jsonify({'error': 'failed to delete'}), 500
 
-    return jsonify({'deleted': True})
+    # files go only after the rows are gone, so a failed commit leaves both intact
+    for f in faces:
+        try:
+            path = os.path.join(current_app.config['UPLOAD_FOLDER'], f.image_path)
+            if f.image_path and os.path.exists(path):
+                os.remove(path)
+        except Exception:
+            pass
+    if user_ids:
+        gallery.refresh_users(user_ids, User, Face)
+
+    return jsonify({'deleted': sorted(found), 'not_found': not_found})
+
+
+@face_bp.route('/gallery', methods=['GET'])
+def gallery_stats():
+    # Build time and size of this process's in-memory gallery cache
+    return jsonify({'gallery': gallery.stats()})
+
+
+@face_bp.route('/pipeline', methods=['GET'])
+def pipeline_stats_view():
+    # Detector invocations of this process versus the old detect/encode
+    # sequence, the recognition pool's size and queue depth, and encode batching
+    return jsonify({'pipeline': pipeline_stats(), 'pool': recognition_pool.stats(),
+                    'encode_batch': encode_batcher.stats() if encode_batcher is not None else None,
+                    'embedding_cache': embedding_cache.stats()})
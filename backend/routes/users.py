@@ -1,9 +1,10 @@
 from flask import Blueprint, request, jsonify, abort
 from backend.extensions import db
-from backend.models import User, RoleEnum
+from backend.models import User, Face, RoleEnum
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask import current_app
 from backend.utils import admin_required
+from backend.utils.gallery import gallery
 
 users_bp = Blueprint('users', __name__)
 
@@ -16,6 +17,7 @@ def _serialize_user(u: User):
         'email': u.email,
         'role': u.role.value if hasattr(u.role, 'value') else str(u.role),
         'department': u.department,
+        'site': u.site,
         'avatar': u.avatar,
         'status': u.status,
         'joinDate': u.join_date.isoformat() if u.join_date else None,
@@ -86,10 +88,13 @@ def update_user(id):
     if not u:
         return jsonify({'error': 'not found'}), 404
     data = request.get_json() or {}
-    for k in ('name', 'department', 'avatar', 'status', 'address', 'phone'):
+    for k in ('name', 'department', 'site', 'avatar', 'status', 'address', 'phone'):
         if k in data:
             setattr(u, k if k != 'phone' else 'phone', data[k])
     db.session.commit()
+    if 'department' in data or 'site' in data:
+        # keep the scoped gallery partitions in step with the new department/site
+        gallery.refresh_user(u.id, User, Face)
     return jsonify(_serialize_user(u))
 
 
@@ -109,4 +114,5 @@ def delete_user(id):
         return jsonify({'error': 'not found'}), 404
     db.session.delete(u)
     db.session.commit()
+    gallery.remove_user(id)
     return jsonify({}), 204
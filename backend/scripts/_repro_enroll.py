@@ -19,8 +19,8 @@ token = data['token']
 img = io.BytesIO(b'fake-image-bytes')
 data = {'image': (img, 'test.png')}
 headers = {'Authorization': f"Bearer {token}"}
-with patch('backend.routes.face.face_recognition.load_image_file', return_value=b'fake'), \
-     patch('backend.routes.face.face_recognition.face_encodings', return_value=[np.zeros(128)]):
+with patch('backend.utils.face_utils.face_recognition.load_image_file', return_value=b'fake'), \
+     patch('backend.utils.face_utils.face_recognition.face_encodings', return_value=[np.zeros(128)]):
     res2 = client.post('/api/face/enroll', data=data, headers=headers, content_type='multipart/form-data')
     print('enroll status', res2.status_code)
     try:
@@ -3,6 +3,8 @@ import json
 import io
 
 os.environ['USE_SQLITE'] = '1'
+# the face_recognition patches below only apply to recognition run in this process
+os.environ['RECOGNITION_POOL_SIZE'] = '0'
 
 from backend.app import create_app
 from unittest.mock import patch
@@ -33,10 +35,11 @@ def test_enroll_and_mark():
     }
     headers = {'Authorization': f'Bearer {token}'}
     # mock face_recognition.face_encodings to avoid real image decoding in tests
-    # patch the symbol used by the route implementation
-    # patch both load_image_file and face_encodings used in the route to avoid real image IO
-    with patch('backend.routes.face.face_recognition.load_image_file', return_value=b'fake'), \
-         patch('backend.routes.face.face_recognition.face_encodings', return_value=[np.zeros(128)]):
+    # patch the module used by the recognition pipeline (face_utils)
+    # patch load_image_file, face_locations and face_encodings used in the route to avoid real image IO
+    with patch('backend.utils.face_utils.face_recognition.load_image_file', return_value=b'fake'), \
+         patch('backend.utils.face_utils.face_recognition.face_locations', return_value=[(0, 200, 200, 0)]), \
+         patch('backend.utils.face_utils.face_recognition.face_encodings', return_value=[np.zeros(128)]):
         res2 = client.post('/api/face/enroll', data=data, headers=headers, content_type='multipart/form-data')
     assert res2.status_code == 200
     j = res2.get_json()
@@ -0,0 +1,203 @@
+"""Approximate nearest-neighbour index for very large galleries.
+
+`IVFIndex` is an inverted-file index over L2-normalized vectors, written in
+plain NumPy (no external service). A spherical k-means coarse quantizer
+splits the gallery into `n_lists` cells; a query only scans the vectors of
+its `n_probe` closest cells and returns the top-k candidates. The caller
+(`MatchEngine`) re-ranks those candidates exactly, so the USER_TOL /
+USER_MARGIN / FACE_TOL rule is applied to exact distances.
+
+Vectors can be added and removed incrementally after training; new vectors
+go to their nearest existing cell. Retrain (rebuild the gallery) once the
+gallery has grown well past the size it was trained on, see `needs_retrain`.
+"""
+import time
+
+import numpy as np
+
+
+class _PostingList:
+    """Growable float32 matrix of vectors for one IVF cell."""
+
+    def __init__(self, dim):
+        self.keys = []
+        self.vecs = np.zeros((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, vec):
+        n = len(self.keys)
+        if n == self.vecs.shape[0]:
+            grown = np.zeros((max(16, 2 * n), self.vecs.shape[1]), dtype=np.float32)
+            grown[:n] = self.vecs[:n]
+            self.vecs = grown
+        self.vecs[n] = vec
+        self.keys.append(key)
+        return n
+
+    def remove_at(self, pos):
+        """Remove the entry at `pos` by moving the last entry into it.
+
+        Returns the key that moved into `pos` (or None if `pos` was last).
+        """
+        last = len(self.keys) - 1
+        moved = None
+        if pos != last:
+            self.vecs[pos] = self.vecs[last]
+            self.keys[pos] = self.keys[last]
+            moved = self.keys[pos]
+        self.keys.pop()
+        return moved
+
+
+class IVFIndex:
+    """Inverted-file index with a spherical k-means coarse quantizer."""
+
+    def __init__(self, n_lists=None, n_probe=8, kmeans_iters=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.kmeans_iters = kmeans_iters
+        self.seed = seed
+        self.dim = None
+        self.quantizer = None
+        self.trained_size = 0
+        self.train_seconds = None
+        self._lists = []
+        self._where = {}
+
+    @property
+    def is_trained(self):
+        return self.quantizer is not None
+
+    def __len__(self):
+        return len(self._where)
+
+    @property
+    def needs_retrain(self):
+        return self.is_trained and len(self) > 4 * max(self.trained_size, 1)
+
+    def _assign(self, X, chunk=8192):
+        out = np.empty(X.shape[0], dtype=np.int64)
+        for i in range(0, X.shape[0], chunk):
+            out[i:i + chunk] = np.argmax(X[i:i + chunk] @ self.quantizer.T, axis=1)
+        return out
+
+    def train(self, keys, X):
+        """Fit the coarse quantizer on `X` (N x D, normalized) and index all rows."""
+        start = time.time()
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n, self.dim = X.shape
+        k = self.n_lists or max(1, int(4 * np.sqrt(n)))
+        k = min(k, n)
+        rng = np.random.default_rng(self.seed)
+        self.quantizer = X[rng.choice(n, size=k, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            assign = self._assign(X)
+            sums = np.zeros((k, self.dim), dtype=np.float32)
+            np.add.at(sums, assign, X)
+            counts = np.bincount(assign, minlength=k)
+            empty = counts == 0
+            if empty.any():
+                # re-seed empty cells with random points
+                sums[empty] = X[rng.choice(n, size=int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            np.divide(sums, norms, out=sums, where=norms > 0)
+            self.quantizer = sums
+
+        self._lists = [_PostingList(self.dim) for _ in range(k)]
+        self._where = {}
+        for key, cell, vec in zip(keys, self._assign(X), X):
+            self._where[key] = (int(cell), self._lists[cell].add(key, vec))
+        self.trained_size = n
+        self.train_seconds = time.time() - start
+
+    def add(self, key, vec):
+        """Add or replace `key`. Ignored until the index has been trained."""
+        if not self.is_trained:
+            return
+        self.remove(key)
+        vec = np.asarray(vec, dtype=np.float32)
+        cell = int(np.argmax(self.quantizer @ vec))
+        self._where[key] = (cell, self._lists[cell].add(key, vec))
+
+    def remove(self, key):
+        loc = self._where.pop(key, None)
+        if loc is None:
+            return False
+        cell, pos = loc
+        moved = self._lists[cell].remove_at(pos)
+        if moved is not None:
+            self._where[moved] = (cell, pos)
+        return True
+
+    def search(self, q, k=10, n_probe=None):
+        """Return up to `k` candidate keys closest to normalized query `q`."""
+        if not self.is_trained or not self._where:
+            return []
+        n_probe = min(n_probe or self.n_probe, len(self._lists))
+        scores = self.quantizer @ q
+        if n_probe < len(self._lists):
+            cells = np.argpartition(-scores, n_probe - 1)[:n_probe]
+        else:
+            cells = np.arange(len(self._lists))
+        keys = []
+        mats = []
+        for c in cells:
+            plist = self._lists[c]
+            if len(plist):
+                keys.extend(plist.keys)
+                mats.append(plist.vecs[:len(plist)])
+        if not keys:
+            return []
+        sims = np.concatenate(mats) @ q
+        if len(keys) > k:
+            top = np.argpartition(-sims, k - 1)[:k]
+        else:
+            top = np.arange(len(keys))
+        top = top[np.argsort(-sims[top], kind='stable')]
+        return [keys[i] for i in top]
+
+    def stats(self):
+        sizes = [len(p) for p in self._lists]
+        return {
+            'type': 'ivf',
+            'trained': self.is_trained,
+            'trained_size': self.trained_size,
+            'train_seconds': self.train_seconds,
+            'size': len(self),
+            'n_lists': len(self._lists),
+            'n_probe': self.n_probe,
+            'max_list': max(sizes) if sizes else 0,
+            'needs_retrain': self.needs_retrain,
+        }
+
+
+def recall_report(engine, queries, k=10, USER_TOL=0.45, USER_MARGIN=0.15, FACE_TOL=0.55):
+    """Compare ANN-backed decisions of `engine` with exact search on `queries`.
+
+    Returns recall@1 and top-2 recall of the candidate set, decision
+    agreement and mean per-query latency of both paths.
+    """
+    exact_t = ann_t = 0.0
+    hit1 = hit2 = agree = 0
+    for q in queries:
+        t0 = time.perf_counter()
+        ex_acc, ex_dbg = engine.decide(q, USER_TOL, USER_MARGIN, FACE_TOL, exact=True)
+        t1 = time.perf_counter()
+        an_acc, an_dbg = engine.decide(q, USER_TOL, USER_MARGIN, FACE_TOL)
+        t2 = time.perf_counter()
+        exact_t += t1 - t0
+        ann_t += t2 - t1
+        hit1 += an_dbg['best_uid'] == ex_dbg['best_uid']
+        hit2 += (an_dbg['best_uid'] == ex_dbg['best_uid']) and (an_dbg['runner_up_d'] == ex_dbg['runner_up_d'])
+        agree += an_acc == ex_acc
+    n = max(len(queries), 1)
+    return {
+        'queries': len(queries),
+        'recall_at_1': hit1 / n,
+        'top2_recall': hit2 / n,
+        'decision_agreement': agree / n,
+        'exact_ms': 1000 * exact_t / n,
+        'ann_ms': 1000 * ann_t / n,
+    }
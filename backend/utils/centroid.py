@@ -0,0 +1,153 @@
+"""Incremental maintenance of per-user centroids.
+
+Each user keeps the running sum (`users.encoding_sum`, float32 blob in the
+`embedding.py` format) and count (`users.encoding_count`) of the stored
+active (not archived, see templates.py) `Face` embeddings next to the normalized centroid in `users.encoding` /
+`users.encoding_bin`. Adding or deleting a face adjusts sum and count and
+rewrites the centroid, so enrollment never re-reads or re-encodes images.
+
+Users enrolled before the sum columns existed get their sum from the
+stored embeddings on the first update; `rebuild_centroids` (CLI:
+`flask --app manage gallery rebuild-centroids`) recomputes everything in
+bulk from `faces.embedding_bin` / `faces.embedding`.
+"""
+import json
+import logging
+
+import numpy as np
+
+from .embedding import decode_stored, pack_embedding, unpack_embedding
+
+logger = logging.getLogger(__name__)
+
+
+def _stored_vec(emb, emb_bin):
+    raw = emb_bin if emb_bin is not None else emb
+    return decode_stored(raw) if raw is not None else None
+
+
+def _set_centroid(user, total, count):
+    # centroid = normalized mean; an empty profile clears all four columns
+    if count <= 0 or total is None:
+        user.encoding_sum = None
+        user.encoding_count = 0
+        user.encoding = None
+        user.encoding_bin = None
+        return
+    user.encoding_sum = pack_embedding(total)
+    user.encoding_count = int(count)
+    mean = np.asarray(total, dtype=np.float64) / count
+    norm = np.linalg.norm(mean)
+    centroid = (mean / norm if norm > 0 else mean).astype(np.float32)
+    user.encoding = json.dumps([float(x) for x in centroid])
+    user.encoding_bin = pack_embedding(centroid)
+
+
+def _stored_sum(user, FaceModel):
+    """(sum, count) of the user's active (not archived) face embeddings, from the DB."""
+    q = FaceModel.query.with_entities(FaceModel.embedding, FaceModel.embedding_bin).filter_by(user_id=user.id)
+    q = q.filter(FaceModel.archived_at.is_(None))
+    total, count = None, 0
+    for emb, emb_bin in q:
+        vec = _stored_vec(emb, emb_bin)
+        if vec is None or not vec.size:
+            continue
+        total = vec.astype(np.float64) if total is None else total + vec
+        count += 1
+    return total, count
+
+
+def _current_sum(user, FaceModel):
+    if user.encoding_sum is not None:
+        return unpack_embedding(user.encoding_sum).astype(np.float64), int(user.encoding_count or 0)
+    # not maintained yet (enrolled before the sum columns): seed from stored embeddings
+    return _stored_sum(user, FaceModel)
+
+
+def add_face_embeddings(user, vecs, FaceModel):
+    """Add embeddings of new faces (not yet flushed) to the user's centroid."""
+    vecs = [np.asarray(v, dtype=np.float64) for v in vecs]
+    if not vecs:
+        return
+    total, count = _current_sum(user, FaceModel)
+    added = np.sum(vecs, axis=0)
+    _set_centroid(user, added if total is None else total + added, count + len(vecs))
+
+
+def remove_face_embeddings(user, vecs, FaceModel):
+    """Remove embeddings of faces being deleted (still in the DB) from the user's centroid."""
+    vecs = [np.asarray(v, dtype=np.float64) for v in vecs if v is not None]
+    if not vecs:
+        return
+    total, count = _current_sum(user, FaceModel)
+    if total is None:
+        return
+    _set_centroid(user, total - np.sum(vecs, axis=0), count - len(vecs))
+
+
+def remove_face_embeddings_bulk(users, face_user_ids, vecs, FaceModel):
+    """Remove many faces (still in the DB) from their users' centroids at once.
+
+    `users` maps user id -> User, `face_user_ids[i]` owns row `vecs[i]`.
+    Per-user sums of the removed rows come from one `np.add.reduceat`
+    over the rows sorted by user; each user's centroid is rewritten once.
+    """
+    face_user_ids = np.asarray(face_user_ids)
+    if not face_user_ids.size:
+        return
+    mat = np.asarray(vecs, dtype=np.float64)
+    order = np.argsort(face_user_ids, kind='stable')
+    sorted_ids = face_user_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    removed = np.add.reduceat(mat[order], starts, axis=0)
+    counts = np.diff(np.r_[starts, sorted_ids.size])
+    for uid, dsum, n in zip(sorted_ids[starts].tolist(), removed, counts.tolist()):
+        user = users.get(uid)
+        if user is None:
+            continue
+        total, count = _current_sum(user, FaceModel)
+        if total is not None:
+            _set_centroid(user, total - dsum, count - n)
+
+
+def rebuild_centroids(UserModel, FaceModel, session, batch_size=1000, user_ids=None):
+    """Recompute sum, count and centroid of every user (or `user_ids`) from stored embeddings.
+
+    Faces are streamed once, ordered by user, and users are updated and
+    committed in batches. Users without any stored embedding are left as they
+    are. Returns `{'users': n_updated, 'skipped': n_skipped, 'faces': n_faces}`.
+    """
+    q = FaceModel.query.with_entities(FaceModel.user_id, FaceModel.embedding, FaceModel.embedding_bin)
+    q = q.filter(FaceModel.archived_at.is_(None))
+    if user_ids is not None:
+        q = q.filter(FaceModel.user_id.in_(list(user_ids)))
+    sums = {}
+    n_faces = 0
+    for fuid, emb, emb_bin in q.order_by(FaceModel.user_id, FaceModel.id).yield_per(batch_size):
+        try:
+            vec = _stored_vec(emb, emb_bin)
+        except Exception:
+            logger.exception("bad face embedding for user %s", fuid)
+            continue
+        if vec is None or not vec.size:
+            continue
+        total, count = sums.get(fuid, (None, 0))
+        sums[fuid] = (vec.astype(np.float64) if total is None else total + vec, count + 1)
+        n_faces += 1
+
+    users = UserModel.query
+    if user_ids is not None:
+        users = users.filter(UserModel.id.in_(list(user_ids)))
+    ids = [uid for (uid,) in users.with_entities(UserModel.id).order_by(UserModel.id)]
+    updated = skipped = 0
+    for i in range(0, len(ids), batch_size):
+        chunk = ids[i:i + batch_size]
+        for user in UserModel.query.filter(UserModel.id.in_(chunk)):
+            if user.id not in sums:
+                # no stored embeddings to rebuild from; leave any legacy centroid alone
+                skipped += 1
+                continue
+            _set_centroid(user, *sums[user.id])
+            updated += 1
+        session.commit()
+    return {'users': updated, 'skipped': skipped, 'faces': n_faces}
@@ -0,0 +1,47 @@
+"""Compact binary encoding for stored face embeddings.
+
+`faces.embedding_bin` and `users.encoding_bin` hold one format byte
+followed by the raw little-endian float32 vector (513 bytes for a 128-d
+embedding, versus ~2.5 KB of JSON text). Decoding is a zero-copy
+`np.frombuffer` view. The JSON columns are still written alongside during
+the transition so the binary columns can be dropped again on rollback.
+"""
+import json
+
+import numpy as np
+
+# format byte values
+EMBEDDING_F32_V1 = 1
+
+_DTYPES = {EMBEDDING_F32_V1: np.dtype('<f4')}
+
+
+def pack_embedding(vec):
+    """Return the binary column value for `vec` (None stays None)."""
+    if vec is None:
+        return None
+    a = np.asarray(vec, dtype=_DTYPES[EMBEDDING_F32_V1]).ravel()
+    return bytes([EMBEDDING_F32_V1]) + a.tobytes()
+
+
+def unpack_embedding(buf):
+    """Decode a binary column value into a read-only float32 view."""
+    buf = memoryview(buf)
+    dtype = _DTYPES.get(buf[0]) if len(buf) else None
+    if dtype is None:
+        raise ValueError('unknown embedding format byte %r' % (buf[0] if len(buf) else None))
+    if (len(buf) - 1) % dtype.itemsize:
+        raise ValueError('embedding payload of %d bytes is not a whole number of floats' % (len(buf) - 1))
+    return np.frombuffer(buf, dtype=dtype, offset=1)
+
+
+def decode_stored(raw):
+    """Decode any stored embedding representation into a float32 array.
+
+    Accepts the binary format (bytes), a JSON string or a native JSON list.
+    """
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        return unpack_embedding(raw)
+    if isinstance(raw, str):
+        return np.array(json.loads(raw), dtype=np.float32)
+    return np.array(raw, dtype=np.float32)
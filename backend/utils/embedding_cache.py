@@ -0,0 +1,209 @@
+"""Content-addressed cache of `analyze_image` results.
+
+Re-uploads, retried requests and the same photo sent to mark twice used
+to pay the full decode, detect and encode cost every time. Results are
+keyed by the sha256 of the upload bytes plus a variant string covering
+everything else that shapes them (recognition profile, minimum face
+height, blur threshold), so `analyze_uploads` can answer repeats without
+touching the recognition pool.
+
+Entries live in an in-process LRU of EMBEDDING_CACHE_SIZE image hashes
+(0 disables the cache). With EMBEDDING_CACHE_DIR set they are also
+written there as one JSON file per hash (`<dir>/<sha[:2]>/<sha>.json`),
+shared by the workers of one host and kept across restarts; clear the
+directory after changing the deployment detection defaults
+(FACE_DETECT_*), which the variant does not include.
+
+Each entry also remembers the users the image was enrolled under or
+marked as. `note_user` returns the other users of a hash, so the routes
+can flag one photo showing up for two different people.
+"""
+import os
+import copy
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .upload import write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Image hashes kept in memory (0 = cache off)
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 1024))
+# Directory for the persistent copy ('' = memory only)
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', '')
+
+# per-request values that are not part of a reusable result
+_TRANSIENT_KEYS = ('timings', 'chips', 'cache', 'sha256')
+
+
+def result_variant(profile, min_face_px, blur_threshold):
+    """Cache variant of an `analyze_image` call: the inputs besides the image bytes."""
+    key = json.dumps({'profile': profile, 'min_face_px': min_face_px, 'blur_threshold': blur_threshold},
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def cacheable(result):
+    """Whether `result` is a complete answer for its image (not a failed encode)."""
+    if result.get('error') is not None or not result.get('boxes'):
+        return True
+    encs = result.get('encodings') or ()
+    return len(encs) == len(result['boxes']) and all(e is not None for e in encs)
+
+
+def _plain(value):
+    # numpy scalars in boxes, heights and counters
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _to_json(result):
+    out = {k: v for k, v in result.items() if k not in _TRANSIENT_KEYS}
+    out['encodings'] = [np.asarray(e, dtype=np.float64).tolist() for e in result.get('encodings', ())]
+    return out
+
+
+def _from_json(result):
+    result = dict(result)
+    result['boxes'] = [tuple(b) for b in result.get('boxes', ())]
+    result['encodings'] = [np.asarray(e, dtype=np.float64) for e in result.get('encodings', ())]
+    return result
+
+
+class EmbeddingCache:
+    """LRU of `{'results': {variant: result}, 'users': set}` entries keyed by sha256."""
+
+    def __init__(self, max_entries=1024, cache_dir=''):
+        self.max_entries = max(int(max_entries), 0)
+        self.cache_dir = cache_dir or None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0,
+                       'disk_errors': 0, 'cross_user': 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _path(self, sha):
+        return os.path.join(self.cache_dir, sha[:2], sha + '.json')
+
+    def _load(self, sha):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(sha), 'r', encoding='utf-8') as fh:
+                raw = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception("unreadable embedding cache file for %s", sha)
+            self._stats['disk_errors'] += 1
+            return None
+        return {'results': {v: _from_json(r) for v, r in raw.get('results', {}).items()},
+                'users': set(raw.get('users', ()))}
+
+    def _merge_disk(self, sha, entry):
+        # other workers sharing the directory may have written since this copy was loaded
+        on_disk = self._load(sha)
+        if on_disk is not None:
+            entry['users'] |= on_disk['users']
+            for variant, result in on_disk['results'].items():
+                entry['results'].setdefault(variant, result)
+
+    def _save(self, sha, entry):
+        if self.cache_dir is None:
+            return
+        raw = {'results': {v: _to_json(r) for v, r in entry['results'].items()},
+               'users': sorted(entry['users'])}
+        try:
+            path = self._path(sha)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, json.dumps(raw, default=_plain).encode('utf-8'))
+        except Exception:
+            logger.exception("failed to persist embedding cache entry %s", sha)
+            self._stats['disk_errors'] += 1
+
+    def _entry(self, sha, create=False):
+        # caller holds the lock
+        entry = self._entries.get(sha)
+        if entry is not None:
+            self._entries.move_to_end(sha)
+            return entry, False
+        entry = self._load(sha)
+        from_disk = entry is not None
+        if entry is None:
+            if not create:
+                return None, False
+            entry = {'results': {}, 'users': set()}
+        self._entries[sha] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+        return entry, from_disk
+
+    def get(self, sha, variant):
+        """Copy of the cached result of `sha` for `variant`, or None."""
+        if not self.enabled or not sha:
+            return None
+        with self._lock:
+            entry, from_disk = self._entry(sha)
+            result = entry['results'].get(variant) if entry is not None else None
+            if result is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits' if from_disk else 'hits'] += 1
+            return copy.deepcopy(result)
+
+    def put(self, sha, variant, result):
+        """Store `result` (an `analyze_image` result) for `sha` and `variant`."""
+        if not self.enabled or not sha or not cacheable(result):
+            return
+        stored = copy.deepcopy({k: v for k, v in result.items() if k not in _TRANSIENT_KEYS})
+        with self._lock:
+            entry, from_disk = self._entry(sha, create=True)
+            if not from_disk:
+                self._merge_disk(sha, entry)
+            entry['results'][variant] = stored
+            self._stats['stores'] += 1
+            self._save(sha, entry)
+
+    def note_user(self, sha, user_id):
+        """Record that image `sha` belongs to `user_id`; return the other users seen with it."""
+        if not self.enabled or not sha or user_id is None:
+            return set()
+        with self._lock:
+            entry, from_disk = self._entry(sha, create=True)
+            if not from_disk:
+                self._merge_disk(sha, entry)
+            others = entry['users'] - {user_id}
+            if user_id not in entry['users']:
+                entry['users'].add(user_id)
+                self._save(sha, entry)
+            if others:
+                self._stats['cross_user'] += 1
+        if others:
+            logger.warning("image %s seen for user %s and also for users %s", sha, user_id, sorted(others))
+        return others
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out['entries'] = len(self._entries)
+        out['max_entries'] = self.max_entries
+        out['persistent'] = self.cache_dir is not None
+        return out
+
+
+# one cache per web process, shared by enroll and mark
+embedding_cache = EmbeddingCache(max_entries=EMBEDDING_CACHE_SIZE, cache_dir=EMBEDDING_CACHE_DIR)
@@ -0,0 +1,157 @@
+"""Micro-batching of face encodings across concurrent requests.
+
+dlib's face encoder accepts a list of aligned 150x150 face chips and runs
+them through the network together, which on CUDA (and BLAS-backed CPU)
+builds is cheaper per face than one call per image. When many
+`/api/attendance/mark` calls arrive at once (shift changes), requests
+hand their chips to `EncodeBatcher.encode` and block; a dispatcher thread
+collects chips for up to ENCODE_BATCH_WAIT_MS after the oldest one
+arrived, or until ENCODE_BATCH_MAX chips are waiting, encodes them in one
+call and hands each request its own descriptors.
+
+ENCODE_BATCH_MAX=1 (the default) disables batching: faces are encoded
+inside the per-image recognition job as before. Measure the throughput
+gain and added tail latency of a setting on the target hardware with
+`tools/batch_benchmark.py` before enabling it.
+"""
+import os
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Largest number of face chips encoded in one call (1 = no batching)
+ENCODE_BATCH_MAX = int(os.getenv('ENCODE_BATCH_MAX', 1))
+# How long the oldest waiting chip may wait for others to join its batch
+ENCODE_BATCH_WAIT_MS = float(os.getenv('ENCODE_BATCH_WAIT_MS', 5.0))
+
+
+class _Job:
+    __slots__ = ('chips', 'num_jitters', 'enqueued', 'done', 'result', 'error')
+
+    def __init__(self, chips, num_jitters):
+        self.chips = list(chips)
+        self.num_jitters = num_jitters
+        self.enqueued = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EncodeBatcher:
+    """Collects face chips from concurrent callers and encodes them in batches.
+
+    `runner(chips, num_jitters)` encodes a list of chips and returns one
+    descriptor per chip. Up to `concurrency` batches run at once; while
+    they do, new chips keep queueing, so batches grow with the load.
+    Only chips with the same `num_jitters` share a batch.
+    """
+
+    def __init__(self, runner, max_batch=16, wait_ms=5.0, concurrency=1):
+        self.runner = runner
+        self.max_batch = max(int(max_batch), 1)
+        self.wait = max(float(wait_ms), 0.0) / 1000.0
+        self._slots = threading.Semaphore(max(int(concurrency), 1))
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._thread = None
+        self._counters = {'requests': 0, 'chips': 0, 'batches': 0, 'largest_batch': 0, 'errors': 0}
+        self._queued_total = 0.0
+
+    def encode(self, chips, num_jitters=1, timeout=None):
+        """Descriptors of `chips`, in order; blocks until their batch ran.
+
+        Exceptions raised by the runner are re-raised in every caller of
+        the failed batch.
+        """
+        if not len(chips):
+            return []
+        job = _Job(chips, num_jitters)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, name='encode-batcher', daemon=True)
+                self._thread.start()
+            self._queue.append(job)
+            self._cond.notify()
+        if not job.done.wait(timeout):
+            raise TimeoutError('face encoding batch did not finish in time')
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _take_batch(self):
+        # called with the lock held and a non-empty queue; FIFO within one jitter setting
+        head = self._queue[0]
+        batch, n = [], 0
+        for job in list(self._queue):
+            if job.num_jitters != head.num_jitters:
+                continue
+            if batch and n + len(job.chips) > self.max_batch:
+                break
+            batch.append(job)
+            n += len(job.chips)
+        for job in batch:
+            self._queue.remove(job)
+        return batch, n
+
+    def _ready(self):
+        head = self._queue[0]
+        waiting = sum(len(j.chips) for j in self._queue if j.num_jitters == head.num_jitters)
+        return waiting >= self.max_batch or time.monotonic() - head.enqueued >= self.wait
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                while not self._ready():
+                    self._cond.wait(max(self._queue[0].enqueued + self.wait - time.monotonic(), 0.0005))
+                batch, n = self._take_batch()
+                now = time.monotonic()
+                c = self._counters
+                c['requests'] += len(batch)
+                c['chips'] += n
+                c['batches'] += 1
+                c['largest_batch'] = max(c['largest_batch'], n)
+                self._queued_total += sum(now - job.enqueued for job in batch)
+            threading.Thread(target=self._run, args=(batch,), daemon=True).start()
+
+    def _run(self, batch):
+        try:
+            chips = [chip for job in batch for chip in job.chips]
+            try:
+                descs = self.runner(chips, batch[0].num_jitters)
+                if len(descs) != len(chips):
+                    raise RuntimeError('encoder returned %d descriptors for %d chips' % (len(descs), len(chips)))
+            except Exception as e:
+                logger.exception("face encoding batch of %d chips failed", len(chips))
+                with self._cond:
+                    self._counters['errors'] += 1
+                for job in batch:
+                    job.error = e
+                    job.done.set()
+                return
+            i = 0
+            for job in batch:
+                job.result = list(descs[i:i + len(job.chips)])
+                i += len(job.chips)
+                job.done.set()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """Batch counters: sizes, and the time requests waited to be batched."""
+        with self._cond:
+            c = dict(self._counters)
+            c['waiting'] = sum(len(j.chips) for j in self._queue)
+            queued_total = self._queued_total
+        c.update({
+            'max_batch': self.max_batch,
+            'wait_ms': 1000.0 * self.wait,
+            'avg_batch': c['chips'] / c['batches'] if c['batches'] else None,
+            'avg_queue_ms': 1000.0 * queued_total / c['requests'] if c['requests'] else None,
+        })
+        return c
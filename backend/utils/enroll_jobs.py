@@ -0,0 +1,174 @@
+"""Background runner for asynchronous enrollment jobs.
+
+`POST /api/face/enroll?async=1` saves the uploads, inserts an `EnrollJob`
+row (status 'queued') and returns 202 straight away. Worker threads in
+the web process (ENROLL_JOB_WORKERS, started on first use) claim queued
+jobs with a conditional UPDATE, so several gunicorn workers sharing one
+database never run the same job twice, and hand them to the route's
+processing function, which sends all images of a job to the recognition
+pool at once and records per-file progress in `EnrollJob.files`.
+
+The database row is the queue: jobs enqueued by another process are
+picked up within ENROLL_JOB_POLL_SECONDS. A claim takes a lease
+(`lease_owner`, `lease_until`) of ENROLL_JOB_LEASE_SECONDS that a
+heartbeat thread renews while the job runs, however long the pool takes;
+only jobs whose lease expired (their process died or hung) are re-queued.
+Before storing anything the processing function calls `renew(job_id,
+commit=False)`: the conditional UPDATE keeps the job row locked until the
+faces are committed, and a worker that lost its lease gets `LeaseLost`
+instead of inserting the same faces as the job's new owner.
+"""
+import os
+import uuid
+import threading
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+logger = logging.getLogger(__name__)
+
+ENROLL_JOB_WORKERS = int(os.getenv('ENROLL_JOB_WORKERS', 1))
+ENROLL_JOB_POLL_SECONDS = float(os.getenv('ENROLL_JOB_POLL_SECONDS', 2.0))
+ENROLL_JOB_LEASE_SECONDS = float(os.getenv('ENROLL_JOB_LEASE_SECONDS', 60))
+
+
+class LeaseLost(RuntimeError):
+    """The job was re-queued (lease expired) and may now belong to another worker."""
+
+
+class EnrollJobRunner:
+    """Claims queued jobs from `JobModel` and runs `process(job_id)` on them.
+
+    `process` runs inside an app context and is expected to set the job's
+    final status itself; if it raises, the job is marked 'failed' (unless
+    the lease was lost, in which case the row is left to its new owner).
+    """
+
+    def __init__(self, JobModel, db, process, workers=1, poll_seconds=2.0, lease_seconds=60.0):
+        self.JobModel = JobModel
+        self.db = db
+        self.process = process
+        self.workers = max(int(workers), 1)
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        # lease token of the job the current thread is running
+        self._local = threading.local()
+
+    def start(self, app):
+        """Start the worker threads for `app` (once per process)."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._loop, args=(app,), name='enroll-job-%d' % i, daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info("enroll job runner started with %d worker(s)", self.workers)
+
+    def wake(self):
+        self._wake.set()
+
+    def _lease_expiry(self):
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def _requeue_stale(self):
+        Job = self.JobModel
+        now = datetime.utcnow()
+        # rows claimed before leases existed only have started_at
+        expired = or_(Job.lease_until < now,
+                      and_(Job.lease_until.is_(None), Job.started_at < now - timedelta(seconds=self.lease_seconds)))
+        n = Job.query.filter(Job.status == 'running', expired).update(
+            {'status': 'queued', 'started_at': None, 'lease_owner': None, 'lease_until': None},
+            synchronize_session=False)
+        if n:
+            logger.warning("re-queued %d enroll job(s) with an expired lease", n)
+
+    def claim(self):
+        """Atomically move the oldest queued job to 'running' under a new lease; return its id or None."""
+        Job = self.JobModel
+        session = self.db.session
+        try:
+            self._requeue_stale()
+            candidates = [jid for (jid,) in Job.query.with_entities(Job.id).filter_by(status='queued')
+                          .order_by(Job.created_at).limit(self.workers * 4)]
+            for jid in candidates:
+                token = uuid.uuid4().hex
+                n = Job.query.filter_by(id=jid, status='queued').update(
+                    {'status': 'running', 'started_at': datetime.utcnow(), 'lease_owner': token,
+                     'lease_until': self._lease_expiry()}, synchronize_session=False)
+                session.commit()
+                if n == 1:
+                    self._local.token = token
+                    return jid
+            session.commit()
+        except Exception:
+            session.rollback()
+            logger.exception("failed to claim an enroll job")
+        return None
+
+    def renew(self, job_id, commit=True):
+        """Extend this thread's lease on `job_id`; False if it was lost.
+
+        With `commit=False` the UPDATE stays in the session's transaction,
+        holding the row until the caller commits its results with it.
+        """
+        Job = self.JobModel
+        token = getattr(self._local, 'token', None)
+        n = Job.query.filter_by(id=job_id, status='running', lease_owner=token).update(
+            {'lease_until': self._lease_expiry()}, synchronize_session=False)
+        if commit:
+            self.db.session.commit()
+        return n == 1
+
+    def _heartbeat(self, app, job_id, token, stop):
+        while not stop.wait(self.lease_seconds / 3.0):
+            self._local.token = token
+            with app.app_context():
+                try:
+                    if not self.renew(job_id):
+                        logger.warning("enroll job %s lost its lease", job_id)
+                        return
+                except Exception:
+                    self.db.session.rollback()
+                    logger.exception("failed to renew the lease of enroll job %s", job_id)
+                finally:
+                    self.db.session.remove()
+
+    def run_one(self, job_id, app=None):
+        stop = threading.Event()
+        if app is not None:
+            threading.Thread(target=self._heartbeat, args=(app, job_id, self._local.token, stop),
+                             name='enroll-lease-%s' % job_id, daemon=True).start()
+        try:
+            self.process(job_id)
+        except LeaseLost:
+            logger.warning("enroll job %s was re-queued while running; results discarded", job_id)
+            self.db.session.rollback()
+        except Exception as e:
+            logger.exception("enroll job %s failed", job_id)
+            self.db.session.rollback()
+            Job = self.JobModel
+            Job.query.filter_by(id=job_id, status='running', lease_owner=self._local.token).update(
+                {'status': 'failed', 'error': str(e), 'finished_at': datetime.utcnow()},
+                synchronize_session=False)
+            self.db.session.commit()
+        finally:
+            stop.set()
+
+    def _loop(self, app):
+        while True:
+            job_id = None
+            with app.app_context():
+                try:
+                    job_id = self.claim()
+                    if job_id is not None:
+                        self.run_one(job_id, app)
+                finally:
+                    self.db.session.remove()
+            if job_id is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
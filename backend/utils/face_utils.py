@@ -1,16 +1,43 @@
+import io
 import os
 import time
-import json
 import logging
 import traceback
 import numpy as np
 import cv2
 import face_recognition
 import csv
+import threading
+
+from .matcher import MatchEngine, normalize_rows, verify_profile
+from .embedding import decode_stored
+from .profiles import detect_kwargs
+from .quality import assess, measure_face
+from .prototypes import USER_PROTOTYPES, unpack_prototypes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cascade of `detect_and_encode`: first-stage detector, the detector it
+# escalates to when it finds no face of acceptable size ('' disables), and
+# dlib's upsample count
+FACE_DETECT_MODEL = os.getenv('FACE_DETECT_MODEL', 'hog')
+FACE_DETECT_FALLBACK = os.getenv('FACE_DETECT_FALLBACK', 'cnn')
+FACE_DETECT_UPSAMPLE = int(os.getenv('FACE_DETECT_UPSAMPLE', 1))
+# Long-edge size of the copy faces are detected on (0 = full resolution) and
+# face height the encoder crop is downscaled to (0 = encode from the full image)
+FACE_DETECT_MAX_SIDE = int(os.getenv('FACE_DETECT_MAX_SIDE', 1024))
+FACE_ENCODE_FACE_PX = int(os.getenv('FACE_ENCODE_FACE_PX', 200))
+# When escalation to CNN is allowed: 'cuda' (only on CUDA builds; the CNN
+# takes tens of seconds per image on CPU), 'auto' (whenever this dlib build
+# has the CNN detector) or 'off'
+FACE_DETECT_CNN = os.getenv('FACE_DETECT_CNN', 'cuda').lower()
+# Decode JPEG uploads at 1/2, 1/4 or 1/8 resolution (libjpeg DCT scaling)
+# when the detection copy would be at most that large anyway
+FACE_DECODE_REDUCED = os.getenv('FACE_DECODE_REDUCED', '1').lower() in ('1', 'true', 'yes')
+
+_REDUCED_MODES = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
 
 def normalize_vec(v):
     """Return L2-normalized numpy vector (float32)."""
@@ -19,99 +46,644 @@ def normalize_vec(v):
     return a / n if n > 0 else a
 
 
-def is_blurry_bgr(image_bgr, threshold=100.0):
-    """Return True if image is blurry using variance of Laplacian.
-    image_bgr: BGR or RGB numpy image.
+_detectors = None
+
+
+def probe_detectors(fr=None, force=False):
+    """Find out once which detectors work; returns `{'hog', 'cnn', 'cuda'}` flags.
+
+    Called at app startup so `detect_and_encode` never has to discover a
+    missing CNN detector through an exception on every request.
     """
+    global _detectors
+    if _detectors is not None and not force:
+        return _detectors
+    fr = fr or face_recognition
+    probe = np.zeros((64, 64, 3), dtype=np.uint8)
+    found = {}
+    for model in ('hog', 'cnn'):
+        try:
+            fr.face_locations(probe, number_of_times_to_upsample=0, model=model)
+            found[model] = True
+        except Exception as e:
+            logger.info("face detector %s unavailable: %s", model, e)
+            found[model] = False
     try:
-        if image_bgr is None:
-            return True
-        gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY) if image_bgr.ndim == 3 else image_bgr
-        var = cv2.Laplacian(gray, cv2.CV_64F).var()
-        return var < threshold
+        import dlib
+        found['cuda'] = bool(getattr(dlib, 'DLIB_USE_CUDA', False))
     except Exception:
-        logger.exception("blur check failed")
-        return True
+        found['cuda'] = False
+    _detectors = found
+    logger.info("face detectors: %s", found)
+    return found
+
+
+def _escalation_model(policy=None):
+    # second cascade stage, decided from the startup probe and the CNN policy
+    policy = policy or FACE_DETECT_CNN
+    if policy == 'off':
+        return ''
+    d = _detectors
+    if d is None:
+        # not probed (scripts/tests): try it and let the stage count the failure
+        return 'cnn'
+    if not d.get('cnn') or (policy == 'cuda' and not d.get('cuda')):
+        return ''
+    return 'cnn'
+
+
+# Per-stage detector counters of `detect_and_encode`, plus what the old
+# encode_faces/get_face_locations sequence would have run for the same
+# images (1 when HOG finds a face, otherwise HOG + CNN + CNN).
+_pipeline_lock = threading.Lock()
+_pipeline_counters = {'requests': 0, 'detector_calls': 0, 'legacy_detector_calls': 0, 'no_face': 0,
+                      'escalations': 0, 'stages': {}, 'decode': {'reduce': {}, 'fallbacks': 0}}
+
+
+def _count_pipeline(stages, legacy_calls, found):
+    with _pipeline_lock:
+        c = _pipeline_counters
+        c['requests'] += 1
+        c['detector_calls'] += len(stages)
+        c['legacy_detector_calls'] += legacy_calls
+        c['no_face'] += 0 if found else 1
+        c['escalations'] += 1 if len(stages) > 1 else 0
+        for model, hit in stages:
+            st = c['stages'].setdefault(model, {'runs': 0, 'hits': 0})
+            st['runs'] += 1
+            st['hits'] += 1 if hit else 0
+
+
+def _count_decode(decode):
+    with _pipeline_lock:
+        c = _pipeline_counters['decode']
+        key = str(decode['reduce'])
+        c['reduce'][key] = c['reduce'].get(key, 0) + 1
+        c['fallbacks'] += 1 if decode['fallback'] else 0
+
 
+def pipeline_stats():
+    """Detector invocation and per-stage hit counters of `detect_and_encode` (process-wide)."""
+    with _pipeline_lock:
+        c = dict(_pipeline_counters)
+        c['stages'] = {m: dict(st) for m, st in _pipeline_counters['stages'].items()}
+        c['decode'] = {'reduce': dict(_pipeline_counters['decode']['reduce']),
+                       'fallbacks': _pipeline_counters['decode']['fallbacks']}
+    n = c['requests']
+    c['saved_detector_calls'] = c['legacy_detector_calls'] - c['detector_calls']
+    c['detector_calls_per_request'] = c['detector_calls'] / n if n else None
+    c['legacy_detector_calls_per_request'] = c['legacy_detector_calls'] / n if n else None
+    c['escalation_rate'] = c['escalations'] / n if n else None
+    for st in c['stages'].values():
+        st['hit_rate'] = st['hits'] / st['runs'] if st['runs'] else None
+    c['detectors'] = _detectors
+    return c
 
-def get_face_locations(image, prefer_cnn=True, fr=None):
-    """Return face locations. Use cnn if available, else hog.
-    Accept optional `fr` parameter (face_recognition module) so callers can
-    pass a patched module for testing.
+
+def _detect_scale(shape, max_side, min_face_px, upsample):
+    """Downscale factor for detection (1.0 = full resolution).
+
+    The long side is brought down to `max_side`, but never so far that a
+    face of `min_face_px` original pixels falls below the ~80px window of
+    dlib's detectors (halved per upsample), so accepted faces stay findable.
     """
-    try:
-        fr = fr or face_recognition
-        if prefer_cnn:
-            try:
-                return fr.face_locations(image, model='cnn')
-            except Exception:
-                return fr.face_locations(image, model='hog')
-        else:
-            return fr.face_locations(image, model='hog')
-    except Exception:
-        logger.exception("face location failed")
-        return []
+    long_side = max(shape[:2])
+    if not max_side or long_side <= max_side:
+        return 1.0
+    scale = float(max_side) / long_side
+    if min_face_px:
+        scale = max(scale, (80.0 / (2 ** upsample)) / min_face_px)
+    return min(scale, 1.0)
 
 
-def encode_faces(image, locations=None, fr=None):
-    """Return face encodings (list of 128-d numpy arrays).
+def jpeg_size(fh):
+    """(width, height) from the SOF marker of a JPEG file object, or None.
 
-    If `locations` is None, prefer calling `fr.face_encodings(image)` which
-    matches common test patches that replace `face_encodings`. If that
-    returns no encodings, fall back to detecting locations first.
+    Reads only the marker headers, never the compressed data.
     """
     try:
-        fr = fr or face_recognition
-        encs = []
-        if locations is None:
-            try:
-                encs = fr.face_encodings(image)
-            except Exception:
-                encs = []
-            if not encs:
-                locations = get_face_locations(image, fr=fr)
-        if locations is not None and locations:
-            try:
-                encs = fr.face_encodings(image, known_face_locations=locations)
-            except Exception:
-                encs = []
-        return [normalize_vec(e) for e in encs]
+        if fh.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            b = fh.read(1)
+            while b and b != b'\xff':
+                b = fh.read(1)
+            while b == b'\xff':
+                b = fh.read(1)
+            if not b:
+                return None
+            marker = b[0]
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                continue
+            seg = fh.read(2)
+            if len(seg) < 2:
+                return None
+            length = int.from_bytes(seg, 'big')
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                sof = fh.read(5)
+                if len(sof) < 5:
+                    return None
+                return int.from_bytes(sof[3:5], 'big'), int.from_bytes(sof[1:3], 'big')
+            fh.seek(length - 2, 1)
     except Exception:
-        logger.exception("face encoding failed")
+        return None
+
+
+def decode_reduction(size, max_side, min_face_px, upsample):
+    """Largest JPEG decode reduction (1, 2, 4 or 8) that loses no detection resolution.
+
+    `size` is the (width, height) from the header. The reduced image must
+    still be at least as large as the copy `_detect_scale` would detect
+    on, which also keeps a `min_face_px` face above the detector window.
+    """
+    if not size or not min(size):
+        return 1
+    scale = _detect_scale((size[1], size[0]), max_side, min_face_px, upsample)
+    for r in (8, 4, 2):
+        if r * scale <= 1.0:
+            return r
+    return 1
+
+
+def _scale_boxes(boxes, factor, shape):
+    """Boxes multiplied by `factor`, clipped to an image of `shape`."""
+    H, W = shape[:2]
+    return [(max(int(round(t * factor)), 0), min(int(round(r * factor)), W),
+             min(int(round(b * factor)), H), max(int(round(l * factor)), 0))
+            for t, r, b, l in boxes]
+
+
+def _face_crops(image, boxes, face_px):
+    """Yield (crop, box in crop pixels) per box: padded, downscaled so the face is ~`face_px` tall."""
+    H, W = image.shape[:2]
+    for top, right, bottom, left in boxes:
+        # landmarks and the 150px face chip only need the face plus some context
+        pad = (bottom - top) // 2
+        y0, y1 = max(top - pad, 0), min(bottom + pad, H)
+        x0, x1 = max(left - pad, 0), min(right + pad, W)
+        crop = image[y0:y1, x0:x1]
+        box = (top - y0, right - x0, bottom - y0, left - x0)
+        if bottom - top > face_px:
+            s = float(face_px) / (bottom - top)
+            crop = cv2.resize(crop, (max(int(round((x1 - x0) * s)), 1), max(int(round((y1 - y0) * s)), 1)),
+                              interpolation=cv2.INTER_AREA)
+            box = tuple(int(round(v * s)) for v in box)
+        yield np.ascontiguousarray(crop), box
+
+
+def _encode_boxes(image, boxes, fr, face_px, num_jitters=1, landmarks='small'):
+    """Encode each box from a padded crop, downscaled so the face is ~`face_px` tall.
+
+    Returns one entry per box, None where the crop gave no encoding, so
+    `encodings[i]` always belongs to `boxes[i]`.
+    """
+    if not face_px or not hasattr(image, 'shape'):
+        encs = list(fr.face_encodings(image, known_face_locations=boxes, num_jitters=num_jitters, model=landmarks))
+        return encs if len(encs) == len(boxes) else [None] * len(boxes)
+    encs = []
+    for crop, box in _face_crops(image, boxes, face_px):
+        e = fr.face_encodings(crop, known_face_locations=[box], num_jitters=num_jitters, model=landmarks)
+        encs.append(e[0] if len(e) else None)
+    return encs
+
+
+def face_chips(image, boxes, fr=None, face_px=None, landmarks='small'):
+    """Aligned 150x150 face chips for `boxes`, the input of the face encoder.
+
+    Landmarks come from the same padded, downscaled crops `detect_and_encode`
+    encodes from, so `encode_chips(face_chips(...))` gives the descriptors
+    `face_encodings` would, but lets many faces be encoded in one call.
+    """
+    import dlib
+
+    fr = fr or face_recognition
+    face_px = FACE_ENCODE_FACE_PX if face_px is None else face_px
+    predictor = fr.api.pose_predictor_68_point if landmarks == 'large' else fr.api.pose_predictor_5_point
+    if face_px:
+        crops = _face_crops(image, boxes, face_px)
+    else:
+        crops = ((image, box) for box in boxes)
+    chips = []
+    for crop, (top, right, bottom, left) in crops:
+        shape = predictor(crop, dlib.rectangle(left, top, right, bottom))
+        # same size/padding dlib uses inside compute_face_descriptor(img, shape)
+        chips.append(dlib.get_face_chip(crop, shape, size=150, padding=0.25))
+    return chips
+
+
+def encode_chips(chips, num_jitters=1, fr=None):
+    """Normalized 128-d descriptors of aligned face chips, computed in one batch."""
+    if not len(chips):
         return []
+    fr = fr or face_recognition
+    descs = fr.api.face_encoder.compute_face_descriptor(list(chips), num_jitters)
+    return [normalize_vec(d) for d in descs]
+
+
+def detect_and_encode(image, model=None, fallback_model=None, upsample=None, fr=None,
+                      max_side=None, min_face_px=None, encode_face_px=None,
+                      cnn=None, num_jitters=1, landmarks='small', encode=True,
+                      decode_scale=1, reload=None, blur_threshold=None):
+    """
+    Detect faces with a two-stage cascade and encode them from the same boxes.
+
+    Stage one runs `model` (HOG) at `upsample` on a copy downscaled to
+    `max_side` on the long edge (see `_detect_scale`; `min_face_px` is the
+    smallest face the caller will accept). Its result is accepted unless it
+    found nothing or every box is smaller than `min_face_px` original
+    pixels; only then `fallback_model` (CNN, if the startup probe found it
+    and the `cnn` policy allows it, see FACE_DETECT_CNN) runs once on the
+    same copy and its boxes are used if it found any. Boxes are mapped back to full-resolution pixels and
+    each face is encoded from a crop downscaled to `encode_face_px` face
+    height with `face_encodings(known_face_locations=...)`, which does not
+    detect again; `num_jitters` and `landmarks` ('small' 5-point or 'large'
+    68-point) are passed through to it. With `encode=False` the aligned
+    face chips are returned in `chips` instead (see `face_chips`), for an
+    encode micro-batcher to encode together with other requests' faces.
+    `image` may have been decoded at 1/`decode_scale` of the original
+    resolution (see `decode_reduction`); `min_face_px` and the returned
+    boxes stay in original pixels. If a face found there is smaller than
+    `encode_face_px`, `reload()` supplies the full-resolution image the
+    faces are then encoded from (`decode_fallback` is set). With
+    `blur_threshold`, the first face is measured on the image it is encoded
+    from (see quality.py) and not encoded if it fails the gate.
+    Defaults come from FACE_DETECT_MODEL / FACE_DETECT_FALLBACK
+    / FACE_DETECT_UPSAMPLE / FACE_DETECT_MAX_SIDE / FACE_ENCODE_FACE_PX.
+    Returns a dict:
+      boxes          [(top, right, bottom, left), ...] in original pixels
+      heights        box heights in original pixels, same order
+      encodings      normalized 128-d vectors, same order
+      model          detector that produced the boxes (None if no face)
+      detector_calls detector invocations made for this image
+      detect_scale   factor the detection copy was resized by
+      stages         [(detector, hit), ...] cascade stages that ran
+      quality        quality record of the first face (with `blur_threshold`)
+      timings        {'detect_ms', 'quality_ms', 'encode_ms'}
+    """
+    fr = fr or face_recognition
+    model = model or FACE_DETECT_MODEL
+    if fallback_model is None:
+        fallback_model = _escalation_model(cnn) if FACE_DETECT_FALLBACK == 'cnn' else FACE_DETECT_FALLBACK
+    upsample = FACE_DETECT_UPSAMPLE if upsample is None else upsample
+    max_side = FACE_DETECT_MAX_SIDE if max_side is None else max_side
+    encode_face_px = FACE_ENCODE_FACE_PX if encode_face_px is None else encode_face_px
+    result = {'boxes': [], 'heights': [], 'encodings': [], 'model': None, 'detector_calls': 0, 'detect_scale': 1.0}
+
+    t0 = time.perf_counter()
+    # faces are compared with min_face_px in the pixels of the decoded image
+    face_min = float(min_face_px) / decode_scale if min_face_px else min_face_px
+    small = image
+    scale = 1.0
+    if hasattr(image, 'shape'):
+        scale = _detect_scale(image.shape, max_side, face_min, upsample)
+        if scale < 1.0:
+            h, w = image.shape[:2]
+            small = cv2.resize(image, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+        result['detect_scale'] = scale / decode_scale
+
+    stages = []
+    models = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+    for m in models:
+        try:
+            boxes = fr.face_locations(small, number_of_times_to_upsample=upsample, model=m)
+        except Exception:
+            logger.exception("face detection (%s) failed", m)
+            boxes = []
+        boxes = [tuple(int(v) for v in b) for b in boxes]
+        # a stage "hits" when it yields a face big enough to be accepted
+        big_enough = [b for b in boxes if not face_min or (b[2] - b[0]) / scale >= face_min]
+        stages.append((m, bool(big_enough)))
+        if boxes and (big_enough or not result['boxes']):
+            result['boxes'] = boxes
+            result['model'] = m
+        if big_enough:
+            break
+    result['detector_calls'] = len(stages)
+    result['stages'] = stages
+    if result['boxes'] and scale < 1.0:
+        result['boxes'] = _scale_boxes(result['boxes'], 1.0 / scale, image.shape)
+    t1 = time.perf_counter()
+
+    if result['boxes'] and decode_scale > 1 and reload is not None and (
+            not encode_face_px or min(b[2] - b[0] for b in result['boxes']) < encode_face_px):
+        # too few pixels on the face for the encoder: encode from the full image
+        full = reload()
+        if full is not None:
+            result['boxes'] = _scale_boxes(result['boxes'], decode_scale, full.shape)
+            image, decode_scale = full, 1
+            result['decode_fallback'] = True
+    t2 = time.perf_counter()
+    if result['boxes'] and blur_threshold is not None and hasattr(image, 'shape'):
+        box = result['boxes'][0]
+        result['quality'] = assess(measure_face(image, box), (box[2] - box[0]) * decode_scale,
+                                   blur_threshold, min_face_px)
+    t3 = time.perf_counter()
+    # a face that fails the gate is rejected by the caller; do not encode it
+    gated = bool(result.get('quality') and result['quality']['reason'])
+    if result['boxes'] and not encode and not gated:
+        try:
+            result['chips'] = face_chips(image, result['boxes'], fr, encode_face_px, landmarks)
+        except Exception:
+            logger.exception("face alignment failed")
+            result['chips'] = []
+    elif result['boxes'] and not gated:
+        try:
+            encs = _encode_boxes(image, result['boxes'], fr, encode_face_px, num_jitters, landmarks)
+        except Exception:
+            logger.exception("face encoding failed")
+            encs = [None] * len(result['boxes'])
+        result['encodings'] = [None if e is None else normalize_vec(e) for e in encs]
+    if result['boxes'] and decode_scale > 1:
+        H, W = image.shape[:2]
+        result['boxes'] = _scale_boxes(result['boxes'], decode_scale, (H * decode_scale, W * decode_scale))
+    result['heights'] = [b[2] - b[0] for b in result['boxes']]
+    result['timings'] = {'detect_ms': 1000.0 * (t1 - t0), 'quality_ms': 1000.0 * (t3 - t2),
+                         'encode_ms': 1000.0 * (time.perf_counter() - t3 + t2 - t1)}
+    record_pipeline(result)
+    return result
+
+
+def record_pipeline(result):
+    """Add one `detect_and_encode` result to this process's pipeline counters.
+
+    `detect_and_encode` records its own results; this is also called in the
+    web process for results computed by recognition pool workers.
+    """
+    found = bool(result['boxes'])
+    _count_pipeline(result['stages'], 1 if (found and result['model'] == 'hog') else 3, found)
+    if result.get('decode'):
+        _count_decode(result['decode'])
+
+
+def _decode(data, flags):
+    if isinstance(data, str):
+        return cv2.imread(data, flags)
+    return cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+
+
+def analyze_image(data, profile, min_face_px, blur_threshold, fr=None, encode=True):
+    """Decode an uploaded image, `detect_and_encode` it and apply the face quality gate.
+
+    `data` is the encoded image (bytes) or the path of a saved upload;
+    `profile` is a recognition profile (see `profiles.py`). Arguments and
+    result are picklable so this can run in a recognition pool worker.
+    JPEGs are decoded at the reduction `decode_reduction` picks from the
+    header dimensions (FACE_DECODE_REDUCED); the full image is decoded
+    again only for faces too small to encode from the reduced one.
+    Returns the `detect_and_encode` result (face chips instead of
+    encodings with `encode=False`) plus `error`: None, 'decode_failed',
+    'blurry', 'too_dark' or 'too_bright' (from the first face's `quality`
+    record, see quality.py), `decode` ({'size', 'reduce', 'fallback'}) and
+    `timings` per stage in milliseconds.
+    """
+    fr = fr or face_recognition
+    timings = {}
+    t0 = time.perf_counter()
+    kwargs = detect_kwargs(profile)
+    reduce = 1
+    size = None
+    if FACE_DECODE_REDUCED and kwargs.get('encode_face_px', FACE_ENCODE_FACE_PX):
+        # (full-resolution encoding needs the full image anyway)
+        if isinstance(data, str):
+            with open(data, 'rb') as fh:
+                size = jpeg_size(fh)
+        else:
+            size = jpeg_size(io.BytesIO(data))
+        reduce = decode_reduction(size, kwargs.get('max_side', FACE_DETECT_MAX_SIDE), min_face_px,
+                                  kwargs.get('upsample', FACE_DETECT_UPSAMPLE))
+    bgr = _decode(data, _REDUCED_MODES.get(reduce, cv2.IMREAD_COLOR))
+    if bgr is None and reduce > 1:
+        reduce = 1
+        bgr = _decode(data, cv2.IMREAD_COLOR)
+    if bgr is None:
+        # OpenCV could not decode the image (corrupt bytes or a test double);
+        # face_recognition's loader may still produce an image
+        try:
+            rgb = fr.load_image_file(data if isinstance(data, str) else io.BytesIO(data))
+        except Exception:
+            rgb = None
+        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR) if hasattr(rgb, 'ndim') else None
+    else:
+        rgb = None
+    timings['decode_ms'] = 1000.0 * (time.perf_counter() - t0)
+    decode = {'size': list(size) if size else None, 'reduce': reduce, 'fallback': False}
+    if bgr is None and rgb is None:
+        return {'error': 'decode_failed', 'quality': None, 'decode': decode, 'timings': timings}
+    if bgr is not None:
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    del bgr
+
+    def reload():
+        t = time.perf_counter()
+        full = _decode(data, cv2.IMREAD_COLOR)
+        timings['redecode_ms'] = 1000.0 * (time.perf_counter() - t)
+        return cv2.cvtColor(full, cv2.COLOR_BGR2RGB) if full is not None else None
+
+    result = detect_and_encode(rgb, fr=fr, min_face_px=min_face_px, encode=encode,
+                               decode_scale=reduce, reload=reload, blur_threshold=blur_threshold, **kwargs)
+    decode['fallback'] = bool(result.get('decode_fallback'))
+    _count_decode(decode)
+    timings.update(result.pop('timings', {}))
+    quality = result.get('quality')
+    # face size is checked by the callers, after the face count
+    error = quality['reason'] if quality and quality['reason'] != 'face_too_small' else None
+    result.update({'error': error, 'quality': quality, 'decode': decode, 'timings': timings})
+    return result
+
+
+def _decode_vec(raw, raw_bin=None):
+    """Decode a stored embedding into a float32 array, preferring the binary column."""
+    return decode_stored(raw_bin if raw_bin is not None else raw)
+
+
+def _build_profile(user, faces):
+    """Return a normalized profile dict for `user` or None if it has no encoding."""
+    if user.encoding_bin is None and not user.encoding:
+        return None
+    avg = _decode_vec(user.encoding, user.encoding_bin)
+    face_vecs = []
+    for f in faces:
+        try:
+            face_vecs.append(normalize_vec(_decode_vec(f.embedding, f.embedding_bin)))
+        except Exception:
+            logger.exception("bad face embedding for face id %s", getattr(f, 'id', None))
+    return {'avg': normalize_vec(avg), 'faces': face_vecs}
+
+
+class _RowBuffer:
+    """Preallocated float32 row matrix that grows if the row estimate was low."""
+
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self.keys = np.empty(self.capacity, dtype=np.int64)
+        self.mat = None
+        self.n = 0
+
+    def append(self, key, vec):
+        if self.mat is None:
+            self.mat = np.empty((self.capacity, vec.shape[0]), dtype=np.float32)
+        elif vec.shape[0] != self.mat.shape[1]:
+            raise ValueError('embedding has %d dims, expected %d' % (vec.shape[0], self.mat.shape[1]))
+        if self.n == self.capacity:
+            self.capacity *= 2
+            self.keys = np.resize(self.keys, self.capacity)
+            mat = np.empty((self.capacity, self.mat.shape[1]), dtype=np.float32)
+            mat[:self.n] = self.mat[:self.n]
+            self.mat = mat
+        self.keys[self.n] = key
+        self.mat[self.n] = vec
+        self.n += 1
+
+    def result(self, dim=None):
+        dim = self.mat.shape[1] if self.mat is not None else (dim or 0)
+        mat = self.mat[:self.n] if self.mat is not None else np.zeros((0, dim), dtype=np.float32)
+        return self.keys[:self.n], mat
+
+
+def load_gallery_arrays(UserModel, FaceModel, batch_size=1000, stats=None, trace_memory=False, prototypes=None):
+    """
+    Stream every enrolled user and active face with two bulk queries (server-side
+    cursors via `yield_per`) straight into preallocated float32 arrays.
+
+    Returns a dict:
+      uids      (N,)   int64 user ids, ascending
+      centroids (N, D) normalized user centroids
+      faces     (M, D) normalized face embeddings grouped by user
+      offsets   (N+1,) faces of uids[i] are faces[offsets[i]:offsets[i+1]]
+    Users with stored prototypes (see prototypes.py) get those rows instead
+    of their faces, unless `prototypes` is False (default: USER_PROTOTYPES > 0).
+    If `stats` is a dict it is filled with row counts, rows/sec and peak memory.
+    """
+    start = time.time()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    if prototypes is None:
+        prototypes = USER_PROTOTYPES > 0
+    users = _RowBuffer(UserModel.query.count())
+    protos = {}
+    q = UserModel.query.with_entities(UserModel.id, UserModel.encoding, UserModel.encoding_bin,
+                                      UserModel.prototypes_bin)
+    for uid, enc, enc_bin, proto_bin in q.order_by(UserModel.id).yield_per(batch_size):
+        if enc_bin is None and not enc:
+            continue
+        try:
+            vec = _decode_vec(enc, enc_bin)
+            if prototypes and proto_bin is not None:
+                protos[uid] = unpack_prototypes(proto_bin, vec.shape[0])
+            users.append(uid, vec)
+        except Exception:
+            logger.exception("failed load profile for user %s", uid)
+    uids, centroids = users.result()
+
+    active = FaceModel.query.filter(FaceModel.archived_at.is_(None))
+    faces = _RowBuffer(active.count())
+    q = active.with_entities(FaceModel.id, FaceModel.user_id, FaceModel.embedding, FaceModel.embedding_bin)
+    face_user_ids = []
+    for fid, fuid, emb, emb_bin in q.order_by(FaceModel.user_id, FaceModel.id).yield_per(batch_size):
+        if emb is None and emb_bin is None:
+            continue
+        try:
+            faces.append(fid, _decode_vec(emb, emb_bin))
+            face_user_ids.append(fuid)
+        except Exception:
+            logger.exception("bad face embedding for face id %s", fid)
+    _, face_mat = faces.result(dim=centroids.shape[1])
+    face_user_ids = np.asarray(face_user_ids, dtype=np.int64)
+
+    # keep only faces of users that have a centroid; rows are already grouped by user
+    keep = np.isin(face_user_ids, uids)
+    face_mat = normalize_rows(face_mat[keep]) if face_mat.shape[0] else face_mat
+    face_user_ids = face_user_ids[keep]
+    offsets = np.searchsorted(face_user_ids, np.append(uids, np.iinfo(np.int64).max)).astype(np.int64)
+    offsets[-1] = face_user_ids.shape[0]
+    if protos:
+        blocks = [normalize_rows(protos[uid]) if uid in protos else face_mat[offsets[i]:offsets[i + 1]]
+                  for i, uid in enumerate(uids.tolist())]
+        offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum([b.shape[0] for b in blocks], out=offsets[1:])
+        face_mat = np.concatenate(blocks) if blocks else face_mat
+
+    arrays = {
+        'uids': uids.copy(),
+        'centroids': normalize_rows(centroids) if centroids.shape[0] else centroids,
+        'faces': face_mat,
+        'offsets': offsets,
+    }
+
+    if stats is not None:
+        elapsed = time.time() - start
+        rows = users.n + faces.n
+        stats.update({
+            'users': int(uids.shape[0]),
+            'faces': int(face_mat.shape[0]),
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else None,
+            'array_bytes': int(sum(a.nbytes for a in arrays.values())),
+        })
+        try:
+            import resource
+            stats['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        except Exception:
+            pass
+        if trace_memory:
+            stats['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+    if trace_memory:
+        tracemalloc.stop()
+    return arrays
 
 
 def load_user_profiles_from_db(UserModel, FaceModel):
     """
     Load normalized user_profiles: { user_id: {'avg': np.array, 'faces':[np.array,...]} }
-    Assumes UserModel.encoding stores JSON list of 128 floats and FaceModel.embedding stores JSON list.
+    Embeddings are read from the binary columns when present, else from the JSON ones.
+    Built on `load_gallery_arrays`; the vectors are views into its matrices.
+    """
+    arrays = load_gallery_arrays(UserModel, FaceModel)
+    offsets = arrays['offsets']
+    profiles = {}
+    for i, uid in enumerate(arrays['uids'].tolist()):
+        profiles[uid] = {
+            'avg': arrays['centroids'][i],
+            'faces': list(arrays['faces'][offsets[i]:offsets[i + 1]]),
+        }
+    return profiles
+
+
+def load_user_profile_from_db(UserModel, FaceModel, user_id):
+    """Load the normalized profile of a single user, or None if not enrolled."""
+    try:
+        return load_user_profiles_by_id(UserModel, FaceModel, [user_id]).get(user_id)
+    except Exception:
+        logger.exception("failed load profile for user %s", user_id)
+        return None
+
+
+def load_user_profiles_by_id(UserModel, FaceModel, user_ids):
+    """Normalized profiles of `user_ids` with two queries: `{uid: {'avg', 'faces'}}`.
+
+    Users that are not enrolled are left out. Users with stored prototypes
+    get those instead of their faces, as in `load_gallery_arrays`.
     """
+    users = UserModel.query.filter(UserModel.id.in_(list(user_ids))).all()
+    faces = {}
+    face_ids = [u.id for u in users if not (USER_PROTOTYPES > 0 and u.prototypes_bin is not None)]
+    if face_ids:
+        q = FaceModel.query.filter(FaceModel.user_id.in_(face_ids)).filter(FaceModel.archived_at.is_(None))
+        for f in q.order_by(FaceModel.user_id, FaceModel.id):
+            faces.setdefault(f.user_id, []).append(f)
     profiles = {}
-    users = UserModel.query.all()
     for u in users:
-        try:
-            if not u.encoding:
-                continue
-            # user.encoding may be a JSON string or a Python list
-            avg_raw = u.encoding
-            if isinstance(avg_raw, str):
-                avg = np.array(json.loads(avg_raw), dtype=np.float32)
-            else:
-                avg = np.array(avg_raw, dtype=np.float32)
-            faces = []
-            for f in FaceModel.query.filter_by(user_id=u.id).all():
-                try:
-                    vec_raw = f.embedding
-                    if isinstance(vec_raw, str):
-                        vec = np.array(json.loads(vec_raw), dtype=np.float32)
-                    else:
-                        vec = np.array(vec_raw, dtype=np.float32)
-                    faces.append(normalize_vec(vec))
-                except Exception:
-                    logger.exception("bad face embedding for face id %s", getattr(f, 'id', None))
-            profiles[u.id] = {'avg': normalize_vec(avg), 'faces': faces}
-        except Exception:
-            logger.exception("failed load profile for user %s", getattr(u, 'id', None))
+        if USER_PROTOTYPES > 0 and u.prototypes_bin is not None and (u.encoding_bin is not None or u.encoding):
+            avg = _decode_vec(u.encoding, u.encoding_bin)
+            protos = unpack_prototypes(u.prototypes_bin, avg.shape[0])
+            profiles[u.id] = {'avg': normalize_vec(avg), 'faces': [normalize_vec(p) for p in protos]}
+            continue
+        profile = _build_profile(u, faces.get(u.id, ()))
+        if profile is not None:
+            profiles[u.id] = profile
     return profiles
 
 
@@ -122,38 +694,42 @@ def decide_match(query_vec, user_profiles, USER_TOL=0.45, USER_MARGIN=0.15, FACE
       - pick best user if best_d <= USER_TOL
       - require margin = runner_up_d - best_d >= USER_MARGIN
       - verify that at least one per-face distance <= FACE_TOL
+    `user_profiles` is either a MatchEngine (as held by the gallery cache) or
+    a `{uid: {'avg', 'faces'}}` dict, which is packed into one on the fly.
     Returns: accepted (bool), debug dict
     """
-    q = normalize_vec(query_vec)
-    if not user_profiles:
-        return False, {'error': 'no user profiles'}
-
-    # compute centroid distances
-    dists = []
-    for uid, p in user_profiles.items():
-        d = float(np.linalg.norm(q - p['avg']))
-        dists.append((uid, d))
-    dists.sort(key=lambda x: x[1])
-    best_uid, best_d = dists[0]
-    runner_up_d = dists[1][1] if len(dists) > 1 else float('inf')
-    margin = runner_up_d - best_d
-
-    # per-face verification
-    per_face_dists = [float(np.linalg.norm(q - f)) for f in user_profiles[best_uid]['faces']] if user_profiles[best_uid]['faces'] else [float('inf')]
-    per_face_min = min(per_face_dists)
-
-    accepted = (best_d <= USER_TOL) and (margin >= USER_MARGIN) and (per_face_min <= FACE_TOL)
-
-    debug = {
-        'best_uid': best_uid,
-        'best_d': best_d,
-        'runner_up_d': runner_up_d,
-        'margin': margin,
-        'per_face_min': per_face_min,
-        'per_face_dists_top3': sorted(per_face_dists)[:3],
-        'accepted': accepted
-    }
-    return accepted, debug
+    if not isinstance(user_profiles, MatchEngine):
+        if not user_profiles:
+            return False, {'error': 'no user profiles'}
+        user_profiles = MatchEngine.from_profiles(user_profiles)
+    return user_profiles.decide(query_vec, USER_TOL, USER_MARGIN, FACE_TOL)
+
+
+def verify_match(query_vec, user_id, profile, VERIFY_TOL=0.45, FACE_TOL=0.55):
+    """
+    1:1 verification of a query against one claimed user:
+      - centroid distance best_d <= VERIFY_TOL
+      - at least one per-face distance <= FACE_TOL
+    `profile` is a `{'avg', 'faces'}` dict (e.g. from `load_user_profile_from_db`).
+    Returns the same (accepted, debug) pair as `decide_match`; `runner_up_d`
+    and `margin` are infinite since no other user is compared.
+    """
+    if profile is None:
+        return False, {'error': 'no profile for user', 'best_uid': user_id}
+    return verify_profile(user_id, profile['avg'], profile['faces'], query_vec, VERIFY_TOL, FACE_TOL)
+
+
+def decide_match_many(query_mat, user_profiles, USER_TOL=0.45, USER_MARGIN=0.15, FACE_TOL=0.55):
+    """
+    Batched decide_match for a Q x 128 matrix (or list) of query embeddings,
+    e.g. every face of a group photo or several kiosk frames.
+    Returns: list of (accepted, debug) pairs, one per query, in input order.
+    """
+    if not isinstance(user_profiles, MatchEngine):
+        if not user_profiles:
+            return [(False, {'error': 'no user profiles'}) for _ in range(len(query_mat))]
+        user_profiles = MatchEngine.from_profiles(user_profiles)
+    return user_profiles.decide_many(query_mat, USER_TOL, USER_MARGIN, FACE_TOL)
 
 
 def append_log_row(csv_path, row, header=None):
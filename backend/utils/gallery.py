@@ -0,0 +1,374 @@
+"""Process-wide in-memory gallery of enrolled face profiles.
+
+`/api/attendance/mark` used to reload and JSON-decode every user and face
+from the database on every request. The gallery is
+built once per process on first use and then kept up to date in place by
+the routes that change enrollment data (`face.enroll`, `face.delete_face`
+and `users.delete_user`).
+
+Profiles are held in a `MatchEngine` (contiguous centroid matrix), which
+is thread-safe, so per-user updates are applied in place while other
+requests keep matching against it. Set GALLERY_ANN=ivf to put an IVF
+index in front of the exact scan for very large galleries, and
+GALLERY_SNAPSHOT_DIR to share one memory-mapped copy between workers.
+With GALLERY_QUANT the engine holds only compact centroid and face rows
+and reads the float32 rows of its re-rank candidates from the mapped
+snapshot, or from the database when there is no snapshot.
+
+Scoped identification (e.g. a kiosk serving one site) uses per-partition
+sub-galleries keyed by `User.department` or `User.site`
+(GALLERY_PARTITION_BY). A partition's engine is copied out of the global
+one on its first scoped query and then updated alongside it, so scoped
+matching cost follows the partition size, not the headcount.
+"""
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+from .face_utils import load_gallery_arrays, load_user_profile_from_db, load_user_profiles_by_id
+from .matcher import ArrayRows, MatchEngine
+from .ann import IVFIndex
+from .snapshot import current_version, load_snapshot, snapshot_lock, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Optional approximate search (tunable via environment variables)
+GALLERY_ANN = os.getenv('GALLERY_ANN', '').lower()
+ANN_MIN_USERS = int(os.getenv('ANN_MIN_USERS', 50000))
+ANN_TOP_K = int(os.getenv('ANN_TOP_K', 10))
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 8))
+ANN_NLISTS = int(os.getenv('ANN_NLISTS', 0)) or None
+
+# Optional compact centroid scan ('float16' or 'int8') with float32 re-ranking
+GALLERY_QUANT = os.getenv('GALLERY_QUANT', '').lower()
+GALLERY_QUANT_RERANK = int(os.getenv('GALLERY_QUANT_RERANK', 16))
+
+# Optional memory-mapped snapshot shared by all worker processes
+GALLERY_SNAPSHOT_DIR = os.getenv('GALLERY_SNAPSHOT_DIR', '')
+GALLERY_SNAPSHOT_CHECK_SECONDS = float(os.getenv('GALLERY_SNAPSHOT_CHECK_SECONDS', 2.0))
+
+
+# User column that defines scoped sub-galleries ('department' or 'site')
+GALLERY_PARTITION_BY = os.getenv('GALLERY_PARTITION_BY', 'department').lower()
+
+
+def _engine_options():
+    opts = {}
+    if GALLERY_ANN == 'ivf':
+        opts.update({
+            'ann': IVFIndex(n_lists=ANN_NLISTS, n_probe=ANN_NPROBE),
+            'ann_min_users': ANN_MIN_USERS,
+            'ann_top_k': ANN_TOP_K,
+        })
+    if GALLERY_QUANT:
+        opts.update({'quant': GALLERY_QUANT, 'quant_rerank': GALLERY_QUANT_RERANK})
+    return opts
+
+
+def _db_rows(UserModel, FaceModel):
+    """`exact_rows` source that reads the re-rank candidates' float32 rows from the database."""
+    def rows(uids):
+        profiles = load_user_profiles_by_id(UserModel, FaceModel, uids)
+        return {uid: (p['avg'], np.asarray(p['faces'], dtype=np.float32).reshape(-1, p['avg'].shape[0]))
+                for uid, p in profiles.items()}
+    return rows
+
+
+class GalleryCache:
+    """Lazily built, incrementally updated cache of user profiles.
+
+    With `snapshot_dir` set, the gallery is shared between worker processes
+    through memory-mapped snapshots (see `snapshot.py`): workers load the
+    live snapshot instead of querying the DB, publish a new snapshot after
+    each enroll/delete, and reload when another worker published one.
+    """
+
+    def __init__(self, snapshot_dir=None, snapshot_check_seconds=2.0, partition_by='department'):
+        self._lock = threading.RLock()
+        self._engine = None
+        self.built_at = None
+        self.build_seconds = None
+        self.updated_at = None
+        self.load_stats = {}
+        self.snapshot_dir = snapshot_dir or None
+        self.snapshot_check_seconds = snapshot_check_seconds
+        self.snapshot_version = None
+        self._snapshot_checked_at = 0.0
+        self.partition_by = partition_by
+        self._members = None     # {uid: partition key}, loaded with the gallery
+        self._partitions = {}    # partition key -> MatchEngine, built on first scoped use
+
+    @property
+    def is_built(self):
+        return self._engine is not None
+
+    def engine(self, UserModel, FaceModel, scope=None):
+        """Return the match engine, building it on first use.
+
+        With `scope` the engine of that partition is returned instead (an
+        empty engine for a partition without enrolled users). In snapshot
+        mode a newer published snapshot is picked up here.
+        """
+        engine = self._engine
+        if engine is not None and not self._snapshot_changed():
+            if scope is None:
+                return engine
+            part = self._partitions.get(scope)
+            if part is not None:
+                return part
+        with self._lock:
+            if self._engine is None:
+                self._load(UserModel, FaceModel)
+            elif self.snapshot_dir and current_version(self.snapshot_dir) not in (None, self.snapshot_version):
+                self._load_snapshot()
+            if scope is None:
+                return self._engine
+            return self._partition(scope, UserModel)
+
+    def profile(self, user_id, UserModel, FaceModel):
+        """Return one user's normalized `{'avg', 'faces'}` profile, or None.
+
+        Served from the gallery when it is already built; otherwise only that
+        user's rows are read, so 1:1 verification never loads the whole gallery.
+        """
+        engine = self._engine
+        if engine is None:
+            return load_user_profile_from_db(UserModel, FaceModel, user_id)
+        if self._snapshot_changed():
+            # the check above consumed the throttle window, so reload here
+            # rather than through engine(), which would skip the check
+            with self._lock:
+                if self._engine is None:
+                    self._load(UserModel, FaceModel)
+                elif current_version(self.snapshot_dir) not in (None, self.snapshot_version):
+                    self._load_snapshot()
+                engine = self._engine
+        return engine.profile(user_id)
+
+    def _load_members(self, UserModel):
+        column = getattr(UserModel, self.partition_by)
+        q = UserModel.query.with_entities(UserModel.id, column).filter(column.isnot(None))
+        self._members = {uid: key for uid, key in q.yield_per(1000) if key}
+
+    def _partition(self, key, UserModel):
+        part = self._partitions.get(key)
+        if part is None:
+            if self._members is None:
+                self._load_members(UserModel)
+            uids = [uid for uid, k in self._members.items() if k == key]
+            if not uids:
+                # don't cache engines for arbitrary unknown scope values
+                return MatchEngine(dim=self._engine.dim)
+            start = time.time()
+            part = self._engine.subset(uids)
+            self._partitions[key] = part
+            logger.info("gallery partition %s=%r built: %d users in %.3fs",
+                        self.partition_by, key, len(part), time.time() - start)
+        return part
+
+    def _members_meta(self):
+        # snapshot header entry so other workers get the partition map without a DB query
+        if self._members is None:
+            return {}
+        by_key = {}
+        for uid, key in self._members.items():
+            by_key.setdefault(key, []).append(int(uid))
+        return {'partition_by': self.partition_by, 'partitions': by_key}
+
+    def _snapshot_changed(self):
+        # cheap, throttled check of the CURRENT pointer file
+        if not self.snapshot_dir:
+            return False
+        now = time.time()
+        if now - self._snapshot_checked_at < self.snapshot_check_seconds:
+            return False
+        self._snapshot_checked_at = now
+        return current_version(self.snapshot_dir) not in (None, self.snapshot_version)
+
+    def _load(self, UserModel, FaceModel):
+        if not self.snapshot_dir:
+            self._build(UserModel, FaceModel)
+            return
+        with snapshot_lock(self.snapshot_dir):
+            if current_version(self.snapshot_dir):
+                self._load_snapshot()
+            else:
+                self._build(UserModel, FaceModel)
+
+    def _load_snapshot(self):
+        start = time.time()
+        header, arrays = load_snapshot(self.snapshot_dir)
+        self._engine = MatchEngine.from_arrays(arrays['uids'], arrays['centroids'], arrays['faces'],
+                                               arrays['offsets'], copy=False, **_engine_options())
+        self.snapshot_version = header['version']
+        self._partitions = {}
+        if header.get('partition_by') == self.partition_by:
+            self._members = {uid: key for key, uids in header.get('partitions', {}).items() for uid in uids}
+        else:
+            self._members = None
+        self.build_seconds = time.time() - start
+        self.built_at = time.time()
+        self.updated_at = self.built_at
+        self.load_stats = {'source': 'snapshot', 'users': header['users'], 'faces': header['faces'],
+                           'seconds': self.build_seconds}
+        logger.info("gallery loaded from snapshot %s: %d users, %d faces in %.3fs",
+                    self.snapshot_version, header['users'], header['faces'], self.build_seconds)
+
+    def _write_snapshot(self, arrays):
+        meta = {'pid': os.getpid()}
+        meta.update(self._members_meta())
+        self.snapshot_version = write_snapshot(self.snapshot_dir, arrays, meta=meta)
+
+    def _publish(self):
+        # write the current engine as the new live snapshot
+        if self._engine is None:
+            return
+        if not self.snapshot_dir:
+            rows = self._engine.exact_rows  # the database already has the changes
+        else:
+            self._write_snapshot(self._engine.to_arrays())
+            if not self._engine.quant:
+                return
+            _, arrays = load_snapshot(self.snapshot_dir, self.snapshot_version)
+            rows = ArrayRows(arrays['uids'], arrays['centroids'], arrays['faces'], arrays['offsets'])
+        # quantized engines re-rank from the published rows and drop their float32 copies
+        for engine in [self._engine] + list(self._partitions.values()):
+            engine.set_exact_rows(rows)
+
+    @contextmanager
+    def _synced(self):
+        """Serialize a read-modify-publish cycle across threads and processes."""
+        with self._lock, snapshot_lock(self.snapshot_dir):
+            if self.snapshot_dir and current_version(self.snapshot_dir) not in (None, self.snapshot_version):
+                # pick up other workers' changes first so publishing doesn't drop them
+                self._load_snapshot()
+            before = self.updated_at
+            yield
+            if self._engine is not None and self.updated_at != before:
+                self._publish()
+
+    def _build(self, UserModel, FaceModel):
+        # in snapshot mode the loaded rows are published and mapped back, so
+        # this worker shares them with the others (and re-ranks from them)
+        start = time.time()
+        load_stats = {'source': 'db'}
+        arrays = load_gallery_arrays(UserModel, FaceModel, stats=load_stats)
+        self._load_members(UserModel)
+        if self.snapshot_dir:
+            self._write_snapshot(arrays)
+            del arrays
+            self._load_snapshot()
+            engine = self._engine
+        else:
+            engine = MatchEngine.from_arrays(arrays['uids'], arrays['centroids'], arrays['faces'],
+                                             arrays['offsets'], exact_rows=_db_rows(UserModel, FaceModel),
+                                             **_engine_options())
+            self._partitions = {}
+        self.load_stats = load_stats
+        self.build_seconds = time.time() - start
+        self.built_at = time.time()
+        self.updated_at = self.built_at
+        self._engine = engine
+        logger.info("gallery built: %d users, %d faces in %.3fs (%.0f rows/s)",
+                    len(engine), engine.face_count, self.build_seconds, load_stats.get('rows_per_sec') or 0)
+
+    def rebuild(self, UserModel, FaceModel):
+        """Force a full reload from the database (and republish the snapshot)."""
+        with self._lock, snapshot_lock(self.snapshot_dir):
+            self._build(UserModel, FaceModel)
+
+    def invalidate(self):
+        """Drop the cached profiles; the next reader triggers a full build."""
+        with self._lock:
+            self._engine = None
+            self._members = None
+            self._partitions = {}
+
+    def refresh_user(self, user_id, UserModel, FaceModel):
+        """Reload a single user's profile after its faces or encoding changed.
+
+        No-op while the gallery has not been built yet (the first reader will
+        load everything anyway).
+        """
+        self.refresh_users([user_id], UserModel, FaceModel)
+
+    def refresh_users(self, user_ids, UserModel, FaceModel):
+        """Reload several users' profiles in one update (and one snapshot publish)."""
+        with self._synced():
+            if self._engine is None:
+                return
+            for user_id in user_ids:
+                profile = load_user_profile_from_db(UserModel, FaceModel, user_id)
+                if profile is None:
+                    self._engine.remove(user_id)
+                else:
+                    self._engine.upsert(user_id, profile['avg'], profile['faces'])
+                self._refresh_membership(user_id, profile, UserModel)
+            self._maybe_train_ann()
+            self.updated_at = time.time()
+
+    def _refresh_membership(self, user_id, profile, UserModel):
+        # move the user between partition engines when its department/site changed
+        if self._members is None:
+            self._load_members(UserModel)
+        old = self._members.pop(user_id, None)
+        row = UserModel.query.with_entities(getattr(UserModel, self.partition_by)).filter_by(id=user_id).first()
+        new = row[0] if row else None
+        if new:
+            self._members[user_id] = new
+        if old is not None and old != new and old in self._partitions:
+            self._partitions[old].remove(user_id)
+        if new in self._partitions:
+            if profile is None:
+                self._partitions[new].remove(user_id)
+            else:
+                self._partitions[new].upsert(user_id, profile['avg'], profile['faces'])
+
+    def _maybe_train_ann(self):
+        # train once the gallery crosses the ANN threshold, retrain after heavy growth
+        ann = self._engine.ann
+        if ann is None:
+            return
+        if (not ann.is_trained and len(self._engine) >= self._engine.ann_min_users) or ann.needs_retrain:
+            self._engine.train_ann()
+
+    def remove_user(self, user_id):
+        """Drop a user from the gallery (e.g. after the user was deleted)."""
+        with self._synced():
+            if self._engine is None:
+                return
+            if self._engine.remove(user_id):
+                self.updated_at = time.time()
+            key = self._members.pop(user_id, None) if self._members is not None else None
+            if key in self._partitions:
+                self._partitions[key].remove(user_id)
+
+    def stats(self):
+        """Return build time and size information for monitoring."""
+        engine = self._engine
+        return {
+            'built': engine is not None,
+            'built_at': self.built_at,
+            'build_seconds': self.build_seconds,
+            'updated_at': self.updated_at,
+            'users': len(engine) if engine is not None else 0,
+            'faces': engine.face_count if engine is not None else 0,
+            'load': self.load_stats,
+            'memory': engine.memory_stats() if engine is not None else None,
+            'snapshot': {'dir': self.snapshot_dir, 'version': self.snapshot_version} if self.snapshot_dir else None,
+            'ann': engine.ann.stats() if (engine is not None and engine.ann is not None) else None,
+            'partitions': {
+                'by': self.partition_by,
+                'count': len(set(self._members.values())) if self._members is not None else None,
+                'built': {key: len(part) for key, part in list(self._partitions.items())},
+            },
+        }
+
+
+# Single gallery instance shared by all requests in this process
+gallery = GalleryCache(snapshot_dir=GALLERY_SNAPSHOT_DIR, snapshot_check_seconds=GALLERY_SNAPSHOT_CHECK_SECONDS,
+                       partition_by=GALLERY_PARTITION_BY)
@@ -0,0 +1,653 @@
+"""Vectorized 1:N matching over a contiguous centroid matrix.
+
+`MatchEngine` keeps every user centroid L2-normalized in one float32
+(N x D) array so that all centroid distances come from a single
+matrix-vector product:
+
+    ||q - c||^2 = ||q||^2 + ||c||^2 - 2 q.c
+
+Best and runner-up are picked with `np.argpartition` instead of a full
+sort. The decision rule and the debug dict are the same as the original
+`decide_match` loop (USER_TOL, USER_MARGIN, FACE_TOL); the reported
+distances for the selected users are recomputed directly from the
+difference vectors so logged values do not carry dot-product rounding.
+
+An optional approximate index (see `ann.IVFIndex`) can be attached for
+very large galleries: it proposes top-k candidate users and only those
+candidates are re-ranked exactly, so best/runner-up and the margin rule
+are evaluated on exact distances.
+
+With `quant='float16'` or `quant='int8'` the centroid and face matrices
+are held only in that compact form (see `quant.CompactMatrix`), a half or
+a quarter of the float32 bytes. The full scan runs over the compact
+centroids and the `quant_rerank` closest users are re-ranked with float32
+rows fetched from `exact_rows` (`ArrayRows` over the memory-mapped
+snapshot, or a database lookup), which also supplies the faces for the
+per-face check. Users changed since the source was attached keep a
+float32 copy until `set_exact_rows` is called again.
+
+This module deliberately has no dependency on `face_recognition`/dlib.
+"""
+import logging
+import threading
+
+import numpy as np
+
+from .quant import CompactMatrix
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(m):
+    """Return a float32 copy of `m` with each row L2-normalized (zero rows kept)."""
+    a = np.array(m, dtype=np.float32, ndmin=2)
+    n = np.linalg.norm(a, axis=1, keepdims=True)
+    np.divide(a, n, out=a, where=n > 0)
+    return a
+
+
+class ArrayRows:
+    """Float32 rows of a quantized engine, looked up by user id in gallery arrays.
+
+    The arrays are in the `load_gallery_arrays` layout, normally the
+    read-only memmaps of a snapshot, so a lookup only pages in the rows of
+    the requested users. Calling it with a list of user ids returns
+    `{uid: (centroid, faces)}` for the ids it holds.
+    """
+
+    def __init__(self, uids, centroids, faces, offsets):
+        uids = np.asarray(uids)
+        self._order = np.argsort(uids, kind='stable')
+        self._sorted = uids[self._order]
+        self.centroids = centroids
+        self.faces = faces
+        self.offsets = offsets
+
+    def __call__(self, uids):
+        out = {}
+        if not uids or not self._sorted.shape[0]:
+            return out
+        pos = np.minimum(np.searchsorted(self._sorted, np.asarray(uids)), self._sorted.shape[0] - 1)
+        for uid, p in zip(uids, pos.tolist()):
+            if self._sorted[p] != uid:
+                continue
+            i = int(self._order[p])
+            out[uid] = (np.array(self.centroids[i], dtype=np.float32),
+                        np.array(self.faces[self.offsets[i]:self.offsets[i + 1]], dtype=np.float32))
+        return out
+
+
+class MatchEngine:
+    """Contiguous centroid matrix plus per-user face matrices.
+
+    Rows are assigned in insertion order; removing a user moves the last
+    row into the freed slot so the live rows stay contiguous. All public
+    methods are thread-safe.
+
+    When `ann` is given it is kept in sync with the centroids and used for
+    candidate search once trained and the gallery holds at least
+    `ann_min_users` users.
+
+    With `quant`, `exact_rows(uids)` must return `{uid: (centroid, faces)}`
+    float32 rows for re-ranking; users it does not return are re-ranked
+    with their decoded compact rows.
+    """
+
+    def __init__(self, dim=None, ann=None, ann_min_users=0, ann_top_k=10, quant=None, quant_rerank=16,
+                 exact_rows=None):
+        self.dim = dim
+        self.ann = ann
+        self.ann_min_users = ann_min_users
+        self.ann_top_k = ann_top_k
+        self.quant = quant or None
+        self.quant_rerank = max(int(quant_rerank), 2)
+        self.exact_rows = exact_rows
+        self._compact = None
+        self._face_codec = None
+        self._changed = {}
+        self._lock = threading.RLock()
+        self._n = 0
+        self._uids = []
+        self._rows = {}
+        self._centroids = np.zeros((0, dim or 0), dtype=np.float32)
+        self._sqnorms = np.zeros(0, dtype=np.float32)
+        self._faces = {}
+
+    @classmethod
+    def from_profiles(cls, profiles, **kwargs):
+        """Build an engine from a `{uid: {'avg': vec, 'faces': [vec, ...]}}` dict."""
+        if not profiles:
+            return cls(**kwargs)
+        uids = list(profiles)
+        centroids = normalize_rows(np.stack([np.asarray(profiles[uid]['avg'], dtype=np.float32).ravel()
+                                             for uid in uids]))
+        dim = centroids.shape[1]
+        blocks = [normalize_rows(np.stack([np.asarray(f, dtype=np.float32) for f in profiles[uid]['faces']]))
+                  if len(profiles[uid]['faces']) else np.zeros((0, dim), dtype=np.float32) for uid in uids]
+        offsets = np.zeros(len(uids) + 1, dtype=np.int64)
+        np.cumsum([b.shape[0] for b in blocks], out=offsets[1:])
+        return cls.from_arrays(uids, centroids, np.concatenate(blocks), offsets, copy=False, **kwargs)
+
+    @classmethod
+    def from_arrays(cls, uids, centroids, faces, offsets, copy=True, **kwargs):
+        """Build an engine in bulk from `face_utils.load_gallery_arrays` output.
+
+        `centroids` and `faces` must already be L2-normalized; per-user face
+        matrices are views into `faces`. With `copy=False` the centroid
+        matrix is used as given (e.g. a read-only memmap of a snapshot) and
+        only copied on the first in-place update.
+
+        A quantized engine keeps only compact copies; unless `exact_rows` is
+        given it re-ranks from the arrays passed in, so pass memmaps there.
+        """
+        kwargs.setdefault('dim', centroids.shape[1] if centroids.shape[0] else None)
+        engine = cls(**kwargs)
+        n = centroids.shape[0]
+        if engine.quant and engine.exact_rows is None:
+            engine.exact_rows = ArrayRows(uids, centroids, faces, offsets)
+        if n:
+            if engine.quant:
+                # only read by fit_quant, which replaces them with compact rows
+                engine._centroids = centroids
+            else:
+                engine._centroids = np.array(centroids, dtype=np.float32) if copy else centroids
+            engine._sqnorms = np.einsum('ij,ij->i', centroids, centroids).astype(np.float32)
+            engine._uids = list(uids.tolist() if hasattr(uids, 'tolist') else uids)
+            engine._rows = {uid: row for row, uid in enumerate(engine._uids)}
+            engine._faces = {uid: faces[offsets[row]:offsets[row + 1]] for row, uid in enumerate(engine._uids)}
+            engine._n = n
+        engine.fit_quant()
+        if engine.ann is not None and n >= max(engine.ann_min_users, 1):
+            engine.train_ann()
+        return engine
+
+    def to_arrays(self):
+        """Export the engine in the `load_gallery_arrays` layout (copies).
+
+        A quantized engine exports the float32 rows of `exact_rows`.
+        """
+        if self._compact is not None:
+            return self._exact_arrays()
+        with self._lock:
+            n = self._n
+            dim = self.dim or 0
+            face_mats = [self._faces[uid] for uid in self._uids]
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            if n:
+                np.cumsum([f.shape[0] for f in face_mats], out=offsets[1:])
+            return {
+                'uids': np.array(self._uids, dtype=np.int64),
+                'centroids': np.array(self._centroids[:n], dtype=np.float32).reshape(n, dim),
+                'faces': (np.concatenate(face_mats).astype(np.float32, copy=False)
+                          if face_mats else np.zeros((0, dim), dtype=np.float32)),
+                'offsets': offsets,
+            }
+
+    def _exact_arrays(self, chunk=1000):
+        with self._lock:
+            uids = list(self._uids)
+            dim = self.dim or 0
+        exact = {}
+        for i in range(0, len(uids), chunk):
+            exact.update(self._exact(uids[i:i + chunk]))
+        uids = [u for u in uids if u in exact]
+        offsets = np.zeros(len(uids) + 1, dtype=np.int64)
+        if uids:
+            np.cumsum([exact[u][1].shape[0] for u in uids], out=offsets[1:])
+        return {
+            'uids': np.array(uids, dtype=np.int64),
+            'centroids': (np.stack([exact[u][0] for u in uids]).astype(np.float32, copy=False)
+                          if uids else np.zeros((0, dim), dtype=np.float32)),
+            'faces': (np.concatenate([exact[u][1] for u in uids]).astype(np.float32, copy=False)
+                      if uids else np.zeros((0, dim), dtype=np.float32)),
+            'offsets': offsets,
+        }
+
+    def subset(self, uids, **kwargs):
+        """Return a new engine holding copies of the rows of `uids` (unknown ids skipped).
+
+        The copy keeps this engine's quantization mode (and row source);
+        `kwargs` go to the constructor (e.g. an ANN index for a very large
+        subset).
+        """
+        if self._compact is not None:
+            return self._compact_subset(uids, **kwargs)
+        with self._lock:
+            keep = [u for u in uids if u in self._rows]
+            rows = np.array([self._rows[u] for u in keep], dtype=np.int64)
+            face_mats = [self._faces[u] for u in keep]
+            dim = self.dim or 0
+            offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+            if keep:
+                np.cumsum([f.shape[0] for f in face_mats], out=offsets[1:])
+            centroids = self._centroids[rows] if keep else np.zeros((0, dim), dtype=np.float32)
+            faces = np.concatenate(face_mats) if face_mats else np.zeros((0, dim), dtype=np.float32)
+        kwargs.setdefault('quant', self.quant)
+        kwargs.setdefault('quant_rerank', self.quant_rerank)
+        engine = type(self).from_arrays(keep, centroids, faces, offsets, **kwargs)
+        if engine.dim is None:
+            engine.dim = self.dim
+        return engine
+
+    def _compact_subset(self, uids, **kwargs):
+        kwargs.setdefault('quant_rerank', self.quant_rerank)
+        kwargs.setdefault('exact_rows', self.exact_rows)
+        engine = type(self)(dim=self.dim, quant=self.quant, **kwargs)
+        with self._lock:
+            keep = [u for u in uids if u in self._rows]
+            rows = np.array([self._rows[u] for u in keep], dtype=np.int64)
+            engine._compact = CompactMatrix(self.quant, self.dim, capacity=len(keep), scale=self._compact.scale)
+            engine._compact.codes[:len(keep)] = self._compact.codes[rows]
+            # face codes are never written in place, so the subset shares them
+            engine._face_codec = self._face_codec
+            engine._faces = {u: self._faces[u] for u in keep}
+            engine._changed = {u: self._changed[u] for u in keep if u in self._changed}
+            engine._sqnorms = self._sqnorms[rows].copy()
+        engine._centroids = None
+        engine._uids = keep
+        engine._rows = {uid: row for row, uid in enumerate(keep)}
+        engine._n = len(keep)
+        if engine.ann is not None and engine._n >= max(engine.ann_min_users, 1):
+            engine.train_ann()
+        return engine
+
+    def fit_quant(self):
+        """Move the float32 centroid and face rows into compact storage.
+
+        int8 scales are fitted on the current rows; the float32 matrices
+        are released afterwards (re-ranking reads `exact_rows`). No-op
+        without `quant` or once the engine is compact.
+        """
+        with self._lock:
+            if not self.quant or not self.dim or self._compact is not None:
+                return
+            n = self._n
+            self._compact = CompactMatrix.from_matrix(self.quant, self._centroids[:n],
+                                                      capacity=max(self._centroids.shape[0], n))
+            blocks = [self._faces[uid] for uid in self._uids]
+            total = sum(b.shape[0] for b in blocks)
+            scale = None
+            if self.quant == 'int8' and total:
+                peak = np.zeros(self.dim, dtype=np.float32)
+                for b in blocks:
+                    if b.shape[0]:
+                        np.maximum(peak, np.abs(b).max(axis=0), out=peak)
+                scale = np.maximum(peak, 1e-6) / 127.0
+            self._face_codec = CompactMatrix(self.quant, self.dim, scale=scale)
+            codes = np.empty((total, self.dim), dtype=self._face_codec.codes.dtype)
+            pos = 0
+            for uid, b in zip(self._uids, blocks):
+                codes[pos:pos + b.shape[0]] = self._face_codec.encode(b)
+                self._faces[uid] = codes[pos:pos + b.shape[0]]
+                pos += b.shape[0]
+            self._centroids = None
+
+    def set_exact_rows(self, exact_rows):
+        """Attach the float32 row source of a quantized engine.
+
+        The source must reflect every change applied so far (e.g. the
+        snapshot just published); the float32 copies kept for users changed
+        since the previous source are dropped.
+        """
+        with self._lock:
+            self.exact_rows = exact_rows
+            self._changed = {}
+
+    def memory_stats(self):
+        """Bytes held by the centroid, compact and face matrices.
+
+        `resident_bytes` is what the engine holds in process memory; rows
+        memory-mapped from a snapshot live in the shared page cache and
+        are not counted.
+        """
+        with self._lock:
+            centroids = self._centroids
+            mapped = isinstance(centroids, np.memmap)
+            faces = list(self._faces.values())
+            stats = {
+                'quant': self.quant,
+                'centroids_bytes': int(centroids[:self._n].nbytes) if centroids is not None else 0,
+                'centroids_mapped': mapped,
+                'compact_bytes': int(self._compact.nbytes) if self._compact is not None else 0,
+                'faces_bytes': int(sum(f.nbytes for f in faces)),
+                'faces_dtype': str(faces[0].dtype) if faces else None,
+                'changed_bytes': int(sum(a.nbytes + f.nbytes for a, f in self._changed.values())),
+            }
+            stats['resident_bytes'] = int(
+                (centroids.nbytes if centroids is not None and not mapped else 0)
+                + stats['compact_bytes'] + self._sqnorms.nbytes + stats['changed_bytes']
+                + sum(f.nbytes for f in faces if not isinstance(f, np.memmap)))
+            return stats
+
+    def train_ann(self):
+        """(Re)train the attached ANN index on the current centroids."""
+        with self._lock:
+            if self.ann is not None and self._n:
+                X = self._centroids[:self._n] if self._compact is None else self._compact.decode(np.arange(self._n))
+                self.ann.train(list(self._uids), X)
+
+    def _use_ann(self):
+        return self.ann is not None and self.ann.is_trained and self._n >= self.ann_min_users
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, uid):
+        return uid in self._rows
+
+    @property
+    def uids(self):
+        with self._lock:
+            return list(self._uids)
+
+    @property
+    def face_count(self):
+        with self._lock:
+            return sum(f.shape[0] for f in self._faces.values())
+
+    def _ensure_capacity(self, n):
+        if self._compact is not None:
+            cap = self._compact.codes.shape[0]
+            if n > cap:
+                new_cap = max(n, cap * 2, 64)
+                self._compact.resize(new_cap)
+                sqnorms = np.zeros(new_cap, dtype=np.float32)
+                sqnorms[:self._n] = self._sqnorms[:self._n]
+                self._sqnorms = sqnorms
+            return
+        cap = self._centroids.shape[0]
+        if n <= cap:
+            if not self._centroids.flags.writeable:
+                # first write to a memmapped snapshot: switch to a private copy
+                self._centroids = np.array(self._centroids, dtype=np.float32)
+            return
+        new_cap = max(n, cap * 2, 64)
+        centroids = np.zeros((new_cap, self.dim), dtype=np.float32)
+        centroids[:self._n] = self._centroids[:self._n]
+        sqnorms = np.zeros(new_cap, dtype=np.float32)
+        sqnorms[:self._n] = self._sqnorms[:self._n]
+        self._centroids = centroids
+        self._sqnorms = sqnorms
+
+    def upsert(self, uid, avg, faces=()):
+        """Insert or replace the centroid and face vectors of `uid`."""
+        avg = normalize_rows(avg)[0]
+        with self._lock:
+            if self.dim is None:
+                self.dim = avg.shape[0]
+                self._centroids = np.zeros((0, self.dim), dtype=np.float32)
+            if self.quant and self._compact is None:
+                self.fit_quant()
+            if avg.shape[0] != self.dim:
+                raise ValueError(f'expected {self.dim}-d centroid, got {avg.shape[0]}-d')
+            if len(faces):
+                face_mat = normalize_rows(np.stack([np.asarray(f, dtype=np.float32) for f in faces]))
+            else:
+                face_mat = np.zeros((0, self.dim), dtype=np.float32)
+            row = self._rows.get(uid)
+            self._ensure_capacity(self._n + (row is None))
+            if row is None:
+                row = self._n
+                self._rows[uid] = row
+                self._uids.append(uid)
+                self._n += 1
+            self._sqnorms[row] = float(np.dot(avg, avg))
+            if self._compact is not None:
+                self._compact.set_row(row, avg)
+                self._faces[uid] = self._face_codec.encode(face_mat)
+                # float32 copy for re-ranking until the row source catches up
+                self._changed[uid] = (avg, face_mat)
+            else:
+                self._centroids[row] = avg
+                self._faces[uid] = face_mat
+            if self.ann is not None:
+                self.ann.add(uid, avg)
+
+    def remove(self, uid):
+        """Remove `uid` if present. Returns True when a row was removed."""
+        with self._lock:
+            row = self._rows.pop(uid, None)
+            if row is None:
+                return False
+            self._ensure_capacity(self._n)
+            last = self._n - 1
+            if row != last:
+                moved = self._uids[last]
+                if self._compact is not None:
+                    self._compact.move_row(last, row)
+                else:
+                    self._centroids[row] = self._centroids[last]
+                self._sqnorms[row] = self._sqnorms[last]
+                self._uids[row] = moved
+                self._rows[moved] = row
+            self._uids.pop()
+            self._faces.pop(uid, None)
+            self._changed.pop(uid, None)
+            self._n = last
+            if self.ann is not None:
+                self.ann.remove(uid)
+            return True
+
+    def profile(self, uid):
+        """Return `{'avg': vec, 'faces': (k, D) array}` for `uid`, or None.
+
+        A quantized engine returns the float32 rows of `exact_rows`.
+        """
+        with self._lock:
+            row = self._rows.get(uid)
+            if row is None:
+                return None
+            if self._compact is None:
+                return {'avg': self._centroids[row].copy(), 'faces': self._faces[uid]}
+        exact = self._exact([uid]).get(uid)
+        return {'avg': exact[0], 'faces': exact[1]} if exact is not None else None
+
+    def _exact(self, uids):
+        """float32 `{uid: (centroid, faces)}` of a quantized engine's users.
+
+        Users changed since `exact_rows` was attached come from their
+        float32 copies, the rest from `exact_rows` (called without holding
+        the lock); users it does not return fall back to their decoded
+        compact rows. Removed users are left out.
+        """
+        with self._lock:
+            out = {u: self._changed[u] for u in uids if u in self._changed}
+            rest = [u for u in uids if u not in out and u in self._rows]
+            source = self.exact_rows
+        if rest and source is not None:
+            try:
+                found = source(rest)
+            except Exception:
+                logger.exception("exact row lookup failed; re-ranking with compact rows")
+                found = {}
+            out.update((u, found[u]) for u in rest if u in found)
+        missing = [u for u in rest if u not in out]
+        if missing:
+            with self._lock:
+                for u in missing:
+                    row = self._rows.get(u)
+                    if row is not None:
+                        out[u] = (self._compact.decode([row])[0], self._face_codec.decode_codes(self._faces[u]))
+        return out
+
+    def centroid_distances(self, q):
+        """Euclidean distances from normalized query `q` to every centroid.
+
+        Computed from the compact rows in a quantized engine.
+        """
+        with self._lock:
+            n = self._n
+            dots = self._compact.dots(q, n) if self._compact is not None else self._centroids[:n] @ q
+            d2 = self._sqnorms[:n] - 2.0 * dots
+        d2 += np.dot(q, q)
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2)
+
+    def _rerank(self, rows, q):
+        """Exact float32 re-rank of candidate rows; returns (best_row, runner_up_row or None)."""
+        d = np.linalg.norm(self._centroids[rows] - q, axis=1)
+        order = np.lexsort((rows, d))[:2]
+        return int(rows[order[0]]), (int(rows[order[1]]) if order.size > 1 else None)
+
+    def _select(self, q, exact=False):
+        """Return (best_row, runner_up_row or None) for normalized query `q`."""
+        if not exact and self._use_ann():
+            rows = np.array([self._rows[u] for u in self.ann.search(q, self.ann_top_k) if u in self._rows],
+                            dtype=np.int64)
+            if rows.size:
+                return self._rerank(rows, q)
+        if self._n == 1:
+            return 0, None
+        d = self.centroid_distances(q)
+        pair = np.argpartition(d, 1)[:2]
+        best_row, runner_row = sorted(pair.tolist(), key=lambda r: (d[r], r))
+        return best_row, runner_row
+
+    def decide(self, query_vec, USER_TOL=0.45, USER_MARGIN=0.15, FACE_TOL=0.55, exact=False):
+        """Vectorized equivalent of `face_utils.decide_match`.
+
+        `exact=True` bypasses the ANN index and compact scan when configured
+        (a quantized engine then re-ranks every user from `exact_rows`).
+        """
+        q = normalize_rows(query_vec)[0]
+        if self._compact is not None:
+            return self._decide_compact(q, USER_TOL, USER_MARGIN, FACE_TOL, exact)
+        with self._lock:
+            if self._n == 0:
+                return False, {'error': 'no user profiles'}
+            best_row, runner_row = self._select(q, exact=exact)
+            best_uid = self._uids[best_row]
+            best_d = float(np.linalg.norm(q - self._centroids[best_row]))
+            if runner_row is not None:
+                runner_up_d = float(np.linalg.norm(q - self._centroids[runner_row]))
+            else:
+                runner_up_d = float('inf')
+            faces = self._faces[best_uid]
+        if faces.shape[0]:
+            per_face = np.linalg.norm(faces - q, axis=1)
+        else:
+            per_face = None
+        return self._result(best_uid, best_d, runner_up_d, per_face, USER_TOL, USER_MARGIN, FACE_TOL)
+
+    def _decide_compact(self, q, USER_TOL, USER_MARGIN, FACE_TOL, exact):
+        # candidates from the compact scan (or ANN), float32 re-rank and per-face check from exact_rows
+        with self._lock:
+            n = self._n
+            if n == 0:
+                return False, {'error': 'no user profiles'}
+            rows = np.arange(n) if exact or n <= self.quant_rerank else None
+            if rows is None and self._use_ann():
+                rows = np.array([self._rows[u] for u in self.ann.search(q, self.ann_top_k) if u in self._rows],
+                                dtype=np.int64)
+            if rows is None or not rows.size:
+                d2 = self._sqnorms[:n] - 2.0 * self._compact.dots(q, n)
+                rows = np.argpartition(d2, self.quant_rerank - 1)[:self.quant_rerank]
+            candidates = [(int(r), self._uids[r]) for r in rows]
+        exact_rows = self._exact([uid for _, uid in candidates])
+        scored = sorted((float(np.linalg.norm(q - exact_rows[uid][0])), row, uid)
+                        for row, uid in candidates if uid in exact_rows)
+        if not scored:
+            return False, {'error': 'no user profiles'}
+        best_d, _, best_uid = scored[0]
+        runner_up_d = scored[1][0] if len(scored) > 1 else float('inf')
+        faces = exact_rows[best_uid][1]
+        per_face = np.linalg.norm(faces - q, axis=1) if faces.shape[0] else None
+        return self._result(best_uid, best_d, runner_up_d, per_face, USER_TOL, USER_MARGIN, FACE_TOL)
+
+    @staticmethod
+    def _result(best_uid, best_d, runner_up_d, per_face, USER_TOL, USER_MARGIN, FACE_TOL):
+        """Apply the decision rule and build the debug dict for one query."""
+        margin = runner_up_d - best_d
+
+        # per-face verification
+        if per_face is None or not per_face.shape[0]:
+            per_face = np.array([np.inf], dtype=np.float32)
+        per_face_min = float(per_face.min())
+        top3 = np.partition(per_face, 2)[:3] if per_face.shape[0] > 3 else per_face
+        per_face_dists_top3 = sorted(float(x) for x in top3)
+
+        accepted = (best_d <= USER_TOL) and (margin >= USER_MARGIN) and (per_face_min <= FACE_TOL)
+
+        debug = {
+            'best_uid': best_uid,
+            'best_d': best_d,
+            'runner_up_d': runner_up_d,
+            'margin': margin,
+            'per_face_min': per_face_min,
+            'per_face_dists_top3': per_face_dists_top3,
+            'accepted': accepted
+        }
+        return accepted, debug
+
+    def decide_many(self, query_mat, USER_TOL=0.45, USER_MARGIN=0.15, FACE_TOL=0.55, exact=False, chunk=256):
+        """Batched `decide` for a Q x D matrix of query embeddings.
+
+        Centroid distances for a chunk of queries come from one matrix
+        product; per-face verification is done once per distinct best user
+        for all queries that picked that user. Returns a list with one
+        `(accepted, debug)` pair per query, in input order.
+        """
+        Q = normalize_rows(query_mat)
+        if self._compact is not None:
+            # candidate sets differ per query; re-rank each one
+            return [self.decide(q, USER_TOL, USER_MARGIN, FACE_TOL, exact=exact) for q in Q]
+        with self._lock:
+            if self._n == 0:
+                return [(False, {'error': 'no user profiles'}) for _ in range(Q.shape[0])]
+            if not exact and self._use_ann():
+                return [self.decide(q, USER_TOL, USER_MARGIN, FACE_TOL) for q in Q]
+            n = self._n
+            C = self._centroids[:n]
+            best_rows = np.empty(Q.shape[0], dtype=np.int64)
+            runner_rows = np.full(Q.shape[0], -1, dtype=np.int64)
+            for i in range(0, Q.shape[0], chunk):
+                Qc = Q[i:i + chunk]
+                d2 = self._sqnorms[:n][None, :] - 2.0 * (Qc @ C.T)
+                if n == 1:
+                    best_rows[i:i + chunk] = 0
+                    continue
+                pair = np.argpartition(d2, 1, axis=1)[:, :2]
+                pd = np.take_along_axis(d2, pair, axis=1)
+                # order the two candidates by (distance, row) like the scalar path
+                swap = (pd[:, 1] < pd[:, 0]) | ((pd[:, 1] == pd[:, 0]) & (pair[:, 1] < pair[:, 0]))
+                pair[swap] = pair[swap][:, ::-1]
+                best_rows[i:i + chunk] = pair[:, 0]
+                runner_rows[i:i + chunk] = pair[:, 1]
+
+            best_d = np.linalg.norm(Q - C[best_rows], axis=1)
+            has_runner = runner_rows >= 0
+            runner_d = np.full(Q.shape[0], np.inf)
+            if has_runner.any():
+                runner_d[has_runner] = np.linalg.norm(Q[has_runner] - C[runner_rows[has_runner]], axis=1)
+
+            # bulk per-face verification grouped by best user
+            per_face = [None] * Q.shape[0]
+            for row in np.unique(best_rows):
+                idx = np.flatnonzero(best_rows == row)
+                faces = self._faces[self._uids[row]]
+                if faces.shape[0]:
+                    dists = np.linalg.norm(Q[idx][:, None, :] - faces[None, :, :], axis=2)
+                    for j, qi in enumerate(idx):
+                        per_face[qi] = dists[j]
+            best_uids = [self._uids[r] for r in best_rows]
+
+        return [
+            self._result(best_uids[i], float(best_d[i]), float(runner_d[i]), per_face[i],
+                         USER_TOL, USER_MARGIN, FACE_TOL)
+            for i in range(Q.shape[0])
+        ]
+
+
+def verify_profile(uid, avg, faces, query_vec, VERIFY_TOL=0.45, FACE_TOL=0.55):
+    """1:1 verification of a query against one user's centroid and faces.
+
+    Accepts when the centroid distance is within VERIFY_TOL and the closest
+    face within FACE_TOL. There is no runner-up in a 1:1 comparison, so the
+    debug dict reports `runner_up_d` and `margin` as infinity.
+    """
+    q = normalize_rows(query_vec)[0]
+    avg = normalize_rows(avg)[0]
+    faces = np.asarray(faces, dtype=np.float32).reshape(-1, q.shape[0])
+    best_d = float(np.linalg.norm(q - avg))
+    per_face = np.linalg.norm(normalize_rows(faces) - q, axis=1) if faces.shape[0] else None
+    return MatchEngine._result(uid, best_d, float('inf'), per_face, VERIFY_TOL, 0.0, FACE_TOL)
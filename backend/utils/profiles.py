@@ -0,0 +1,85 @@
+"""Named recognition profiles trading latency for accuracy.
+
+A profile bundles the detection/encoding knobs of
+`face_utils.detect_and_encode` plus the blur threshold and minimum face
+height checked around it:
+
+  fast      kiosks: close-range faces (at least 200px tall), HOG without
+            upsampling on a small copy, never CNN, 5-point landmarks, more
+            lenient blur check
+  balanced  the deployment defaults (FACE_DETECT_* / FACE_ENCODE_FACE_PX /
+            QUALITY_BLUR_THRESHOLD / MIN_FACE_HEIGHT_PX environment variables)
+  accurate  larger detection copy with one upsample, CNN escalation
+            whenever the detector exists
+
+Probes are compared with embeddings enrolled under the deployment's
+encoder settings. Changing the landmark model or the jitter count moves an
+embedding by 0.07-0.13 on the same image (as much as a different photo of
+the person), so every profile keeps 5-point landmarks and one jitter; the
+fast profile's smaller encoder crop moves it by about 0.03.
+
+`None` means "use the deployment default". The deployment picks its
+profile with RECOGNITION_PROFILE; requests may override it with
+`?profile=<name>`.
+"""
+import os
+
+PROFILES = {
+    'fast': {
+        'model': 'hog',
+        'upsample': 0,
+        'max_side': 640,
+        'cnn': 'off',
+        'encode_face_px': 160,
+        'num_jitters': 1,
+        'landmarks': 'small',
+        # face-crop scale (see quality.QUALITY_BLUR_THRESHOLD)
+        'blur_threshold': 80.0,
+        # the detection copy may only shrink until this face height reaches
+        # the detector's minimum, so it bounds the cost of the HOG scan
+        'min_face_px': 200,
+    },
+    'balanced': {
+        'model': None,
+        'upsample': None,
+        'max_side': None,
+        'cnn': None,
+        'encode_face_px': None,
+        'num_jitters': 1,
+        'landmarks': 'small',
+        'blur_threshold': None,
+        'min_face_px': None,
+    },
+    'accurate': {
+        'model': 'hog',
+        'upsample': 1,
+        'max_side': 1600,
+        'cnn': 'auto',
+        'encode_face_px': None,
+        'num_jitters': 1,
+        'landmarks': 'small',
+        'blur_threshold': None,
+        'min_face_px': None,
+    },
+}
+
+DEFAULT_PROFILE = os.getenv('RECOGNITION_PROFILE', 'balanced')
+
+# profile keys that are `detect_and_encode` keyword arguments
+_DETECT_KEYS = ('model', 'upsample', 'max_side', 'cnn', 'encode_face_px', 'num_jitters', 'landmarks')
+
+
+def get_profile(name=None):
+    """Return the profile `name` (default: RECOGNITION_PROFILE) with its 'name' set.
+
+    Raises KeyError for an unknown name.
+    """
+    name = (name or DEFAULT_PROFILE).lower()
+    profile = dict(PROFILES[name])
+    profile['name'] = name
+    return profile
+
+
+def detect_kwargs(profile):
+    """`detect_and_encode` keyword arguments of a profile (deployment defaults omitted)."""
+    return {k: profile[k] for k in _DETECT_KEYS if profile.get(k) is not None}
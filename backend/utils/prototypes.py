@@ -0,0 +1,215 @@
+"""Per-user prototype faces (k-medoids over the active face embeddings).
+
+One averaged centroid per user blurs glasses/no-glasses and lighting
+variants together, so the decision rule falls back on the per-face check,
+which compares the query with every active face of the best user. Instead
+each user keeps USER_PROTOTYPES medoids of their active faces
+(`users.prototypes_bin`, a packed k x D float32 matrix): the gallery puts
+the prototypes where the user's faces used to be, so the per-face check
+costs at most k comparisons per user whatever the number of photos.
+Medoids are real face embeddings, so FACE_TOL keeps its meaning.
+
+Prototypes are refreshed for a user whenever their active faces change
+(enroll, delete, template cap). `flask --app manage gallery recluster`
+recomputes everyone's in parallel and reports how many match decisions
+change. Users with at most k active faces need no prototypes (the column
+stays NULL and all their faces are used).
+
+Prototypes are off by default (USER_PROTOTYPES=0): matching against k
+medoids instead of every face changes accept/reject decisions. To opt in,
+set USER_PROTOTYPES (3 is a good start) in every worker and run
+`recluster` once to compute them for the users enrolled before.
+"""
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .embedding import decode_stored, pack_embedding, unpack_embedding
+
+logger = logging.getLogger(__name__)
+
+# Prototypes kept per user (0 = match against every active face)
+USER_PROTOTYPES = int(os.getenv('USER_PROTOTYPES', 0))
+# Iteration limit of the k-medoids alternation
+PROTOTYPE_MAX_ITER = int(os.getenv('PROTOTYPE_MAX_ITER', 20))
+
+
+def kmedoids(X, k, max_iter=None):
+    """Indices of `k` medoids of the rows of `X` (Euclidean).
+
+    Deterministic: starts from the overall medoid plus farthest points,
+    then alternates assignment and per-cluster medoid update until the
+    medoids stop changing.
+    """
+    n = X.shape[0]
+    if n <= k:
+        return list(range(n))
+    max_iter = PROTOTYPE_MAX_ITER if max_iter is None else max_iter
+    sq = np.einsum('ij,ij->i', X, X)
+    D = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2.0 * (X @ X.T), 0.0))
+    medoids = [int(np.argmin(D.sum(axis=1)))]
+    while len(medoids) < k:
+        nearest = D[:, medoids].min(axis=1)
+        nearest[medoids] = -1.0
+        medoids.append(int(np.argmax(nearest)))
+    medoids = np.array(medoids)
+    for _ in range(max_iter):
+        labels = np.argmin(D[:, medoids], axis=1)
+        updated = medoids.copy()
+        for c in range(k):
+            members = np.flatnonzero(labels == c)
+            if members.size:
+                updated[c] = members[np.argmin(D[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(np.sort(updated), np.sort(medoids)):
+            break
+        medoids = updated
+    return sorted(int(m) for m in medoids)
+
+
+def compute_prototypes(vecs, k=None):
+    """(k, D) float32 prototype matrix of `vecs`, or None when all of them are needed."""
+    k = USER_PROTOTYPES if k is None else k
+    if k <= 0 or len(vecs) <= k:
+        return None
+    X = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    X = X / np.where(norms > 0, norms, 1.0)
+    return np.ascontiguousarray(X[kmedoids(X, k)])
+
+
+def unpack_prototypes(buf, dim):
+    """Decode `users.prototypes_bin` into a (k, dim) float32 matrix."""
+    return unpack_embedding(buf).reshape(-1, dim)
+
+
+def _active_vecs(user_id, FaceModel):
+    q = FaceModel.query.with_entities(FaceModel.embedding, FaceModel.embedding_bin).filter_by(user_id=user_id)
+    vecs = []
+    for emb, emb_bin in q.filter(FaceModel.archived_at.is_(None)).order_by(FaceModel.id):
+        raw = emb_bin if emb_bin is not None else emb
+        if raw is not None:
+            vecs.append(decode_stored(raw))
+    return vecs
+
+
+def refresh_user_prototypes(user, FaceModel, k=None):
+    """Recompute `user.prototypes_bin` from the user's active faces; the caller commits."""
+    protos = compute_prototypes(_active_vecs(user.id, FaceModel), k)
+    user.prototypes_bin = pack_embedding(protos) if protos is not None else None
+    return protos
+
+
+def _cluster_batch(batch, k):
+    # runs in a worker process: [(uid, (n, D) array), ...] -> [(uid, (k, D) array or None), ...]
+    return [(uid, compute_prototypes(mat, k)) for uid, mat in batch]
+
+
+def _user_batches(FaceModel, batch_users, batch_size, user_ids=None):
+    """Yield lists of (user_id, active face matrix), streaming faces ordered by user."""
+    q = FaceModel.query.with_entities(FaceModel.user_id, FaceModel.embedding, FaceModel.embedding_bin)
+    q = q.filter(FaceModel.archived_at.is_(None))
+    if user_ids is not None:
+        q = q.filter(FaceModel.user_id.in_(list(user_ids)))
+    batch, cur, vecs = [], None, []
+    for fuid, emb, emb_bin in q.order_by(FaceModel.user_id, FaceModel.id).yield_per(batch_size):
+        if fuid != cur:
+            if vecs:
+                batch.append((cur, np.stack(vecs)))
+                if len(batch) >= batch_users:
+                    yield batch
+                    batch = []
+            cur, vecs = fuid, []
+        raw = emb_bin if emb_bin is not None else emb
+        if raw is not None:
+            vecs.append(np.asarray(decode_stored(raw), dtype=np.float32))
+    if vecs:
+        batch.append((cur, np.stack(vecs)))
+    if batch:
+        yield batch
+
+
+def recluster_all(UserModel, FaceModel, session, k=None, workers=None, batch_users=200, batch_size=1000,
+                  user_ids=None):
+    """Recompute the prototypes of every user (or `user_ids`) with `workers` processes.
+
+    Faces are streamed once, ordered by user; batches of `batch_users`
+    users are clustered in a process pool and written back (one commit per
+    batch). Users without active faces get their prototypes cleared.
+    Returns `{'users': n, 'with_prototypes': n, 'faces': n}`.
+    """
+    k = USER_PROTOTYPES if k is None else k
+    workers = workers or os.cpu_count() or 1
+    result = {'users': 0, 'with_prototypes': 0, 'faces': 0}
+    seen = set()
+
+    def store(done):
+        users = {u.id: u for u in UserModel.query.filter(UserModel.id.in_([uid for uid, _ in done]))}
+        for uid, protos in done:
+            user = users.get(uid)
+            if user is None:
+                continue
+            user.prototypes_bin = pack_embedding(protos) if protos is not None else None
+            result['users'] += 1
+            result['with_prototypes'] += protos is not None
+        session.commit()
+
+    batches = _user_batches(FaceModel, batch_users, batch_size, user_ids)
+    if workers <= 1:
+        for batch in batches:
+            seen.update(uid for uid, _ in batch)
+            result['faces'] += sum(m.shape[0] for _, m in batch)
+            store(_cluster_batch(batch, k))
+    else:
+        ctx = multiprocessing.get_context(os.getenv('RECOGNITION_POOL_START', 'spawn'))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+            pending = []
+            for batch in batches:
+                seen.update(uid for uid, _ in batch)
+                result['faces'] += sum(m.shape[0] for _, m in batch)
+                pending.append(ex.submit(_cluster_batch, batch, k))
+                if len(pending) >= 2 * workers:
+                    store(pending.pop(0).result())
+            for fut in pending:
+                store(fut.result())
+
+    # users whose faces were all archived or deleted
+    stale = UserModel.query.filter(UserModel.prototypes_bin.isnot(None))
+    if user_ids is not None:
+        stale = stale.filter(UserModel.id.in_(list(user_ids)))
+    for user in stale:
+        if user.id not in seen:
+            user.prototypes_bin = None
+            result['users'] += 1
+    session.commit()
+    return result
+
+
+def compare_decisions(before, after, queries, labels, USER_TOL=0.45, USER_MARGIN=0.15, FACE_TOL=0.55):
+    """How the decisions for `queries` (true user ids `labels`) differ between two engines.
+
+    Returns counts of accepted / correctly accepted queries before and
+    after, decisions that changed (accept flag or accepted user), the mean
+    margin and the mean number of per-face comparisons for the best user.
+    """
+    out = {'queries': int(len(queries))}
+    decided = {}
+    for name, engine in (('before', before), ('after', after)):
+        res = engine.decide_many(queries, USER_TOL, USER_MARGIN, FACE_TOL, exact=True)
+        decided[name] = res
+        margins = [d['margin'] for _, d in res if np.isfinite(d.get('margin', np.inf))]
+        rows = [engine.profile(d['best_uid'])['faces'].shape[0] for _, d in res if 'best_uid' in d]
+        out[name] = {
+            'accepted': sum(1 for ok, _ in res if ok),
+            'correct': sum(1 for (ok, d), uid in zip(res, labels) if ok and d['best_uid'] == uid),
+            'mean_margin': float(np.mean(margins)) if margins else None,
+            'mean_face_comparisons': float(np.mean(rows)) if rows else None,
+        }
+    changed = 0
+    for (ok0, d0), (ok1, d1) in zip(decided['before'], decided['after']):
+        if ok0 != ok1 or (ok0 and d0.get('best_uid') != d1.get('best_uid')):
+            changed += 1
+    out['changed'] = changed
+    return out
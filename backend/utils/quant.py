@@ -0,0 +1,86 @@
+"""Compact (float16 / int8) storage of the centroid and face matrices.
+
+`CompactMatrix` holds the rows of `MatchEngine`'s centroid matrix in a
+smaller dtype:
+
+  float16  half precision, 2 bytes per value
+  int8     symmetric scalar quantization with one scale per dimension
+           (x ~= code * scale), 1 byte per value
+
+In a quantized engine the compact rows replace the float32 matrices in
+memory (the face matrices are stored as codes of a second, row-less
+`CompactMatrix`). The engine scans the compact rows to pick the closest
+candidates and then re-ranks only those with float32 rows read from the
+memory-mapped snapshot or the database, so best/runner-up distances and
+the accept decision are still computed in float32. Scans are chunked so
+the float32 upcast never materializes the whole matrix.
+"""
+import numpy as np
+
+QUANT_MODES = ('float16', 'int8')
+
+
+class CompactMatrix:
+    """Row-aligned compact copy of a float32 matrix."""
+
+    def __init__(self, mode, dim, capacity=0, scale=None):
+        if mode not in QUANT_MODES:
+            raise ValueError('unknown quantization mode %r' % mode)
+        self.mode = mode
+        self.dim = dim
+        if mode == 'int8':
+            self.codes = np.zeros((capacity, dim), dtype=np.int8)
+            # unit-norm embeddings never exceed 1 in any component
+            self.scale = np.asarray(scale, dtype=np.float32) if scale is not None else np.full(dim, 1.0 / 127, np.float32)
+        else:
+            self.codes = np.zeros((capacity, dim), dtype=np.float16)
+            self.scale = None
+
+    @classmethod
+    def from_matrix(cls, mode, X, capacity=None):
+        """Quantize the rows of `X` (per-dimension scales fitted on `X` for int8)."""
+        n, dim = X.shape
+        scale = None
+        if mode == 'int8' and n:
+            scale = np.maximum(np.abs(X).max(axis=0), 1e-6) / 127.0
+        cm = cls(mode, dim, capacity=max(capacity or n, n), scale=scale)
+        if n:
+            cm.codes[:n] = cm.encode(X)
+        return cm
+
+    def encode(self, X):
+        if self.mode == 'int8':
+            return np.clip(np.rint(X / self.scale), -127, 127).astype(np.int8)
+        return np.asarray(X, dtype=np.float16)
+
+    def decode(self, rows):
+        return self.decode_codes(self.codes[rows])
+
+    def decode_codes(self, codes):
+        """float32 values of codes produced by `encode`."""
+        c = np.asarray(codes).astype(np.float32)
+        return c * self.scale if self.mode == 'int8' else c
+
+    def resize(self, capacity):
+        codes = np.zeros((capacity, self.dim), dtype=self.codes.dtype)
+        n = min(capacity, self.codes.shape[0])
+        codes[:n] = self.codes[:n]
+        self.codes = codes
+
+    def set_row(self, row, x):
+        self.codes[row] = self.encode(np.asarray(x, dtype=np.float32)[None, :])[0]
+
+    def move_row(self, src, dst):
+        self.codes[dst] = self.codes[src]
+
+    def dots(self, q, n, chunk=2048):
+        """Approximate `X[:n] @ q` computed from the compact rows."""
+        qs = q * self.scale if self.mode == 'int8' else q
+        out = np.empty(n, dtype=np.float32)
+        for i in range(0, n, chunk):
+            out[i:i + chunk] = self.codes[i:min(i + chunk, n)].astype(np.float32) @ qs
+        return out
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
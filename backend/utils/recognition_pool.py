@@ -0,0 +1,287 @@
+"""Bounded process pool for the CPU-heavy part of image recognition.
+
+Decoding, the blur check, detection and encoding of an upload
+(`face_utils.analyze_image`) take hundreds of milliseconds of GIL-holding
+dlib/OpenCV work. Run inline they occupy gunicorn's request threads, so
+with `-w 1 --threads N` every other endpoint (`/health`,
+`/api/attendance/today`, ...) queues behind recognitions.
+
+`/api/attendance/mark` and `/api/face/enroll` submit that work to
+`recognition_pool` instead: RECOGNITION_POOL_SIZE worker processes, each
+loading face_recognition's dlib models and probing the detectors once in
+its initializer. The request thread only waits on the result. At most
+RECOGNITION_QUEUE_MAX images may be queued or running; beyond that (and
+after RECOGNITION_TIMEOUT seconds of waiting) `RecognitionUnavailable` is
+raised and the route answers 503 instead of stacking up threads.
+RECOGNITION_POOL_SIZE=0 runs the work inline in the request thread
+(tests, debugging). With ENCODE_BATCH_MAX > 1 the encoding step is split
+off and micro-batched across requests (see `encode_batcher.py`); those
+batches finish images that were already admitted, so they bypass the
+queue bound instead of failing a half-done request with 'busy'.
+Uploads whose content hash is in `embedding_cache` never reach the pool.
+"""
+import os
+import hashlib
+import threading
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from .face_utils import analyze_image, encode_chips, probe_detectors, record_pipeline
+from .encode_batcher import ENCODE_BATCH_MAX, ENCODE_BATCH_WAIT_MS, EncodeBatcher
+from .embedding_cache import embedding_cache, result_variant
+
+logger = logging.getLogger(__name__)
+
+# Worker processes (0 = run recognition inline in the request thread)
+RECOGNITION_POOL_SIZE = int(os.getenv('RECOGNITION_POOL_SIZE', 1))
+# Images allowed to be queued or running at once across all requests
+RECOGNITION_QUEUE_MAX = int(os.getenv('RECOGNITION_QUEUE_MAX', 8))
+# Seconds a request waits for its images before giving up
+RECOGNITION_TIMEOUT = float(os.getenv('RECOGNITION_TIMEOUT', 30))
+# 'spawn' keeps workers free of the web process's threads and DB connections
+RECOGNITION_POOL_START = os.getenv('RECOGNITION_POOL_START', 'spawn')
+
+
+class RecognitionUnavailable(RuntimeError):
+    """The pool cannot take or finish the work: 'busy', 'timeout' or 'crashed'."""
+
+    def __init__(self, reason):
+        super().__init__('recognition %s' % reason)
+        self.reason = reason
+
+
+def _init_worker():
+    # importing face_utils already loaded the dlib models; probing here
+    # keeps workers from discovering a missing CNN detector per image
+    probe_detectors()
+
+
+class RecognitionPool:
+    """Process pool with a bound on queued + running jobs.
+
+    The executor is created on first use, so processes that never recognize
+    (CLI commands, tests with `size=0`) never start workers.
+    """
+
+    def __init__(self, size=1, queue_max=8, timeout=30.0, start_method='spawn', initializer=_init_worker):
+        self.size = max(int(size), 0)
+        self.queue_max = max(int(queue_max), 1)
+        self.timeout = timeout
+        self.start_method = start_method
+        self.initializer = initializer
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counters = {'requests': 0, 'submitted': 0, 'completed': 0, 'rejected': 0, 'timeouts': 0,
+                          'restarts': 0}
+        self._wait_total = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            ctx = multiprocessing.get_context(self.start_method)
+            self._executor = ProcessPoolExecutor(max_workers=self.size, mp_context=ctx,
+                                                 initializer=self.initializer)
+            logger.info("recognition pool started: %d %s workers", self.size, self.start_method)
+        return self._executor
+
+    def _reserve(self, n, admitted=False):
+        with self._lock:
+            # an idle pool always admits a request, even one larger than the bound
+            if not admitted and self._pending and self._pending + n > self.queue_max:
+                self._counters['rejected'] += 1
+                raise RecognitionUnavailable('busy')
+            self._pending += n
+            self._counters['submitted'] += n
+
+    def _release(self, n=1, ran=True):
+        with self._lock:
+            self._pending -= n
+            if ran:
+                self._counters['completed'] += n
+
+    def map(self, fn, arg_tuples, timeout=None, on_result=None, admitted=False):
+        """Run `fn(*args)` for every tuple in `arg_tuples`; results in order.
+
+        All jobs are admitted together or not at all. Raises
+        `RecognitionUnavailable` when the queue is full, the results take
+        longer than `timeout` (default: the pool's) or a worker died;
+        exceptions raised by `fn` propagate. `on_result(i, result)` is
+        called in this thread as each job finishes, in completion order.
+        With `admitted=True` (follow-up work of requests that were already
+        admitted) the jobs are counted but never rejected as busy.
+        """
+        arg_tuples = list(arg_tuples)
+        if not arg_tuples:
+            return []
+        self._reserve(len(arg_tuples), admitted)
+        start = time.monotonic()
+        if not self.size:
+            try:
+                results = []
+                for i, args in enumerate(arg_tuples):
+                    results.append(fn(*args))
+                    if on_result is not None:
+                        on_result(i, results[-1])
+            finally:
+                self._release(len(arg_tuples))
+            self._served(start)
+            return results
+
+        futures = []
+        executor = None
+        try:
+            with self._lock:
+                executor = self._get_executor()
+            for args in arg_tuples:
+                f = executor.submit(fn, *args)
+                f.add_done_callback(lambda _f: self._release())
+                futures.append(f)
+        except BrokenProcessPool:
+            self._restart(executor)
+            self._release(len(arg_tuples) - len(futures), ran=False)
+            raise RecognitionUnavailable('crashed')
+        except Exception:
+            self._release(len(arg_tuples) - len(futures), ran=False)
+            raise
+
+        deadline = start + (self.timeout if timeout is None else timeout)
+        index = {f: i for i, f in enumerate(futures)}
+        results = [None] * len(futures)
+        try:
+            for f in as_completed(futures, timeout=max(deadline - time.monotonic(), 0)):
+                results[index[f]] = f.result()
+                if on_result is not None:
+                    on_result(index[f], results[index[f]])
+        except FutureTimeout:
+            with self._lock:
+                self._counters['timeouts'] += 1
+            for f in futures:
+                f.cancel()
+            raise RecognitionUnavailable('timeout')
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise RecognitionUnavailable('crashed')
+        self._served(start)
+        return results
+
+    def _served(self, start):
+        with self._lock:
+            self._counters['requests'] += 1
+            self._wait_total += time.monotonic() - start
+
+    def _restart(self, executor):
+        # a worker died (e.g. killed for memory) and `executor` is unusable;
+        # the next request starts a new one (once, however many requests saw it)
+        with self._lock:
+            if executor is None or self._executor is not executor:
+                return
+            self._executor = None
+            self._counters['restarts'] += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.error("recognition pool worker died; pool will be restarted")
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        """Pool size, current queue depth and lifetime counters."""
+        with self._lock:
+            c = dict(self._counters)
+            pending = self._pending
+            started = self._executor is not None
+            wait_total = self._wait_total
+        c.update({
+            'mode': 'process' if self.size else 'inline',
+            'size': self.size,
+            'started': started,
+            'queue_max': self.queue_max,
+            'pending': pending,
+            # jobs waiting for a free worker (the rest are running)
+            'queue_depth': max(pending - self.size, 0) if self.size else 0,
+            'timeout': self.timeout,
+            # submit-to-last-result time of a request
+            'avg_wait_ms': 1000.0 * wait_total / c['requests'] if c['requests'] else None,
+        })
+        return c
+
+
+def analyze_uploads(sources, profile, min_face_px, blur_threshold, timeout=None, on_result=None, hashes=None):
+    """`analyze_image` for each upload (bytes or saved path) on the recognition pool.
+
+    Results come back in order; detector counters of worker results are
+    added to this process's `pipeline_stats`. With ENCODE_BATCH_MAX > 1 the
+    pool jobs stop at the aligned face chips and the faces are encoded by
+    `encode_batcher` together with other requests' faces. `timeout` and
+    `on_result(i, result)` are passed to `RecognitionPool.map`; with
+    batching, `on_result` is called once the encodings are in.
+
+    `hashes` are the sha256 hex digests of the uploads (computed here for
+    bytes sources when omitted). Uploads found in `embedding_cache` are
+    answered from it without any pool work; every result carries its
+    `sha256` and `cache` ('hit', 'miss' or None when not cached).
+    """
+    batching = encode_batcher is not None
+    if hashes is None:
+        hashes = [hashlib.sha256(s).hexdigest() if isinstance(s, (bytes, bytearray)) else None for s in sources]
+    variant = result_variant(profile, min_face_px, blur_threshold)
+    results = [None] * len(sources)
+    for i, sha in enumerate(hashes):
+        t0 = time.perf_counter()
+        r = embedding_cache.get(sha, variant)
+        if r is not None:
+            r.update(sha256=sha, cache='hit', timings={'cache_ms': 1000.0 * (time.perf_counter() - t0)})
+            results[i] = r
+            if on_result is not None:
+                on_result(i, r)
+    todo = [i for i, r in enumerate(results) if r is None]
+    if not todo:
+        return results
+
+    def finished(k, r):
+        if recognition_pool.size and r.get('error') is None:
+            record_pipeline(r)
+        if on_result is not None and not batching:
+            on_result(todo[k], r)
+
+    fresh = recognition_pool.map(analyze_image, [(sources[i], profile, min_face_px, blur_threshold, None, not batching)
+                                                 for i in todo], timeout=timeout, on_result=finished)
+    if batching:
+        chips = [chip for r in fresh for chip in r.get('chips', ())]
+        try:
+            encs = encode_batcher.encode(chips, profile['num_jitters'],
+                                         timeout=recognition_pool.timeout if timeout is None else timeout)
+        except TimeoutError:
+            raise RecognitionUnavailable('timeout')
+        i = 0
+        for k, r in enumerate(fresh):
+            n = len(r.pop('chips', ()))
+            r['encodings'] = encs[i:i + n]
+            i += n
+            if on_result is not None:
+                on_result(todo[k], r)
+    for i, r in zip(todo, fresh):
+        sha = hashes[i]
+        r['sha256'] = sha
+        r['cache'] = 'miss' if (embedding_cache.enabled and sha) else None
+        embedding_cache.put(sha, variant, r)
+        results[i] = r
+    return results
+
+
+def _encode_on_pool(chips, num_jitters):
+    return recognition_pool.map(encode_chips, [(chips, num_jitters)], admitted=True)[0]
+
+
+# single pool per web process, shared by all request threads
+recognition_pool = RecognitionPool(size=RECOGNITION_POOL_SIZE, queue_max=RECOGNITION_QUEUE_MAX,
+                                   timeout=RECOGNITION_TIMEOUT, start_method=RECOGNITION_POOL_START)
+# cross-request batching of face encodings; one batch per pool worker at a time
+encode_batcher = (EncodeBatcher(_encode_on_pool, max_batch=ENCODE_BATCH_MAX, wait_ms=ENCODE_BATCH_WAIT_MS,
+                                concurrency=max(RECOGNITION_POOL_SIZE, 1))
+                  if ENCODE_BATCH_MAX > 1 else None)
@@ -0,0 +1,160 @@
+"""On-disk gallery snapshots shared between worker processes.
+
+A snapshot is a directory of `.npy` files plus a JSON header:
+
+    <root>/CURRENT                  name of the live version
+    <root>/<version>/header.json    format, version, dim, counts, created_at
+    <root>/<version>/uids.npy       (N,)   int64 user ids
+    <root>/<version>/centroids.npy  (N, D) float32 normalized centroids
+    <root>/<version>/faces.npy      (M, D) float32 normalized face embeddings
+    <root>/<version>/offsets.npy    (N+1,) int64, faces of uids[i] are
+                                    faces[offsets[i]:offsets[i+1]]
+
+Workers open the arrays with `np.load(mmap_mode='r')`, so the OS page
+cache holds one copy of the gallery for all of them. Writers build a new
+version in a temporary directory and publish it with two `os.replace`
+calls (directory, then CURRENT), so readers never see a partial snapshot.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+ARRAY_NAMES = ('uids', 'centroids', 'faces', 'offsets')
+CURRENT_FILE = 'CURRENT'
+
+
+def current_version(root):
+    """Return the live snapshot version under `root`, or None."""
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as fh:
+            return fh.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def snapshot_lock(root):
+    """Exclusive cross-process lock for read-modify-publish cycles."""
+    if not root or fcntl is None:
+        yield
+        return
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, '.lock'), 'a+') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def write_snapshot(root, arrays, meta=None, keep=3):
+    """Atomically write `arrays` as a new snapshot version and make it live.
+
+    Returns the new version name.
+    """
+    os.makedirs(root, exist_ok=True)
+    version = '%d-%s' % (int(time.time() * 1000), uuid.uuid4().hex[:8])
+    tmp_dir = os.path.join(root, '.tmp-' + version)
+    os.makedirs(tmp_dir)
+    try:
+        centroids = np.ascontiguousarray(arrays['centroids'], dtype=np.float32)
+        faces = np.ascontiguousarray(arrays['faces'], dtype=np.float32)
+        np.save(os.path.join(tmp_dir, 'uids.npy'), np.asarray(arrays['uids'], dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'centroids.npy'), centroids)
+        np.save(os.path.join(tmp_dir, 'faces.npy'), faces)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), np.asarray(arrays['offsets'], dtype=np.int64))
+        header = {
+            'format': SNAPSHOT_FORMAT,
+            'version': version,
+            'created_at': time.time(),
+            'dim': int(centroids.shape[1]) if centroids.ndim == 2 else 0,
+            'users': int(centroids.shape[0]),
+            'faces': int(faces.shape[0]),
+        }
+        header.update(meta or {})
+        with open(os.path.join(tmp_dir, 'header.json'), 'w') as fh:
+            json.dump(header, fh)
+        os.replace(tmp_dir, os.path.join(root, version))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    tmp_current = os.path.join(root, CURRENT_FILE + '.' + version)
+    with open(tmp_current, 'w') as fh:
+        fh.write(version)
+    os.replace(tmp_current, os.path.join(root, CURRENT_FILE))
+    prune_snapshots(root, keep=keep)
+    return version
+
+
+def load_snapshot(root, version=None, mmap=True):
+    """Load a snapshot. Returns (header, arrays); arrays are read-only memmaps when `mmap`."""
+    version = version or current_version(root)
+    if not version:
+        raise FileNotFoundError('no gallery snapshot in %s' % root)
+    vdir = os.path.join(root, version)
+    with open(os.path.join(vdir, 'header.json')) as fh:
+        header = json.load(fh)
+    if header.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError('unsupported snapshot format %r' % header.get('format'))
+    mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(vdir, name + '.npy'), mmap_mode=mode) for name in ARRAY_NAMES}
+    return header, arrays
+
+
+def verify_snapshot(root, version=None):
+    """Check a snapshot for internal consistency. Returns a list of problems (empty if OK)."""
+    problems = []
+    try:
+        header, a = load_snapshot(root, version)
+    except Exception as e:
+        return ['failed to load: %s' % e]
+    n, m = a['uids'].shape[0], a['faces'].shape[0]
+    if a['centroids'].shape[0] != n or header.get('users') != n:
+        problems.append('centroid rows %d, uids %d, header users %s' % (a['centroids'].shape[0], n, header.get('users')))
+    if header.get('faces') != m:
+        problems.append('faces rows %d, header faces %s' % (m, header.get('faces')))
+    if n and a['centroids'].shape[1] != header.get('dim'):
+        problems.append('centroid dim %d, header dim %s' % (a['centroids'].shape[1], header.get('dim')))
+    if m and a['faces'].shape[1] != a['centroids'].shape[1]:
+        problems.append('face dim %d differs from centroid dim' % a['faces'].shape[1])
+    offsets = a['offsets']
+    if offsets.shape[0] != n + 1 or offsets[0] != 0 or offsets[-1] != m or np.any(np.diff(offsets) < 0):
+        problems.append('offsets are not a monotonic 0..%d index of %d users' % (m, n))
+    if np.unique(a['uids']).shape[0] != n:
+        problems.append('duplicate user ids')
+    for name in ('centroids', 'faces'):
+        mat = a[name]
+        if mat.shape[0]:
+            if not np.all(np.isfinite(mat)):
+                problems.append('%s contains non-finite values' % name)
+            norms = np.linalg.norm(mat, axis=1)
+            bad = int(np.sum((norms > 0) & (np.abs(norms - 1.0) > 1e-3)))
+            if bad:
+                problems.append('%d %s rows are not unit length' % (bad, name))
+    return problems
+
+
+def prune_snapshots(root, keep=3):
+    """Delete all but the newest `keep` versions (never the live one)."""
+    live = current_version(root)
+    versions = sorted(d for d in os.listdir(root)
+                      if not d.startswith('.') and os.path.isdir(os.path.join(root, d)))
+    for v in versions[:-keep] if keep else versions:
+        if v != live:
+            # workers still mapping an old version keep their pages until they reload
+            shutil.rmtree(os.path.join(root, v), ignore_errors=True)
@@ -0,0 +1,96 @@
+"""Per-user cap on the face templates used for matching.
+
+Every stored face of a user is a template `decide_match` / `verify_match`
+compare against, so without a bound verification cost and gallery memory
+grow with every photo an enthusiastic user uploads. After each enrollment
+the user's active faces are cut down to FACE_TEMPLATES_MAX: templates are
+picked greedily, starting with the best quality score (`faces.quality`,
+see quality.py), each next one maximizing
+
+    quality + TEMPLATE_DIVERSITY_WEIGHT * distance to the nearest picked template
+
+so near-duplicates of an already kept photo lose to a different pose or
+lighting. The others are archived (`faces.archived_at` set): the row and
+image stay, but they leave the centroid and the in-memory gallery.
+`flask --app manage gallery cap-templates --reselect` re-runs the
+selection over active and archived faces, e.g. after lowering the cap or
+deleting faces.
+"""
+import os
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from .centroid import add_face_embeddings, remove_face_embeddings
+from .embedding import decode_stored
+
+logger = logging.getLogger(__name__)
+
+# Active face templates kept per user (0 = unlimited)
+FACE_TEMPLATES_MAX = int(os.getenv('FACE_TEMPLATES_MAX', 10))
+# Weight of the distance to the nearest kept template against the quality score
+TEMPLATE_DIVERSITY_WEIGHT = float(os.getenv('TEMPLATE_DIVERSITY_WEIGHT', 1.0))
+# Quality assumed for faces enrolled before scores were stored
+DEFAULT_QUALITY = 0.5
+
+
+def select_templates(vecs, scores, k, diversity=None):
+    """Indices (ascending) of the `k` templates to keep among `vecs`."""
+    n = len(vecs)
+    if k <= 0 or n <= k:
+        return list(range(n))
+    diversity = TEMPLATE_DIVERSITY_WEIGHT if diversity is None else diversity
+    X = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    X = X / np.where(norms > 0, norms, 1.0)
+    q = np.array([DEFAULT_QUALITY if s is None else float(s) for s in scores], dtype=np.float32)
+    first = int(np.argmax(q))
+    chosen = [first]
+    nearest = np.linalg.norm(X - X[first], axis=1)
+    while len(chosen) < k:
+        gain = q + diversity * nearest
+        gain[chosen] = -np.inf
+        j = int(np.argmax(gain))
+        chosen.append(j)
+        nearest = np.minimum(nearest, np.linalg.norm(X - X[j], axis=1))
+    return sorted(chosen)
+
+
+def cap_user_templates(user, FaceModel, k=None, reselect=False):
+    """Archive the user's active faces beyond the best `k` (default FACE_TEMPLATES_MAX).
+
+    With `reselect`, archived faces compete again and selected ones are
+    restored. The user's running centroid is updated; the caller commits
+    and refreshes the gallery. Returns `(archived, restored)` Face lists.
+    """
+    k = FACE_TEMPLATES_MAX if k is None else k
+    if k <= 0:
+        return [], []
+    q = FaceModel.query.filter_by(user_id=user.id)
+    if not reselect:
+        q = q.filter(FaceModel.archived_at.is_(None))
+    faces, vecs = [], []
+    for f in q.order_by(FaceModel.id):
+        raw = f.embedding_bin if f.embedding_bin is not None else f.embedding
+        if raw is None:
+            continue
+        faces.append(f)
+        vecs.append(decode_stored(raw))
+    if not reselect and len(faces) <= k:
+        return [], []
+
+    keep = set(select_templates(vecs, [f.quality for f in faces], k))
+    archived = [i for i, f in enumerate(faces) if i not in keep and f.archived_at is None]
+    restored = [i for i, f in enumerate(faces) if i in keep and f.archived_at is not None]
+    # centroid first: seeding it from stored rows must still see the current state
+    remove_face_embeddings(user, [vecs[i] for i in archived], FaceModel)
+    add_face_embeddings(user, [vecs[i] for i in restored], FaceModel)
+    now = datetime.utcnow()
+    for i in archived:
+        faces[i].archived_at = now
+    for i in restored:
+        faces[i].archived_at = None
+    if archived or restored:
+        logger.info("user %s templates: %d archived, %d restored", user.id, len(archived), len(restored))
+    return [faces[i] for i in archived], [faces[i] for i in restored]
@@ -1,9 +1,14 @@
+import hashlib
 import imghdr
 import os
+import tempfile
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Suffix of uploads parked for an asynchronous enrollment job
+PENDING_SUFFIX = '.pending'
+
 
 def _is_allowed_magic(header_bytes):
     # imghdr.what works on bytes if given a filename, but we can use imghdr on a temp file name
@@ -57,6 +62,49 @@ def validate_upload_stream(stream_or_bytes, filename=None, max_bytes=5 * 1024 *
         return False, 'validation_error'
 
 
+class UploadTooLarge(ValueError):
+    pass
+
+
+def read_upload(stream, max_bytes=5 * 1024 * 1024, chunk_size=64 * 1024):
+    """Read an uploaded file once, hashing it on the way.
+
+    Returns (data: bytes, sha256 hex digest). Raises UploadTooLarge as soon
+    as more than `max_bytes` have been read.
+    """
+    digest = hashlib.sha256()
+    buf = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if len(buf) + len(chunk) > max_bytes:
+            raise UploadTooLarge(f'file too large (max {max_bytes} bytes)')
+        digest.update(chunk)
+        buf += chunk
+    return bytes(buf), digest.hexdigest()
+
+
+def write_atomic(path, data):
+    """Write `data` to `path` via a temp file in the same directory and a rename.
+
+    Readers never see a partially written file; on failure nothing is left behind.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=parent, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
 def prepare_offload_stub(save_path):
     """Return a dict placeholder describing an S3 offload target (stub).
     Implementation left as a stub to be integrated with S3 in future.
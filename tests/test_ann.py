@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+from backend.utils.ann import IVFIndex
+from backend.utils.matcher import MatchEngine, normalize_rows
+
+
+def gallery(n, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    cents = normalize_rows(rng.normal(size=(n, dim)))
+    return {i: {'avg': c, 'faces': [c]} for i, c in enumerate(cents)}
+
+
+class TestIVFIndex(unittest.TestCase):
+    def test_ann_decisions_match_exact(self):
+        profiles = gallery(2000)
+        engine = MatchEngine.from_profiles(profiles, ann=IVFIndex(n_probe=16), ann_top_k=10)
+        self.assertTrue(engine.ann.is_trained)
+        rng = np.random.default_rng(5)
+        for uid in range(0, 2000, 97):
+            q = profiles[uid]['avg'] + 0.05 * rng.normal(size=32)
+            ex = engine.decide(q, 0.6, 0.1, 0.6, exact=True)
+            an = engine.decide(q, 0.6, 0.1, 0.6)
+            self.assertEqual(an[1]['best_uid'], ex[1]['best_uid'])
+            self.assertEqual(an[0], ex[0])
+
+    def test_incremental_add_and_remove(self):
+        profiles = gallery(500)
+        engine = MatchEngine.from_profiles(profiles, ann=IVFIndex(n_probe=4))
+        new = normalize_rows(np.ones(32))[0]
+        engine.upsert('new', new, [new])
+        self.assertEqual(engine.ann.search(new, k=1), ['new'])
+        engine.remove('new')
+        self.assertNotIn('new', engine.ann.search(new, k=5))
+        engine.remove(0)
+        self.assertEqual(len(engine.ann), 499)
+
+    def test_untrained_index_falls_back_to_exact(self):
+        profiles = gallery(50)
+        engine = MatchEngine.from_profiles(profiles, ann=IVFIndex(), ann_min_users=1000)
+        self.assertFalse(engine.ann.is_trained)
+        _, debug = engine.decide(profiles[7]['avg'])
+        self.assertEqual(debug['best_uid'], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from backend.utils.centroid import add_face_embeddings, remove_face_embeddings, remove_face_embeddings_bulk
+from backend.utils.embedding import pack_embedding, unpack_embedding
+
+
+def empty_user():
+    return SimpleNamespace(id=1, encoding=None, encoding_bin=None, encoding_sum=pack_embedding(np.zeros(128)),
+                           encoding_count=0)
+
+
+class TestIncrementalCentroid(unittest.TestCase):
+    def test_add_and_remove_match_the_batch_mean(self):
+        rng = np.random.default_rng(0)
+        vecs = rng.normal(size=(5, 128))
+        user = empty_user()
+        add_face_embeddings(user, vecs[:3], None)
+        add_face_embeddings(user, vecs[3:], None)
+        remove_face_embeddings(user, [vecs[1]], None)
+        expected = np.delete(vecs, 1, axis=0).mean(axis=0)
+        expected /= np.linalg.norm(expected)
+        self.assertEqual(user.encoding_count, 4)
+        np.testing.assert_allclose(unpack_embedding(user.encoding_bin), expected, atol=1e-5)
+        np.testing.assert_allclose(json.loads(user.encoding), expected, atol=1e-5)
+
+    def test_removing_last_face_clears_the_centroid(self):
+        vec = np.ones(128)
+        user = empty_user()
+        add_face_embeddings(user, [vec], None)
+        remove_face_embeddings(user, [vec], None)
+        self.assertEqual(user.encoding_count, 0)
+        self.assertIsNone(user.encoding_bin)
+        self.assertIsNone(user.encoding)
+
+    def test_bulk_remove_updates_each_user_once(self):
+        rng = np.random.default_rng(1)
+        vecs = {uid: rng.normal(size=(4, 128)) for uid in (1, 2, 3)}
+        users = {}
+        for uid, v in vecs.items():
+            users[uid] = empty_user()
+            users[uid].id = uid
+            add_face_embeddings(users[uid], v, None)
+        # remove faces 0 and 2 of user 2, face 3 of user 1, interleaved
+        remove_face_embeddings_bulk(users, [2, 1, 2], [vecs[2][0], vecs[1][3], vecs[2][2]], None)
+        for uid, keep in ((1, [0, 1, 2]), (2, [1, 3]), (3, [0, 1, 2, 3])):
+            expected = vecs[uid][keep].mean(axis=0)
+            expected /= np.linalg.norm(expected)
+            self.assertEqual(users[uid].encoding_count, len(keep))
+            np.testing.assert_allclose(unpack_embedding(users[uid].encoding_bin), expected, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
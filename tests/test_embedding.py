@@ -0,0 +1,27 @@
+import json
+import unittest
+import numpy as np
+from backend.utils.embedding import decode_stored, pack_embedding, unpack_embedding
+
+
+class TestEmbeddingCodec(unittest.TestCase):
+    def test_roundtrip_is_513_bytes_and_zero_copy(self):
+        v = np.linspace(-1, 1, 128).astype(np.float32)
+        buf = pack_embedding(v)
+        self.assertEqual(len(buf), 513)
+        out = unpack_embedding(buf)
+        np.testing.assert_array_equal(out, v)
+        self.assertFalse(out.flags.owndata)
+
+    def test_decode_stored_accepts_all_representations(self):
+        v = [0.5, -0.25, 1.0]
+        for raw in (pack_embedding(v), json.dumps(v), v):
+            np.testing.assert_allclose(decode_stored(raw), v)
+
+    def test_unknown_format_byte_is_rejected(self):
+        with self.assertRaises(ValueError):
+            unpack_embedding(b'\x07' + np.zeros(4, dtype='<f4').tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from backend.utils.embedding_cache import EmbeddingCache, result_variant
+
+
+def _result(n_enc=1):
+    return {'error': None, 'boxes': [(10, 60, 70, 0)], 'heights': [60], 'model': 'hog',
+            'encodings': [np.arange(128, dtype=np.float64) / 128.0 for _ in range(n_enc)],
+            'quality': {'score': 0.8, 'reason': None}, 'timings': {'detect_ms': 12.0}}
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.variant = result_variant({'name': 'balanced'}, 120, 100.0)
+
+    def test_hit_returns_an_independent_copy_without_timings(self):
+        cache = EmbeddingCache(max_entries=4)
+        cache.put('aa' * 32, self.variant, _result())
+        hit = cache.get('aa' * 32, self.variant)
+        self.assertNotIn('timings', hit)
+        np.testing.assert_array_equal(hit['encodings'][0], _result()['encodings'][0])
+        hit['encodings'][0][:] = 0
+        self.assertTrue(cache.get('aa' * 32, self.variant)['encodings'][0].any())
+        self.assertIsNone(cache.get('aa' * 32, result_variant({'name': 'fast'}, 200, 60.0)))
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_lru_eviction_and_incomplete_results(self):
+        cache = EmbeddingCache(max_entries=2)
+        for sha in ('a', 'b'):
+            cache.put(sha, self.variant, _result())
+        cache.get('a', self.variant)
+        cache.put('c', self.variant, _result())
+        self.assertIsNone(cache.get('b', self.variant))
+        self.assertIsNotNone(cache.get('a', self.variant))
+        # a face whose encoding failed is not a reusable answer
+        cache.put('d', self.variant, _result(n_enc=0))
+        self.assertIsNone(cache.get('d', self.variant))
+
+    def test_disk_copy_survives_a_new_process_and_keeps_users(self):
+        with tempfile.TemporaryDirectory() as d:
+            first = EmbeddingCache(max_entries=4, cache_dir=d)
+            first.put('ab' * 32, self.variant, _result())
+            self.assertEqual(first.note_user('ab' * 32, 1), set())
+            self.assertTrue(os.path.exists(os.path.join(d, 'ab', 'ab' * 32 + '.json')))
+
+            second = EmbeddingCache(max_entries=4, cache_dir=d)
+            hit = second.get('ab' * 32, self.variant)
+            self.assertEqual(hit['boxes'], [(10, 60, 70, 0)])
+            self.assertEqual(second.stats()['disk_hits'], 1)
+            self.assertEqual(second.note_user('ab' * 32, 1), set())
+            self.assertEqual(second.note_user('ab' * 32, 2), {1})
+            # the first process sees the user recorded by the second one
+            self.assertEqual(first.note_user('ab' * 32, 3), {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import threading
+import time
+import unittest
+
+from backend.utils.encode_batcher import EncodeBatcher
+
+
+class TestEncodeBatcher(unittest.TestCase):
+    def test_concurrent_callers_share_batches_and_get_their_own_results(self):
+        batches = []
+
+        def runner(chips, num_jitters):
+            batches.append((len(chips), num_jitters))
+            time.sleep(0.05)
+            return [c * 10 + num_jitters for c in chips]
+
+        batcher = EncodeBatcher(runner, max_batch=4, wait_ms=20)
+        results = {}
+
+        def call(i, jitters):
+            results[i] = batcher.encode([i, i + 100], num_jitters=jitters)
+
+        threads = [threading.Thread(target=call, args=(i, 1 if i < 4 else 2)) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(6):
+            j = 1 if i < 4 else 2
+            self.assertEqual(results[i], [i * 10 + j, (i + 100) * 10 + j])
+        # two chips per caller, at most 4 per batch, jitter settings never mixed
+        self.assertTrue(all(n <= 4 for n, _ in batches))
+        self.assertEqual(sum(n for n, j in batches if j == 1), 8)
+        self.assertEqual(sum(n for n, j in batches if j == 2), 4)
+        self.assertLess(len(batches), 6)
+        self.assertEqual(batcher.stats()['chips'], 12)
+
+    def test_runner_errors_reach_every_caller_of_the_batch(self):
+        def runner(chips, num_jitters):
+            raise RuntimeError('encoder down')
+
+        batcher = EncodeBatcher(runner, max_batch=8, wait_ms=1)
+        with self.assertRaises(RuntimeError):
+            batcher.encode(['chip'])
+        self.assertEqual(batcher.stats()['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import numpy as np
+from flask import Flask
+
+from backend.extensions import db
+from backend.models import EnrollJob, Face, User
+from backend.routes.face import _run_enroll_job
+from backend.utils.enroll_jobs import EnrollJobRunner, LeaseLost
+from backend.utils.gallery import GalleryCache
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://')
+    db.init_app(app)
+    return app
+
+
+class TestEnrollJobRunner(unittest.TestCase):
+    def setUp(self):
+        self.app = make_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        now = datetime.utcnow()
+        for i, jid in enumerate(('b', 'a')):
+            db.session.add(EnrollJob(id=jid, user_id=1, files=[], created_at=now + timedelta(seconds=i)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_claims_oldest_queued_job_once(self):
+        runner = EnrollJobRunner(EnrollJob, db, process=None)
+        self.assertEqual(runner.claim(), 'b')
+        self.assertEqual(runner.claim(), 'a')
+        self.assertIsNone(runner.claim())
+        self.assertEqual(db.session.get(EnrollJob, 'b').status, 'running')
+
+    def test_failing_job_is_marked_failed(self):
+        def process(job_id):
+            raise RuntimeError('pool crashed')
+
+        runner = EnrollJobRunner(EnrollJob, db, process)
+        runner.run_one(runner.claim())
+        job = db.session.get(EnrollJob, 'b')
+        self.assertEqual((job.status, job.error), ('failed', 'pool crashed'))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_only_expired_leases_are_requeued(self):
+        runner = EnrollJobRunner(EnrollJob, db, process=None, lease_seconds=60)
+        self.assertEqual(runner.claim(), 'b')
+        # a long-running job whose worker keeps renewing stays with it
+        EnrollJob.query.filter_by(id='b').update({'started_at': datetime.utcnow() - timedelta(seconds=3600)})
+        db.session.commit()
+        self.assertTrue(runner.renew('b'))
+        self.assertEqual(runner.claim(), 'a')
+        self.assertIsNone(runner.claim())
+        EnrollJob.query.filter_by(id='b').update({'lease_until': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        self.assertEqual(runner.claim(), 'b')
+
+    def test_worker_that_lost_its_lease_cannot_store_or_fail_the_job(self):
+        stale = EnrollJobRunner(EnrollJob, db, process=None, lease_seconds=60)
+        self.assertEqual(stale.claim(), 'b')
+        EnrollJob.query.filter_by(id='b').update({'lease_until': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        owner = EnrollJobRunner(EnrollJob, db, process=None, lease_seconds=60)
+        self.assertEqual(owner.claim(), 'b')
+
+        def process(job_id):
+            if not stale.renew(job_id, commit=False):
+                raise LeaseLost(job_id)
+
+        stale.process = process
+        stale.run_one('b')
+        stale.process = lambda job_id: 1 / 0
+        stale.run_one('b')
+        job = db.session.get(EnrollJob, 'b')
+        self.assertEqual((job.status, job.error), ('running', None))
+        self.assertTrue(owner.renew('b'))
+
+
+class TestEnrollJobFiles(unittest.TestCase):
+    def setUp(self):
+        self.app = make_app()
+        self.root = tempfile.mkdtemp()
+        self.app.config['UPLOAD_FOLDER'] = self.root
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        user = User(name='alice', email='alice@x')
+        db.session.add(user)
+        db.session.commit()
+        os.makedirs(os.path.join(self.root, 'faces', 'user_%d' % user.id))
+        self.image_path = os.path.join('faces', 'user_%d' % user.id, 'f1.png')
+        self.pending = os.path.join(self.root, self.image_path + '.pending')
+        with open(self.pending, 'wb') as fh:
+            fh.write(b'image')
+        db.session.add(EnrollJob(id='j', user_id=user.id, files=[
+            {'filename': 'f1.png', 'face_id': 'f1', 'path': self.pending, 'image_path': self.image_path,
+             'sha256': None, 'status': 'queued', 'error': None}]))
+        db.session.commit()
+        self.runner = EnrollJobRunner(EnrollJob, db, process=None)
+        self.assertEqual(self.runner.claim(), 'j')
+        self.patches = [patch('backend.routes.face.enroll_jobs', self.runner),
+                        patch('backend.routes.face.gallery', GalleryCache())]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _analyzed(self, failing_commit=None):
+        enc = np.zeros(128)
+        enc[0] = 1.0
+        detected = {'error': None, 'boxes': [(0, 200, 200, 0)], 'heights': [200], 'encodings': [enc],
+                    'quality': None}
+
+        def analyze(paths, hashes, profile, min_face_px, on_result):
+            on_result(0, detected)
+            if failing_commit is not None:
+                failing_commit.start()
+            return [detected]
+        return patch('backend.routes.face._analyze_job_files', analyze)
+
+    def test_failed_commit_keeps_pending_files_for_the_retry(self):
+        failing = patch.object(db.session, 'commit', side_effect=RuntimeError('database is locked'))
+        with self._analyzed(failing):
+            with self.assertRaises(RuntimeError):
+                _run_enroll_job('j')
+        failing.stop()
+        db.session.rollback()
+        self.assertTrue(os.path.exists(self.pending))
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.image_path)))
+
+        with self._analyzed():
+            _run_enroll_job('j')
+        self.assertFalse(os.path.exists(self.pending))
+        self.assertTrue(os.path.exists(os.path.join(self.root, self.image_path)))
+        self.assertEqual(db.session.get(EnrollJob, 'j').status, 'done')
+        self.assertEqual(Face.query.count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from flask import Flask
+
+from backend.extensions import db
+from backend.models import Face, User
+from backend.utils.embedding import pack_embedding
+from backend.utils.gallery import GalleryCache
+from backend.utils.matcher import normalize_rows
+
+
+class TestQuantizedGallery(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://')
+        db.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        rng = np.random.default_rng(0)
+        self.faces = {}
+        for i in range(40):
+            faces = normalize_rows(rng.normal(size=(2, 128)))
+            u = User(name='user%d' % i, email='user%d@x' % i,
+                     encoding_bin=pack_embedding(normalize_rows(faces.mean(axis=0))[0]))
+            db.session.add(u)
+            db.session.commit()
+            for j, f in enumerate(faces):
+                db.session.add(Face(user_id=u.id, face_id='face-%d-%d' % (i, j), embedding_bin=pack_embedding(f)))
+            self.faces[u.id] = faces
+        db.session.commit()
+        self.patches = [patch('backend.utils.gallery.GALLERY_QUANT', 'int8'),
+                        patch('backend.utils.gallery.GALLERY_QUANT_RERANK', 4)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _check_exact(self, gallery):
+        engine = gallery.engine(User, Face)
+        self.assertEqual(engine.memory_stats()['centroids_bytes'], 0)
+        uid = next(iter(self.faces))
+        _, debug = engine.decide(self.faces[uid][0])
+        self.assertEqual(debug['best_uid'], uid)
+        # checked against the stored float32 face, not its int8 code
+        self.assertLess(debug['per_face_min'], 1e-5)
+        np.testing.assert_allclose(gallery.profile(uid, User, Face)['faces'], self.faces[uid], atol=1e-6)
+        return engine
+
+    def test_reranks_from_the_database(self):
+        gallery = GalleryCache()
+        engine = self._check_exact(gallery)
+        u = User.query.first()
+        new = normalize_rows(np.random.default_rng(1).normal(size=128))[0]
+        db.session.add(Face(user_id=u.id, face_id='face-new', embedding_bin=pack_embedding(new)))
+        db.session.commit()
+        gallery.refresh_user(u.id, User, Face)
+        # the database already holds the change, so no float32 copy is kept
+        self.assertEqual(engine.memory_stats()['changed_bytes'], 0)
+        np.testing.assert_allclose(engine.profile(u.id)['faces'][-1], new, atol=1e-6)
+
+    def test_reranks_from_the_mapped_snapshot(self):
+        gallery = GalleryCache(snapshot_dir=tempfile.mkdtemp(), snapshot_check_seconds=0)
+        engine = self._check_exact(gallery)
+        self.assertIsInstance(engine.exact_rows.centroids, np.memmap)
+        u = User.query.first()
+        db.session.delete(Face.query.filter_by(user_id=u.id).first())
+        db.session.commit()
+        gallery.refresh_user(u.id, User, Face)
+        engine = gallery.engine(User, Face)
+        self.assertEqual(engine.memory_stats()['changed_bytes'], 0)
+        self.assertIn(gallery.snapshot_version, engine.exact_rows.centroids.filename)
+        self.assertEqual(len(gallery.profile(u.id, User, Face)['faces']), 1)
+
+    def test_profile_picks_up_another_workers_snapshot(self):
+        root = tempfile.mkdtemp()
+        reader = GalleryCache(snapshot_dir=root, snapshot_check_seconds=60)
+        writer = GalleryCache(snapshot_dir=root, snapshot_check_seconds=60)
+        reader.engine(User, Face)
+        writer.engine(User, Face)
+        u = User.query.first()
+        db.session.delete(Face.query.filter_by(user_id=u.id).first())
+        db.session.commit()
+        writer.refresh_user(u.id, User, Face)
+        self.assertEqual(len(reader.profile(u.id, User, Face)['faces']), 1)
+        self.assertEqual(reader.snapshot_version, writer.snapshot_version)
+
+
+if __name__ == '__main__':
+    unittest.main()
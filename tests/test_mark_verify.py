@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from flask import Flask
+from flask_jwt_extended import JWTManager, create_access_token
+
+from backend.extensions import db
+from backend.models import Face, User
+from backend.routes.attendance import attendance_bp
+from backend.utils.embedding import pack_embedding
+from backend.utils.gallery import GalleryCache
+
+
+def _vec(i):
+    v = np.zeros(128, dtype=np.float32)
+    v[i] = 1.0
+    return v
+
+
+def _detected(vec):
+    return {'error': None, 'boxes': [(0, 200, 200, 0)], 'heights': [200], 'encodings': [vec],
+            'quality': None, 'decode': None, 'timings': {}, 'detector_calls': 1}
+
+
+class TestMarkVerification(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', JWT_SECRET_KEY='x' * 32)
+        db.init_app(self.app)
+        JWTManager(self.app)
+        self.app.register_blueprint(attendance_bp, url_prefix='/api/attendance')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.uids = []
+        for i, name in enumerate(('alice', 'bob')):
+            u = User(name=name, email=name + '@x', encoding_bin=pack_embedding(_vec(i)))
+            db.session.add(u)
+            db.session.commit()
+            db.session.add(Face(user_id=u.id, face_id='face-%s' % name, embedding_bin=pack_embedding(_vec(i))))
+            self.uids.append(u.id)
+        db.session.commit()
+        self.client = self.app.test_client()
+        log = os.path.join(tempfile.mkdtemp(), 'log.csv')
+        self.patches = [patch('backend.routes.attendance.gallery', GalleryCache()),
+                        patch('backend.routes.attendance.LOG_CSV_PATH', log)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _mark(self, vec, token_uid=None, face_id=None):
+        headers = {'Authorization': 'Bearer ' + create_access_token(identity=str(token_uid))} if token_uid else {}
+        data = {'image': (tempfile.SpooledTemporaryFile(), 'q.jpg')}
+        if face_id:
+            data['face_id'] = face_id
+        with patch('backend.routes.attendance.analyze_uploads', return_value=[_detected(vec)]):
+            return self.client.post('/api/attendance/mark', data=data, headers=headers,
+                                    content_type='multipart/form-data')
+
+    def test_token_holder_is_verified(self):
+        r = self._mark(_vec(0), token_uid=self.uids[0])
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.get_json()['marked'])
+
+    def test_impostor_with_token_gets_identity_mismatch(self):
+        r = self._mark(_vec(1), token_uid=self.uids[0])
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(r.get_json()['error'], 'identity_mismatch')
+
+    def test_face_id_without_token_is_identified_not_verified(self):
+        with patch('backend.routes.attendance.verify_match') as verify:
+            r = self._mark(_vec(1), face_id='face-alice')
+        verify.assert_not_called()
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(r.get_json()['error'], 'identity_mismatch')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+import numpy as np
+from backend.utils.matcher import ArrayRows, MatchEngine, normalize_rows, verify_profile
+
+
+def reference_decide(q, profiles, USER_TOL, USER_MARGIN, FACE_TOL):
+    # the original per-user loop, kept here as the ground truth
+    q = normalize_rows(q)[0]
+    dists = sorted(((uid, float(np.linalg.norm(q - p['avg']))) for uid, p in profiles.items()), key=lambda x: x[1])
+    best_uid, best_d = dists[0]
+    runner_up_d = dists[1][1] if len(dists) > 1 else float('inf')
+    faces = profiles[best_uid]['faces']
+    per_face = [float(np.linalg.norm(q - f)) for f in faces] if faces else [float('inf')]
+    accepted = best_d <= USER_TOL and (runner_up_d - best_d) >= USER_MARGIN and min(per_face) <= FACE_TOL
+    return accepted, best_uid, best_d, runner_up_d, min(per_face), sorted(per_face)[:3]
+
+
+def random_profiles(rng, n_users, dim=128):
+    profiles = {}
+    for uid in range(n_users):
+        avg = normalize_rows(rng.normal(size=dim))[0]
+        faces = normalize_rows(avg + 0.3 * rng.normal(size=(rng.integers(1, 6), dim)) / np.sqrt(dim))
+        profiles[uid] = {'avg': avg, 'faces': list(faces)}
+    return profiles
+
+
+class TestMatchEngine(unittest.TestCase):
+    def test_matches_reference_loop(self):
+        rng = np.random.default_rng(0)
+        profiles = random_profiles(rng, 200)
+        engine = MatchEngine.from_profiles(profiles)
+        for uid in range(0, 200, 7):
+            q = profiles[uid]['avg'] + 0.2 * rng.normal(size=128) / np.sqrt(128)
+            accepted, debug = engine.decide(q, 0.45, 0.15, 0.55)
+            ref = reference_decide(q, profiles, 0.45, 0.15, 0.55)
+            self.assertEqual(accepted, ref[0])
+            self.assertEqual(debug['best_uid'], ref[1])
+            self.assertAlmostEqual(debug['best_d'], ref[2], places=5)
+            self.assertAlmostEqual(debug['runner_up_d'], ref[3], places=5)
+            self.assertAlmostEqual(debug['per_face_min'], ref[4], places=5)
+            np.testing.assert_allclose(debug['per_face_dists_top3'], ref[5], rtol=1e-5)
+
+    def test_single_user_has_infinite_margin(self):
+        engine = MatchEngine.from_profiles({'A': {'avg': [1, 0, 0, 0], 'faces': [[1, 0, 0, 0]]}})
+        accepted, debug = engine.decide([0.9, 0.1, 0, 0], 0.6, 0.05, 0.6)
+        self.assertTrue(accepted)
+        self.assertEqual(debug['runner_up_d'], float('inf'))
+
+    def test_remove_keeps_rows_contiguous(self):
+        rng = np.random.default_rng(1)
+        profiles = random_profiles(rng, 10, dim=16)
+        engine = MatchEngine.from_profiles(profiles)
+        engine.remove(3)
+        del profiles[3]
+        self.assertEqual(len(engine), 9)
+        self.assertNotIn(3, engine)
+        q = profiles[9]['avg']
+        _, debug = engine.decide(q, 0.45, 0.15, 0.55)
+        self.assertEqual(debug['best_uid'], 9)
+
+    def test_decide_many_matches_single_queries(self):
+        rng = np.random.default_rng(2)
+        profiles = random_profiles(rng, 300)
+        engine = MatchEngine.from_profiles(profiles)
+        Q = np.stack([profiles[uid]['avg'] + 0.2 * rng.normal(size=128) / np.sqrt(128) for uid in range(0, 300, 3)])
+        Q[5] = Q[4]  # two queries resolving to the same user
+        batched = engine.decide_many(Q, 0.45, 0.15, 0.55, chunk=16)
+        self.assertEqual(len(batched), Q.shape[0])
+        for q, (accepted, debug) in zip(Q, batched):
+            single_accepted, single = engine.decide(q, 0.45, 0.15, 0.55)
+            self.assertEqual(accepted, single_accepted)
+            self.assertEqual(debug['best_uid'], single['best_uid'])
+            self.assertAlmostEqual(debug['runner_up_d'], single['runner_up_d'], places=5)
+            self.assertAlmostEqual(debug['per_face_min'], single['per_face_min'], places=5)
+
+    def test_quantized_scan_reranks_in_float32(self):
+        rng = np.random.default_rng(3)
+        profiles = random_profiles(rng, 400)
+        exact = MatchEngine.from_profiles(profiles)
+        for mode, ratio in (('float16', 0.55), ('int8', 0.3)):
+            engine = MatchEngine.from_profiles(profiles, quant=mode, quant_rerank=8)
+            # the compact rows replace the float32 centroids and faces
+            mem = engine.memory_stats()
+            self.assertEqual((mem['centroids_bytes'], mem['faces_dtype']), (0, mode))
+            self.assertLess(mem['resident_bytes'], ratio * exact.memory_stats()['resident_bytes'])
+            for uid in range(0, 400, 13):
+                q = profiles[uid]['avg'] + 0.2 * rng.normal(size=128) / np.sqrt(128)
+                self.assertEqual(engine.decide(q, 0.45, 0.15, 0.55), exact.decide(q, 0.45, 0.15, 0.55))
+            engine.remove(0)
+            engine.upsert('x', profiles[5]['avg'], profiles[5]['faces'])
+            self.assertIn(engine.decide(profiles[5]['avg'])[1]['best_uid'], (5, 'x'))
+
+    def test_quantized_engine_reads_only_candidate_rows(self):
+        rng = np.random.default_rng(6)
+        profiles = random_profiles(rng, 300)
+        exact = MatchEngine.from_profiles(profiles)
+        a = exact.to_arrays()
+        rows = ArrayRows(**a)
+        asked = []
+
+        def exact_rows(uids):
+            asked.append(list(uids))
+            return rows(uids)
+
+        engine = MatchEngine.from_arrays(quant='int8', quant_rerank=8, exact_rows=exact_rows, **a)
+        q = profiles[7]['avg'] + 0.2 * rng.normal(size=128) / np.sqrt(128)
+        self.assertEqual(engine.decide(q), exact.decide(q))
+        self.assertEqual(len(asked[-1]), 8)
+        np.testing.assert_array_equal(engine.profile(7)['faces'], exact.profile(7)['faces'])
+
+        # a changed user is re-ranked from its float32 copy until the source catches up
+        new = normalize_rows(rng.normal(size=128))[0]
+        engine.upsert(7, new, [new])
+        self.assertEqual(engine.decide(new)[1]['best_d'], 0.0)
+        self.assertNotIn(7, asked[-1])
+        self.assertGreater(engine.memory_stats()['changed_bytes'], 0)
+        engine.set_exact_rows(exact_rows)
+        self.assertEqual(engine.memory_stats()['changed_bytes'], 0)
+
+        # without a usable source the decoded compact rows are used
+        def broken(uids):
+            raise RuntimeError('database unavailable')
+
+        engine.set_exact_rows(broken)
+        _, debug = engine.decide(profiles[9]['avg'])
+        self.assertEqual(debug['best_uid'], 9)
+        self.assertLess(debug['best_d'], 0.02)
+
+    def test_subset_matches_like_a_gallery_of_those_users(self):
+        rng = np.random.default_rng(4)
+        profiles = random_profiles(rng, 60)
+        engine = MatchEngine.from_profiles(profiles)
+        part_uids = list(range(0, 60, 3))
+        part = engine.subset(part_uids + [999])
+        ref = MatchEngine.from_profiles({u: profiles[u] for u in part_uids})
+        self.assertEqual(sorted(part.uids), part_uids)
+        for uid in range(60):
+            q = profiles[uid]['avg'] + 0.2 * rng.normal(size=128) / np.sqrt(128)
+            self.assertEqual(part.decide(q), ref.decide(q))
+        self.assertEqual(len(engine.subset([999])), 0)
+
+    def test_verify_profile_is_one_to_one(self):
+        rng = np.random.default_rng(5)
+        profiles = random_profiles(rng, 20)
+        p = profiles[3]
+        q = p['avg'] + 0.1 * rng.normal(size=128) / np.sqrt(128)
+        accepted, debug = verify_profile(3, p['avg'], p['faces'], q, 0.45, 0.55)
+        self.assertTrue(accepted)
+        self.assertEqual(debug['best_uid'], 3)
+        self.assertAlmostEqual(debug['best_d'], float(np.linalg.norm(normalize_rows(q)[0] - p['avg'])), places=5)
+        self.assertEqual(debug['runner_up_d'], float('inf'))
+        self.assertEqual(set(debug), set(MatchEngine.from_profiles(profiles).decide(q)[1]))
+        self.assertFalse(verify_profile(3, p['avg'], p['faces'], profiles[4]['avg'], 0.45, 0.55)[0])
+        self.assertFalse(verify_profile(3, p['avg'], [], q, 0.45, 0.55)[0])
+
+    def test_empty_engine(self):
+        accepted, debug = MatchEngine().decide([1, 0, 0, 0])
+        self.assertFalse(accepted)
+        self.assertEqual(debug, {'error': 'no user profiles'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import io
+import unittest
+from types import SimpleNamespace
+import cv2
+import numpy as np
+from backend.utils.face_utils import (analyze_image, decode_reduction, detect_and_encode, jpeg_size,
+                                      pipeline_stats, probe_detectors)
+from backend.utils.profiles import PROFILES, detect_kwargs, get_profile
+
+
+def fake_fr(boxes_by_model):
+    calls = []
+
+    def face_locations(image, number_of_times_to_upsample=1, model='hog'):
+        calls.append(('detect', model, getattr(image, 'shape', None)))
+        return boxes_by_model.get(model, [])
+
+    def face_encodings(image, known_face_locations=None, num_jitters=1, model='small'):
+        calls.append(('encode', known_face_locations, getattr(image, 'shape', None)))
+        return [np.ones(128) for _ in known_face_locations]
+
+    return SimpleNamespace(face_locations=face_locations, face_encodings=face_encodings), calls
+
+
+class TestDetectAndEncode(unittest.TestCase):
+    def test_single_detection_feeds_boxes_and_encodings(self):
+        fr, calls = fake_fr({'hog': [(10, 210, 190, 30)]})
+        out = detect_and_encode(None, model='hog', fallback_model='cnn', fr=fr)
+        self.assertEqual(out['detector_calls'], 1)
+        self.assertEqual(out['model'], 'hog')
+        self.assertEqual(out['heights'], [180])
+        self.assertEqual(len(out['encodings']), 1)
+        self.assertAlmostEqual(float(np.linalg.norm(out['encodings'][0])), 1.0, places=5)
+        self.assertEqual(calls, [('detect', 'hog', None), ('encode', [(10, 210, 190, 30)], None)])
+
+    def test_fallback_detector_runs_once_when_primary_finds_nothing(self):
+        fr, calls = fake_fr({'cnn': [(0, 100, 150, 0), (0, 300, 90, 200)]})
+        out = detect_and_encode(None, model='hog', fallback_model='cnn', fr=fr)
+        self.assertEqual(out['detector_calls'], 2)
+        self.assertEqual(out['model'], 'cnn')
+        self.assertEqual(out['heights'], [150, 90])
+
+    def test_no_face(self):
+        fr, calls = fake_fr({})
+        out = detect_and_encode(None, model='hog', fallback_model='', fr=fr)
+        self.assertEqual((out['boxes'], out['encodings'], out['detector_calls']), ([], [], 1))
+        self.assertEqual(calls, [('detect', 'hog', None)])
+
+    def test_detects_on_downscaled_copy_and_encodes_from_crop(self):
+        image = np.zeros((3000, 4000, 3), dtype=np.uint8)
+        # detection copy is 750 x 1000; this box is 100px tall there, 400px in the original
+        fr, calls = fake_fr({'hog': [(100, 600, 200, 500)]})
+        out = detect_and_encode(image, model='hog', fallback_model='', fr=fr,
+                                max_side=1000, min_face_px=160, encode_face_px=200)
+        self.assertEqual(out['detect_scale'], 0.25)
+        self.assertEqual(calls[0][2], (750, 1000, 3))
+        self.assertEqual(out['boxes'], [(400, 2400, 800, 2000)])
+        self.assertEqual(out['heights'], [400])
+        # padded 800px crop scaled so the face is 200px tall
+        _, boxes, shape = calls[1]
+        self.assertEqual(shape, (400, 400, 3))
+        self.assertEqual(boxes, [(100, 300, 300, 100)])
+
+    def test_failed_crop_encoding_keeps_encodings_aligned_with_boxes(self):
+        image = np.zeros((1000, 1000, 3), dtype=np.uint8)
+        fr, calls = fake_fr({'hog': [(100, 400, 400, 100), (500, 900, 900, 500)]})
+        face_encodings = fr.face_encodings
+
+        def first_crop_fails(crop, known_face_locations=None, num_jitters=1, model='small'):
+            face_encodings(crop, known_face_locations, num_jitters, model)
+            return [] if len(calls) == 2 else [np.full(128, float(len(calls)))]
+
+        fr.face_encodings = first_crop_fails
+        out = detect_and_encode(image, model='hog', fallback_model='', fr=fr,
+                                max_side=0, min_face_px=100, encode_face_px=200)
+        self.assertEqual(len(out['boxes']), 2)
+        self.assertEqual(len(out['encodings']), 2)
+        self.assertIsNone(out['encodings'][0])
+        self.assertAlmostEqual(float(np.linalg.norm(out['encodings'][1])), 1.0, places=5)
+
+    def test_small_min_face_limits_downscaling(self):
+        image = np.zeros((3000, 4000, 3), dtype=np.uint8)
+        fr, calls = fake_fr({})
+        out = detect_and_encode(image, model='hog', fallback_model='', upsample=1, fr=fr,
+                                max_side=1000, min_face_px=80)
+        # an 80px face must stay >= 40px (dlib's 80px window at upsample=1)
+        self.assertEqual(out['detect_scale'], 0.5)
+        self.assertEqual(calls[0][2], (1500, 2000, 3))
+
+    def test_too_small_hog_face_escalates_to_cnn(self):
+        image = np.zeros((600, 800, 3), dtype=np.uint8)
+        fr, calls = fake_fr({'hog': [(10, 110, 90, 30)], 'cnn': [(0, 200, 180, 20)]})
+        before = pipeline_stats()['stages'].get('hog', {'runs': 0, 'hits': 0})
+        out = detect_and_encode(image, model='hog', fallback_model='cnn', fr=fr,
+                                max_side=0, min_face_px=120, encode_face_px=0)
+        self.assertEqual([c[1] for c in calls if c[0] == 'detect'], ['hog', 'cnn'])
+        self.assertEqual((out['model'], out['heights']), ('cnn', [180]))
+        after = pipeline_stats()['stages']['hog']
+        self.assertEqual((after['runs'] - before['runs'], after['hits'] - before['hits']), (1, 0))
+
+    def test_probe_reports_unavailable_detector(self):
+        def face_locations(image, number_of_times_to_upsample=1, model='hog'):
+            if model == 'cnn':
+                raise RuntimeError('cnn model not built')
+            return []
+        found = probe_detectors(SimpleNamespace(face_locations=face_locations), force=True)
+        self.assertTrue(found['hog'])
+        self.assertFalse(found['cnn'])
+        probe_detectors(force=True)
+
+    def test_profiles_pass_their_settings_to_the_pipeline(self):
+        self.assertEqual(detect_kwargs(get_profile('balanced')), {'num_jitters': 1, 'landmarks': 'small'})
+        fast = get_profile('FAST')
+        self.assertEqual(fast['name'], 'fast')
+        self.assertEqual(detect_kwargs(fast)['cnn'], 'off')
+        with self.assertRaises(KeyError):
+            get_profile('turbo')
+        image = np.zeros((1500, 2000, 3), dtype=np.uint8)
+        fr, calls = fake_fr({'hog': [(10, 110, 90, 30)]})
+        detect_and_encode(image, fr=fr, min_face_px=fast['min_face_px'], **detect_kwargs(fast))
+        # no upsampling: a 200px face must stay >= 80px, so 640px is floored to 0.4 scale
+        self.assertEqual(calls[0][2], (600, 800, 3))
+
+    def test_profiles_encode_like_enrollment(self):
+        # probes are compared with embeddings enrolled with 5-point landmarks and no jitter
+        for name in PROFILES:
+            kwargs = detect_kwargs(get_profile(name))
+            self.assertEqual((kwargs['landmarks'], kwargs['num_jitters']), ('small', 1), name)
+        self.assertNotIn('encode_face_px', detect_kwargs(get_profile('accurate')))
+
+
+
+class TestReducedDecode(unittest.TestCase):
+    PROFILE = {'model': 'hog', 'upsample': 1, 'max_side': 1024, 'cnn': 'off', 'encode_face_px': 200,
+               'num_jitters': 1, 'landmarks': 'small'}
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 255, size=(3000, 4000, 3), dtype=np.uint8)
+        cls.jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+
+    def test_reduction_keeps_the_detection_copy_resolution(self):
+        self.assertEqual(jpeg_size(io.BytesIO(self.jpeg)), (4000, 3000))
+        self.assertIsNone(jpeg_size(io.BytesIO(b'\x89PNG\r\n')))
+        # detection copy is a third of the original (a 120px face must stay 40px)
+        self.assertEqual(decode_reduction((4000, 3000), 1024, 120, 1), 2)
+        self.assertEqual(decode_reduction((4000, 3000), 500, 400, 0), 4)
+        self.assertEqual(decode_reduction((1600, 1200), 1024, 120, 1), 1)
+        self.assertEqual(decode_reduction(None, 1024, 120, 1), 1)
+
+    def test_large_face_is_encoded_from_the_reduced_image(self):
+        # 2000 x 1500 decode, 1333 x 1000 detection copy; face is 600px in the original
+        fr, calls = fake_fr({'hog': [(100, 700, 300, 500)]})
+        out = analyze_image(self.jpeg, self.PROFILE, 120, 10.0, fr=fr)
+        self.assertEqual(out['decode'], {'size': [4000, 3000], 'reduce': 2, 'fallback': False})
+        self.assertEqual(calls[0][2], (1000, 1333, 3))
+        self.assertEqual(out['boxes'], [(300, 2100, 900, 1500)])
+        self.assertEqual(out['heights'], [600])
+        self.assertTrue({'decode_ms', 'detect_ms', 'quality_ms', 'encode_ms'} <= set(out['timings']))
+
+    def test_small_face_falls_back_to_full_decode_for_encoding(self):
+        # 150px in the reduced image, below the 200px encoder crop
+        fr, calls = fake_fr({'hog': [(100, 700, 200, 600)]})
+        out = analyze_image(self.jpeg, self.PROFILE, 120, 10.0, fr=fr)
+        self.assertTrue(out['decode']['fallback'])
+        self.assertIn('redecode_ms', out['timings'])
+        self.assertEqual(out['heights'], [300])
+        # encoded from a crop of the full image: 600px padded, scaled to a 200px face
+        self.assertEqual(calls[1][2], (400, 400, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from backend.utils.prototypes import compute_prototypes, kmedoids, unpack_prototypes
+from backend.utils.embedding import pack_embedding
+
+
+class TestPrototypes(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(2, 128))
+        self.labels = np.repeat([0, 1], 6)
+        self.vecs = centers[self.labels] + 0.05 * rng.normal(size=(12, 128))
+
+    def test_one_medoid_per_cluster(self):
+        medoids = kmedoids(self.vecs.astype(np.float32), 2)
+        self.assertEqual(sorted(self.labels[medoids].tolist()), [0, 1])
+        self.assertEqual(medoids, kmedoids(self.vecs.astype(np.float32), 2))
+
+    def test_prototypes_are_normalized_face_rows(self):
+        protos = compute_prototypes(self.vecs, k=3)
+        self.assertEqual(protos.shape, (3, 128))
+        self.assertEqual(protos.dtype, np.float32)
+        np.testing.assert_allclose(np.linalg.norm(protos, axis=1), 1.0, rtol=1e-5)
+        normalized = self.vecs / np.linalg.norm(self.vecs, axis=1, keepdims=True)
+        for p in protos:
+            self.assertLess(np.min(np.linalg.norm(normalized - p, axis=1)), 1e-5)
+        np.testing.assert_array_equal(unpack_prototypes(pack_embedding(protos), 128), protos)
+
+    def test_no_prototypes_when_every_face_is_needed(self):
+        self.assertIsNone(compute_prototypes(self.vecs[:3], k=3))
+        self.assertIsNone(compute_prototypes(self.vecs, k=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
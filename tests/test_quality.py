@@ -0,0 +1,66 @@
+import os
+import unittest
+
+import cv2
+import numpy as np
+
+from backend.utils.quality import QUALITY_BLUR_THRESHOLD, assess, measure_face
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a 640x480 webcam enrollment and its HOG face box; the whole frame scores
+# 77 on the old CV_64F check (flat background), the face crop 563
+ENROLLMENT = os.path.join(REPO_ROOT, 'backend', 'uploads', 'faces', 'user_1',
+                          '06ed3400-e703-4c32-ba90-0d47a3bede77.png')
+ENROLLMENT_BOX = (180, 448, 366, 262)
+
+
+def textured(h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    small = rng.integers(60, 200, size=(h // 8, w // 8, 3), dtype=np.uint8)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+
+
+class TestFaceQuality(unittest.TestCase):
+    def test_only_the_face_region_is_measured(self):
+        image = cv2.GaussianBlur(textured(600, 800), (0, 0), 8)
+        box = (100, 500, 400, 200)
+        image[100:400, 200:500] = textured(300, 300, seed=1)
+        sharp = measure_face(image, box)
+        # blurry background does not count against a sharp face; a blurred face fails
+        self.assertGreater(sharp['blur'], 100)
+        blurred = cv2.GaussianBlur(image, (0, 0), 8)
+        self.assertLess(measure_face(blurred, box)['blur'], 100)
+
+    def test_blur_measure_does_not_depend_on_resolution(self):
+        face = textured(480, 480)
+        big = measure_face(face, (0, 480, 480, 0))['blur']
+        half = cv2.resize(face, (240, 240), interpolation=cv2.INTER_AREA)
+        small = measure_face(half, (0, 240, 240, 0))['blur']
+        self.assertLess(abs(big - small) / big, 0.25)
+
+    def test_default_threshold_is_calibrated_on_a_real_face_crop(self):
+        rgb = cv2.cvtColor(cv2.imread(ENROLLMENT), cv2.COLOR_BGR2RGB)
+        sharp = measure_face(rgb, ENROLLMENT_BOX)
+        self.assertGreater(sharp['blur'], 500)
+        self.assertIsNone(assess(sharp, 186, QUALITY_BLUR_THRESHOLD, 120)['reason'])
+        for sigma in (1.5, 2.0):
+            blurred = measure_face(cv2.GaussianBlur(rgb, (0, 0), sigma), ENROLLMENT_BOX)
+            self.assertEqual(assess(blurred, 186, QUALITY_BLUR_THRESHOLD, 120)['reason'], 'blurry')
+        # the frame-level default of 100 would let the 1.5px blur through
+        blurred = measure_face(cv2.GaussianBlur(rgb, (0, 0), 1.5), ENROLLMENT_BOX)
+        self.assertGreater(blurred['blur'], 100)
+
+    def test_assess_reports_first_failed_check_and_ranks(self):
+        good = assess({'blur': 400.0, 'brightness': 130.0}, 300, 100.0, 120)
+        self.assertIsNone(good['reason'])
+        self.assertEqual(good['score'], 1.0)
+        self.assertEqual(assess({'blur': 50.0, 'brightness': 10.0}, 300, 100.0, 120)['reason'], 'blurry')
+        self.assertEqual(assess({'blur': 400.0, 'brightness': 10.0}, 300, 100.0, 120)['reason'], 'too_dark')
+        self.assertEqual(assess({'blur': 400.0, 'brightness': 250.0}, 300, 100.0, 120)['reason'], 'too_bright')
+        self.assertEqual(assess({'blur': 400.0, 'brightness': 130.0}, 100, 100.0, 120)['reason'], 'face_too_small')
+        worse = assess({'blur': 150.0, 'brightness': 70.0}, 160, 100.0, 120)
+        self.assertLess(worse['score'], good['score'])
+
+
+if __name__ == '__main__':
+    unittest.main()
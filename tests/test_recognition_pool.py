@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from backend.utils.encode_batcher import EncodeBatcher
+from backend.utils.recognition_pool import RecognitionPool, RecognitionUnavailable, _encode_on_pool
+
+
+class TestRecognitionPool(unittest.TestCase):
+    def test_inline_pool_runs_in_order(self):
+        pool = RecognitionPool(size=0)
+        self.assertEqual(pool.map(pow, [(2, 3), (3, 2)]), [8, 9])
+        stats = pool.stats()
+        self.assertEqual((stats['mode'], stats['completed'], stats['pending']), ('inline', 2, 0))
+
+    def test_full_queue_rejects_and_timeout_gives_up(self):
+        pool = RecognitionPool(size=1, queue_max=2, timeout=10, initializer=None)
+        try:
+            busy = threading.Thread(target=pool.map, args=(time.sleep, [(1.0,)]))
+            busy.start()
+            while pool.stats()['pending'] < 1:
+                time.sleep(0.01)
+            with self.assertRaises(RecognitionUnavailable) as ctx:
+                pool.map(time.sleep, [(0,), (0,)])
+            self.assertEqual(ctx.exception.reason, 'busy')
+            with self.assertRaises(RecognitionUnavailable) as ctx:
+                pool.map(time.sleep, [(0,)], timeout=0.05)
+            self.assertEqual(ctx.exception.reason, 'timeout')
+            busy.join()
+            stats = pool.stats()
+            self.assertEqual((stats['rejected'], stats['timeouts'], stats['size']), (1, 1, 1))
+        finally:
+            pool.shutdown()
+
+    def test_encode_batches_finish_while_the_analyze_queue_is_full(self):
+        pool = RecognitionPool(size=2, queue_max=2, timeout=30, initializer=None)
+        try:
+            busy = [threading.Thread(target=pool.map, args=(time.sleep, [(2.0,)])) for _ in range(2)]
+            for t in busy:
+                t.start()
+            while pool.stats()['pending'] < 2:
+                time.sleep(0.01)
+            with self.assertRaises(RecognitionUnavailable):
+                pool.map(time.sleep, [(0,)])
+            # the encode step of images analyzed before the queue filled up
+            batcher = EncodeBatcher(_encode_on_pool, max_batch=4, wait_ms=1)
+            with patch('backend.utils.recognition_pool.recognition_pool', pool):
+                encs = batcher.encode([np.zeros((150, 150, 3), dtype=np.uint8)] * 2)
+            self.assertEqual([e.shape for e in encs], [(128,), (128,)])
+            for t in busy:
+                t.join()
+            self.assertEqual(pool.stats()['pending'], 0)
+        finally:
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from backend.utils.matcher import MatchEngine, normalize_rows
+from backend.utils.snapshot import current_version, load_snapshot, verify_snapshot, write_snapshot
+
+
+def arrays(n=10, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    profiles = {uid: {'avg': normalize_rows(rng.normal(size=dim))[0],
+                      'faces': list(normalize_rows(rng.normal(size=(uid % 3, dim))))} for uid in range(1, n + 1)}
+    return MatchEngine.from_profiles(profiles).to_arrays()
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_roundtrip_is_memory_mapped_and_valid(self):
+        root = tempfile.mkdtemp()
+        a = arrays()
+        version = write_snapshot(root, a)
+        self.assertEqual(current_version(root), version)
+        self.assertEqual(verify_snapshot(root), [])
+        header, b = load_snapshot(root)
+        self.assertIsInstance(b['centroids'], np.memmap)
+        self.assertEqual(header['users'], 10)
+        for name in a:
+            np.testing.assert_array_equal(a[name], b[name])
+
+    def test_engine_copies_mapped_centroids_on_write(self):
+        root = tempfile.mkdtemp()
+        write_snapshot(root, arrays())
+        _, b = load_snapshot(root)
+        engine = MatchEngine.from_arrays(b['uids'], b['centroids'], b['faces'], b['offsets'], copy=False)
+        self.assertFalse(engine._centroids.flags.writeable)
+        engine.upsert(99, np.ones(16), [np.ones(16)])
+        engine.remove(1)
+        self.assertEqual(len(engine), 10)
+        self.assertEqual(engine.decide(np.ones(16))[1]['best_uid'], 99)
+
+    def test_old_versions_are_pruned(self):
+        root = tempfile.mkdtemp()
+        for seed in range(5):
+            live = write_snapshot(root, arrays(seed=seed), keep=2)
+        versions = [d for d in os.listdir(root) if not d.startswith('.') and os.path.isdir(os.path.join(root, d))]
+        self.assertEqual(len(versions), 2)
+        self.assertIn(live, versions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+import numpy as np
+
+from backend.utils.templates import select_templates
+
+
+def unit(v):
+    v = np.asarray(v, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+
+class TestTemplateSelection(unittest.TestCase):
+    def test_keeps_everything_under_the_cap(self):
+        self.assertEqual(select_templates([unit([1, 0])] * 3, [0.1, 0.2, 0.3], 5), [0, 1, 2])
+        self.assertEqual(select_templates([unit([1, 0])] * 3, [0.1, 0.2, 0.3], 0), [0, 1, 2])
+
+    def test_prefers_quality_then_diversity_over_near_duplicates(self):
+        base = unit([1, 0, 0])
+        vecs = [base, unit([1, 0.01, 0]), unit([0.6, 0.8, 0]), unit([1, 0, 0.02])]
+        scores = [0.9, 0.95, 0.6, None]
+        # best quality first (1), then the distinct pose (2) beats the duplicates of 1
+        self.assertEqual(select_templates(vecs, scores, 2), [1, 2])
+        # with diversity switched off only the scores count (None ranks as 0.5)
+        self.assertEqual(select_templates(vecs, scores, 2, diversity=0.0), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
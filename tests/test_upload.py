@@ -0,0 +1,30 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+
+from backend.utils.upload import UploadTooLarge, read_upload, write_atomic
+
+
+class TestUploadIO(unittest.TestCase):
+    def test_read_upload_hashes_in_one_pass(self):
+        data = os.urandom(200 * 1024 + 7)
+        got, digest = read_upload(io.BytesIO(data), max_bytes=len(data), chunk_size=4096)
+        self.assertEqual(got, data)
+        self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+        with self.assertRaises(UploadTooLarge):
+            read_upload(io.BytesIO(data), max_bytes=len(data) - 1, chunk_size=4096)
+
+    def test_write_atomic_leaves_only_the_target(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'faces', 'a.jpg')
+            write_atomic(path, b'one')
+            write_atomic(path, b'two')
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), b'two')
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['a.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Recall/latency report for the IVF gallery index against exact search.
+
+Builds a synthetic gallery of unit-norm 128-d centroids (or loads a
+centroid matrix saved with `np.save`), then compares ANN-backed decisions
+with the exact matrix scan for a set of noisy probe queries.
+
+Usage:
+    python tools/ann_benchmark.py --users 100000 --queries 500 --nprobe 8
+    python tools/ann_benchmark.py --centroids gallery.npy
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from backend.utils.ann import IVFIndex, recall_report  # noqa: E402
+from backend.utils.matcher import MatchEngine, normalize_rows  # noqa: E402
+
+
+def synthetic_centroids(n, dim=128, seed=0):
+    rng = np.random.default_rng(seed)
+    return normalize_rows(rng.normal(size=(n, dim)))
+
+
+def probe_queries(centroids, n, noise=0.25, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(centroids.shape[0], size=n, replace=centroids.shape[0] < n)
+    noisy = centroids[picks] + noise * rng.normal(size=(n, centroids.shape[1])) / np.sqrt(centroids.shape[1])
+    return normalize_rows(noisy)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--users', type=int, default=100000)
+    ap.add_argument('--centroids', help='.npy file with an N x 128 centroid matrix')
+    ap.add_argument('--queries', type=int, default=500)
+    ap.add_argument('--nlists', type=int, default=0)
+    ap.add_argument('--nprobe', type=int, default=8)
+    ap.add_argument('--topk', type=int, default=10)
+    args = ap.parse_args()
+
+    centroids = normalize_rows(np.load(args.centroids)) if args.centroids else synthetic_centroids(args.users)
+    profiles = {i: {'avg': c, 'faces': [c]} for i, c in enumerate(centroids)}
+
+    t0 = time.perf_counter()
+    engine = MatchEngine.from_profiles(profiles, ann=IVFIndex(n_lists=args.nlists or None, n_probe=args.nprobe),
+                                       ann_top_k=args.topk)
+    print("gallery: %d users, build+train %.2fs (train %.2fs)" % (
+        len(engine), time.perf_counter() - t0, engine.ann.train_seconds))
+    print("index:", engine.ann.stats())
+
+    report = recall_report(engine, probe_queries(centroids, args.queries))
+    for k, v in report.items():
+        print("%-20s %s" % (k, round(v, 4) if isinstance(v, float) else v))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Throughput and tail latency of encode micro-batching under synthetic load.
+
+`--clients` threads each encode `--requests` face chips one at a time
+(closed loop, like concurrent `/api/attendance/mark` calls) through an
+`EncodeBatcher` that runs dlib's encoder in this process with one batch
+at a time (a one-worker recognition pool). The first setting is the
+unbatched baseline (`--batch 1`); every other `--batch` size is run with
+`--wait-ms` and compared with it. The encoder's cost does not depend on
+the chip content, so random 150x150 chips are used.
+
+Usage:
+    python tools/batch_benchmark.py
+    python tools/batch_benchmark.py --clients 32 --requests 4 --batch 1,8,16,32 --wait-ms 5
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from backend.utils.encode_batcher import EncodeBatcher  # noqa: E402
+from backend.utils.face_utils import encode_chips  # noqa: E402
+
+
+def run_load(batcher, chips, clients, requests):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(i):
+        mine = []
+        for j in range(requests):
+            chip = chips[(i * requests + j) % len(chips)]
+            t0 = time.perf_counter()
+            batcher.encode([chip])
+            mine.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    return np.asarray(latencies) * 1000, wall
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--clients', type=int, default=16)
+    ap.add_argument('--requests', type=int, default=4, help='chips encoded by each client')
+    ap.add_argument('--batch', default='1,4,16', help='comma-separated batch sizes; the first is the baseline')
+    ap.add_argument('--wait-ms', type=float, default=float(os.getenv('ENCODE_BATCH_WAIT_MS', 5.0)))
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    chips = [rng.integers(0, 255, size=(150, 150, 3), dtype=np.uint8) for _ in range(64)]
+    encode_chips(chips[:1])  # load the network before timing
+
+    sizes = [int(b) for b in args.batch.split(',') if b.strip()]
+    print("%d clients x %d chips, wait %.1f ms" % (args.clients, args.requests, args.wait_ms))
+    print("%-6s %10s %8s %9s %9s %9s %10s %9s" % (
+        'batch', 'chips/s', 'gain', 'p50 ms', 'p95 ms', 'p99 ms', '+p99 ms', 'avg size'))
+    base = None
+    for size in sizes:
+        batcher = EncodeBatcher(encode_chips, max_batch=size, wait_ms=args.wait_ms if size > 1 else 0)
+        lat, wall = run_load(batcher, chips, args.clients, args.requests)
+        throughput = lat.size / wall
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+        if base is None:
+            base = (throughput, p99)
+        print("%-6d %10.1f %7.2fx %9.1f %9.1f %9.1f %10.1f %9.1f" % (
+            size, throughput, throughput / base[0], p50, p95, p99, p99 - base[1], batcher.stats()['avg_batch']))
+
+
+if __name__ == '__main__':
+    main()
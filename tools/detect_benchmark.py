@@ -0,0 +1,89 @@
+"""Before/after latency of downscale-before-detect in `detect_and_encode`.
+
+Runs the detect+encode pipeline on each image twice: at full resolution
+(FACE_DETECT_MAX_SIDE=0, FACE_ENCODE_FACE_PX=0, the previous behaviour) and
+with the configured detection size and encoder crop. By default the images
+are synthetic phone-sized frames (smoothed noise, no faces), which measures
+the detector scan that dominates request latency; pass `--images DIR` to
+use real photos, where boxes found at both settings are compared as well.
+
+Usage:
+    python tools/detect_benchmark.py
+    python tools/detect_benchmark.py --images ./samples --max-side 1024 --repeat 3
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from backend.utils.face_utils import detect_and_encode  # noqa: E402
+
+# (height, width) of common phone camera outputs
+SYNTHETIC_SIZES = [(4032, 3024), (3264, 2448), (2592, 1944), (1920, 1080)]
+
+
+def synthetic_images(seed=0):
+    rng = np.random.default_rng(seed)
+    for h, w in SYNTHETIC_SIZES:
+        small = rng.integers(0, 255, size=(h // 16, w // 16, 3), dtype=np.uint8)
+        yield '%dx%d' % (w, h), cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+
+
+def folder_images(path):
+    for name in sorted(os.listdir(path)):
+        img = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if img is not None:
+            yield name, cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def timed(rgb, repeat, **kw):
+    best = None
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = detect_and_encode(rgb, **kw)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return out, 1000 * best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--images', help='directory of photos (default: synthetic frames)')
+    ap.add_argument('--max-side', type=int, default=int(os.getenv('FACE_DETECT_MAX_SIDE', 1024)))
+    ap.add_argument('--encode-face-px', type=int, default=int(os.getenv('FACE_ENCODE_FACE_PX', 200)))
+    ap.add_argument('--min-face-px', type=int, default=int(os.getenv('MIN_FACE_HEIGHT_PX', 120)))
+    ap.add_argument('--model', default='hog')
+    ap.add_argument('--repeat', type=int, default=2)
+    args = ap.parse_args()
+
+    images = folder_images(args.images) if args.images else synthetic_images()
+    common = {'model': args.model, 'fallback_model': '', 'min_face_px': args.min_face_px}
+    print("%-24s %10s %10s %8s %6s %6s" % ('image', 'full ms', 'scaled ms', 'speedup', 'faces', 'same'))
+    total_full = total_scaled = 0.0
+    for name, rgb in images:
+        full, full_ms = timed(rgb, args.repeat, max_side=0, encode_face_px=0, **common)
+        scaled, scaled_ms = timed(rgb, args.repeat, max_side=args.max_side,
+                                  encode_face_px=args.encode_face_px, **common)
+        total_full += full_ms
+        total_scaled += scaled_ms
+        same = len(full['boxes']) == len(scaled['boxes'])
+        print("%-24s %10.1f %10.1f %7.1fx %6d %6s" % (
+            name[:24], full_ms, scaled_ms, full_ms / max(scaled_ms, 1e-9), len(scaled['boxes']), 'yes' if same else 'NO'))
+        encoded = [e for e in full['encodings'] + scaled['encodings'] if e is not None]
+        if full['encodings'] and scaled['encodings'] and same and len(encoded) == 2 * len(full['boxes']):
+            d = np.linalg.norm(np.asarray(full['encodings']) - np.asarray(scaled['encodings']), axis=1)
+            print("%-24s embedding distance full vs scaled: max %.4f" % ('', float(d.max())))
+    if total_scaled:
+        print("total: %.1f ms -> %.1f ms (%.1fx)" % (total_full, total_scaled, total_full / total_scaled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Latency and decision agreement of the recognition profiles on one image set.
+
+Every image is run through blur check + `detect_and_encode` + `decide_match`
+once per profile (see `backend/utils/profiles.py`). Decisions are compared
+with the reference profile (`--reference`, default 'accurate').
+
+With `--images DIR` laid out as one sub-directory per person, the first
+image of each person is enrolled with the profile enrollment runs under
+(`--enroll-profile`, default RECOGNITION_PROFILE) and the remaining images
+are the queries. Per profile the table shows the share of queries accepted,
+the distance between each query's embedding and the enrollment profile's
+embedding of the same image (mean and max; a profile that encodes
+differently from enrollment shows up here), and accuracy against the folder
+label. Without `--images`, synthetic phone-sized frames are used,
+which only measures latency of the no-face path.
+
+Usage:
+    python tools/profile_benchmark.py --images ./people
+    python tools/profile_benchmark.py --profiles fast,balanced
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from backend.utils.face_utils import decide_match, detect_and_encode, probe_detectors  # noqa: E402
+from backend.utils.matcher import MatchEngine  # noqa: E402
+from backend.utils.quality import QUALITY_BLUR_THRESHOLD  # noqa: E402
+from backend.utils.profiles import DEFAULT_PROFILE, PROFILES, detect_kwargs, get_profile  # noqa: E402
+
+
+def labeled_images(root):
+    for person in sorted(os.listdir(root)):
+        pdir = os.path.join(root, person)
+        if not os.path.isdir(pdir):
+            continue
+        for name in sorted(os.listdir(pdir)):
+            img = cv2.imread(os.path.join(pdir, name), cv2.IMREAD_COLOR)
+            if img is not None:
+                yield person, img
+
+
+def synthetic_images(n=4, seed=0):
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        small = rng.integers(0, 255, size=(189, 252, 3), dtype=np.uint8)
+        yield None, cv2.resize(small, (4032, 3024), interpolation=cv2.INTER_NEAREST)
+
+
+def run_profile(profile, bgr, min_face_px, blur_default):
+    """Return (embedding or None, reason, ms) for one image."""
+    t0 = time.perf_counter()
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    min_face_px = profile['min_face_px'] or min_face_px
+    out = detect_and_encode(rgb, min_face_px=min_face_px, blur_threshold=profile['blur_threshold'] or blur_default,
+                            **detect_kwargs(profile))
+    ms = 1000 * (time.perf_counter() - t0)
+    reason = (out.get('quality') or {}).get('reason')
+    if reason in ('blurry', 'too_dark', 'too_bright'):
+        return None, reason, ms
+    if len(out['boxes']) != 1:
+        return None, 'no_face' if not out['boxes'] else 'multi_face', ms
+    if out['heights'][0] < min_face_px or not out['encodings'] or out['encodings'][0] is None:
+        return None, 'too_small', ms
+    return out['encodings'][0], 'ok', ms
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--images', help='directory with one sub-directory of photos per person')
+    ap.add_argument('--profiles', default=','.join(PROFILES))
+    ap.add_argument('--reference', default='accurate')
+    ap.add_argument('--enroll-profile', default=DEFAULT_PROFILE)
+    ap.add_argument('--min-face-px', type=int, default=int(os.getenv('MIN_FACE_HEIGHT_PX', 120)))
+    ap.add_argument('--blur-threshold', type=float, default=QUALITY_BLUR_THRESHOLD)
+    ap.add_argument('--user-tol', type=float, default=float(os.getenv('USER_TOL', 0.45)))
+    ap.add_argument('--user-margin', type=float, default=float(os.getenv('USER_MARGIN', 0.15)))
+    ap.add_argument('--face-tol', type=float, default=float(os.getenv('FACE_TOL', 0.55)))
+    args = ap.parse_args()
+    tol = (args.user_tol, args.user_margin, args.face_tol)
+    names = [n.strip() for n in args.profiles.split(',') if n.strip()]
+    if args.reference not in names:
+        names.append(args.reference)
+    profiles = {n: get_profile(n) for n in names}
+    enroll_profile = get_profile(args.enroll_profile)
+    # same CNN availability decision as the app makes at startup
+    probe_detectors()
+
+    images = list(labeled_images(args.images) if args.images else synthetic_images())
+
+    # enroll the first image of each person the way the enroll route does
+    gallery, queries, seen = {}, [], set()
+    for label, bgr in images:
+        if label is not None and label not in seen:
+            seen.add(label)
+            vec, reason, _ = run_profile(enroll_profile, bgr, args.min_face_px, args.blur_threshold)
+            if vec is not None:
+                gallery[label] = {'avg': vec, 'faces': [vec]}
+            continue
+        queries.append((label, bgr))
+    engine = MatchEngine.from_profiles(gallery) if gallery else None
+    # the query images as the enrollment profile encodes them
+    enrolled = [run_profile(enroll_profile, bgr, args.min_face_px, args.blur_threshold)[0] for _, bgr in queries]
+    print("%d enrolled with '%s', %d queries" % (len(gallery), enroll_profile['name'], len(queries)))
+
+    decisions = {}
+    rows = []
+    for name in names:
+        ms_all, out, dists = [], [], []
+        for (label, bgr), base in zip(queries, enrolled):
+            vec, reason, ms = run_profile(profiles[name], bgr, args.min_face_px, args.blur_threshold)
+            ms_all.append(ms)
+            if vec is not None and base is not None:
+                dists.append(float(np.linalg.norm(np.asarray(vec) - np.asarray(base))))
+            if vec is None or engine is None:
+                out.append((reason, None))
+                continue
+            accepted, debug = decide_match(vec, engine, *tol)
+            out.append(('accepted' if accepted else 'rejected', debug['best_uid'] if accepted else None))
+        decisions[name] = out
+        rows.append((name, ms_all, out, dists))
+
+    ref = decisions[args.reference]
+    print("%-10s %9s %9s %9s %9s %9s %9s %9s %9s" % (
+        'profile', 'mean ms', 'p95 ms', 'detected', 'accepted', 'agree', 'enc dist', 'enc max', 'correct'))
+    for name, ms_all, out, dists in rows:
+        n = max(len(out), 1)
+        detected = sum(1 for r, _ in out if r in ('accepted', 'rejected')) / n
+        accepted = sum(1 for r, _ in out if r == 'accepted') / n
+        agree = sum(1 for a, b in zip(out, ref) if a == b) / n
+        labeled = [(lbl, o) for (lbl, _), o in zip(queries, out) if lbl is not None]
+        correct = (sum(1 for lbl, o in labeled if o[1] == lbl) / len(labeled)) if labeled else float('nan')
+        print("%-10s %9.1f %9.1f %9.3f %9.3f %9.3f %9.3f %9.3f %9.3f" % (
+            name, float(np.mean(ms_all)) if ms_all else 0.0,
+            float(np.percentile(ms_all, 95)) if ms_all else 0.0, detected, accepted, agree,
+            float(np.mean(dists)) if dists else float('nan'), max(dists) if dists else float('nan'), correct))
+
+
+if __name__ == '__main__':
+    main()
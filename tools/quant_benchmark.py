@@ -0,0 +1,152 @@
+"""Memory/latency/decision report for the compact (float16/int8) gallery modes.
+
+Compares each quantized mode with the exact float32 engine on the same
+gallery and queries. The gallery is either synthetic or a snapshot
+written by `flask --app manage gallery export`; with a snapshot the
+stored face embeddings are replayed as queries.
+
+`resident MB` is the memory the engine keeps after a build from
+in-memory arrays (as the gallery does from the database), measured with
+tracemalloc, so it includes the Python-side per-user overhead. Quantized
+engines re-rank from the memory-mapped snapshot (`mapped MB`, shared page
+cache, only candidate rows are read). `recall@1` is the share of queries
+whose best user equals the float32 engine's.
+
+With `--log`, logged match decisions (logs/face_match_log.csv) whose
+margin or distance to a threshold is inside the measured quantization
+error are counted, i.e. past decisions that a compact scan could order
+differently before the float32 re-rank.
+
+Usage:
+    python tools/quant_benchmark.py --users 20000 --faces-per-user 5 --queries 500
+    python tools/quant_benchmark.py --snapshot /var/lib/face-gallery --log logs/face_match_log.csv
+"""
+import argparse
+import csv
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from backend.utils.matcher import ArrayRows, MatchEngine, normalize_rows  # noqa: E402
+from backend.utils.quant import QUANT_MODES  # noqa: E402
+from backend.utils.snapshot import load_snapshot, write_snapshot  # noqa: E402
+
+
+def synthetic_gallery(n, faces_per_user=1, dim=128, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = normalize_rows(rng.normal(size=(n, dim)))
+    owners = np.repeat(np.arange(n), faces_per_user)
+    faces = normalize_rows(centroids[owners] + 0.15 * rng.normal(size=(owners.shape[0], dim)) / np.sqrt(dim))
+    return {'uids': np.arange(1, n + 1), 'centroids': centroids, 'faces': faces,
+            'offsets': np.arange(n + 1, dtype=np.int64) * faces_per_user}
+
+
+def build(snapshot_dir, mode, rerank):
+    """Engine built from in-memory arrays and the bytes it keeps afterwards."""
+    _, mapped = load_snapshot(snapshot_dir)
+    gc.collect()
+    tracemalloc.start()
+    _, arrays = load_snapshot(snapshot_dir, mmap=False)
+    if mode == 'float32':
+        engine = MatchEngine.from_arrays(**arrays)
+    else:
+        engine = MatchEngine.from_arrays(quant=mode, quant_rerank=rerank, exact_rows=ArrayRows(**mapped), **arrays)
+    del arrays
+    gc.collect()
+    resident = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return engine, resident
+
+
+def run(engine, queries, tol):
+    t0 = time.perf_counter()
+    out = [engine.decide(q, *tol) for q in queries]
+    return out, 1000 * (time.perf_counter() - t0) / max(len(queries), 1)
+
+
+def log_rows_at_risk(path, err, tol):
+    rows = at_risk = 0
+    with open(path) as fh:
+        for r in csv.DictReader(fh):
+            try:
+                best_d, margin = float(r['best_d']), float(r['margin'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            rows += 1
+            if abs(best_d - tol[0]) <= err or abs(margin - tol[1]) <= 2 * err:
+                at_risk += 1
+    return rows, at_risk
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--users', type=int, default=100000)
+    ap.add_argument('--faces-per-user', type=int, default=5)
+    ap.add_argument('--snapshot', help='gallery snapshot directory')
+    ap.add_argument('--queries', type=int, default=500)
+    ap.add_argument('--rerank', type=int, default=16)
+    ap.add_argument('--log', help='match log CSV to check against the measured error')
+    ap.add_argument('--user-tol', type=float, default=float(os.getenv('USER_TOL', 0.45)))
+    ap.add_argument('--user-margin', type=float, default=float(os.getenv('USER_MARGIN', 0.15)))
+    ap.add_argument('--face-tol', type=float, default=float(os.getenv('FACE_TOL', 0.55)))
+    args = ap.parse_args()
+    tol = (args.user_tol, args.user_margin, args.face_tol)
+
+    if args.snapshot:
+        _, arrays = load_snapshot(args.snapshot, mmap=False)
+    else:
+        arrays = synthetic_gallery(args.users, args.faces_per_user)
+    rng = np.random.default_rng(1)
+    pool = arrays['faces'] if arrays['faces'].shape[0] else arrays['centroids']
+    queries = pool[rng.choice(pool.shape[0], size=min(args.queries, pool.shape[0]), replace=False)]
+    snapshot_dir = tempfile.mkdtemp(prefix='quant-bench-')
+    write_snapshot(snapshot_dir, arrays)
+    centroids = arrays['centroids']
+    mapped_mb = (centroids.nbytes + arrays['faces'].nbytes) / 2.0 ** 20
+    del arrays
+
+    try:
+        exact, resident = build(snapshot_dir, 'float32', args.rerank)
+        ref, ref_ms = run(exact, queries, tol)
+        print("gallery: %d users, %d faces, %d queries" % (len(exact), exact.face_count, len(queries)))
+        print("%-8s %12s %10s %10s %10s %10s %10s" % (
+            'mode', 'resident MB', 'mapped MB', 'ms/query', 'recall@1', 'same dec', 'max err'))
+        print("%-8s %12.1f %10s %10.3f %10.4f %10.4f %10s" % (
+            'float32', resident / 2.0 ** 20, '-', ref_ms, 1.0, 1.0, '-'))
+        del exact
+
+        worst_err = 0.0
+        for mode in QUANT_MODES:
+            engine, resident = build(snapshot_dir, mode, args.rerank)
+            res, ms = run(engine, queries, tol)
+            same_uid = np.mean([a[1]['best_uid'] == b[1]['best_uid'] for a, b in zip(res, ref)])
+            same_dec = np.mean([a[0] == b[0] for a, b in zip(res, ref)])
+            # distance error of the compact representation itself (before re-rank)
+            sample = rng.choice(len(engine), size=min(2000, len(engine)), replace=False)
+            approx = engine._compact.decode(sample)
+            err = float(np.max(np.abs(np.linalg.norm(approx - queries[0], axis=1)
+                                      - np.linalg.norm(centroids[sample] - queries[0], axis=1))))
+            worst_err = max(worst_err, err)
+            print("%-8s %12.1f %10.1f %10.3f %10.4f %10.4f %10.5f" % (
+                mode, resident / 2.0 ** 20, mapped_mb, ms, same_uid, same_dec, err))
+            del engine
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    if args.log:
+        rows, at_risk = log_rows_at_risk(args.log, worst_err, tol)
+        print("match log: %d decisions, %d within quantization error of a threshold" % (rows, at_risk))
+
+
+if __name__ == '__main__':
+    main()